@@ -6,16 +6,21 @@ verion's objects did, and the database objects contain a relational version
 of the same.
 """
 import logging
-from rvr.infrastructure.util import concatenate
 from rvr.db.tables import GameHistoryActionResult, GameHistoryRangeAction,  \
-    GameHistoryUserRange, AnalysisFoldEquity, GameHistoryBoard,  \
-    AnalysisFoldEquityItem
+    AnalysisFoldEquity, GameHistoryBoard, AnalysisFoldEquityItem
+from rvr.db.history import load_history_items
+from rvr.db.packing import pack_fold_equity_items
+from rvr.db.ranges import parsed_range
 from rvr.poker.handrange import HandRange
-from rvr.poker.cards import Card, RIVER, PREFLOP
+from rvr.poker.cards import Card, RIVER, PREFLOP, combo_id
 import unittest
 
 # pylint:disable=R0902,R0913,R0914,R0903
 
+# Store each spot's AnalysisFoldEquityItems packed into its AnalysisFoldEquity,
+# rather than as individual rows.
+PACK_FOLD_EQUITY_ITEMS = True
+
 def _range_desc_to_size(range_description):
     """
     Given a range description, determine the number of combos it represents.
@@ -60,9 +65,9 @@ class FoldEquityAccumulator(object):
         logging.debug("gameid %d, FEA %d, adding folder: userid %d",
                       self.gameid, self.order, ghra.userid)
         self.potential_folders.remove(ghra.userid)
-        fold_range = HandRange(ghra.fold_range)
-        pas = HandRange(ghra.passive_range)
-        agg = HandRange(ghra.aggressive_range)
+        fold_range = parsed_range(ghra.fold_rangeid, ghra.fold_range)
+        pas = parsed_range(ghra.passive_rangeid, ghra.passive_range)
+        agg = parsed_range(ghra.aggressive_rangeid, ghra.aggressive_range)
         nonfold_range = pas.add(agg, self.board)
         self.folds.append((ghra.userid, fold_range, nonfold_range))
         return len(self.potential_folders) == 0
@@ -90,9 +95,7 @@ class FoldEquityAccumulator(object):
         afei = AnalysisFoldEquityItem()
         afei.gameid = self.gameid
         afei.order = self.order
-        lower_card, higher_card = sorted(combo)
-        afei.higher_card = higher_card.to_mnemonic()
-        afei.lower_card = lower_card.to_mnemonic()
+        afei.comboid = combo_id(*combo)
         afei.is_aggressive = is_agg
         afei.is_passive = is_pas
         afei.is_fold = is_fol
@@ -116,27 +119,35 @@ class FoldEquityAccumulator(object):
             afei.semibluff_equity = None
         return afei
     
-    def finalise(self, session):
+    def finalise(self, session, packed=PACK_FOLD_EQUITY_ITEMS):
         """
         Assuming complete, return an AnalysisFoldEquity
+        
+        If packed, the items are packed into the AnalysisFoldEquity, otherwise
+        they are added as AnalysisFoldEquityItems.
         """
         logging.debug("gameid %d, FEA %d, calculating...", self.gameid,
                       self.order)
         assert len(self.potential_folders) == 0
         afe = self._create_afe()
         session.add(afe)
-        for combo in HandRange(self.range_action.aggressive_range)  \
+        afeis = []
+        action = self.range_action
+        for combo in parsed_range(action.aggressive_rangeid,
+                                  action.aggressive_range)  \
                 .generate_options_unweighted(self.board):
-            afei = self._create_afei(combo, is_agg=True)
-            session.add(afei)
-        for combo in HandRange(self.range_action.passive_range)  \
+            afeis.append(self._create_afei(combo, is_agg=True))
+        for combo in parsed_range(action.passive_rangeid,
+                                  action.passive_range)  \
                 .generate_options_unweighted(self.board):
-            afei = self._create_afei(combo, is_pas=True)
-            session.add(afei)
-        for combo in HandRange(self.range_action.fold_range)  \
+            afeis.append(self._create_afei(combo, is_pas=True))
+        for combo in parsed_range(action.fold_rangeid, action.fold_range)  \
                 .generate_options_unweighted(self.board):
-            afei = self._create_afei(combo, is_fol=True)
-            session.add(afei)
+            afeis.append(self._create_afei(combo, is_fol=True))
+        if packed:
+            afe.packed_items = pack_fold_equity_items(afeis)
+        else:
+            session.add_all(afeis)
         logging.debug("gameid %d, FEA %d, finalised", self.gameid, self.order)
         return afe
         # TODO: 3: need a supplementary table for individual folders
@@ -245,14 +256,7 @@ class AnalysisReplayer(object):
         """
         gameid = self.game.gameid
         logging.debug("gameid %d, AnalysisReplayer, analyse", gameid)
-        items = [self.session.query(table)
-                 .filter(table.gameid == gameid).all()
-                 for table in [GameHistoryBoard,
-                               GameHistoryUserRange,
-                               GameHistoryActionResult,
-                               GameHistoryRangeAction]]
-        child_items = sorted(concatenate(items),
-                             key=lambda c: c.order)
+        child_items = load_history_items(self.session, gameid)
         self.ranges = {self.game.rgps[i].userid:
                   self.game.situation.players[i].range_raw
                   for i in range(len(self.game.situation.players))}
@@ -0,0 +1,3 @@
+"""
+Benchmarks, run against ephemeral databases (see rvr.core.fixture).
+"""
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""
+Benchmark of running-game queries, with lots of old finished games either in
+the hot tables or archived (see rvr.db.archive).
+
+Usage: python -m rvr.bench.archive [<finished games> ...]
+(default: 10000 100000)
+
+For each number of finished games, this plays one game to the end, clones it
+(rows and snapshot) that many times, starts a running game, and times some
+typical queries, before and after archiving the finished games.
+"""
+import datetime
+import random
+import sys
+import time
+from rvr.core.api import APIError
+from rvr.core.fixture import ephemeral_db
+from rvr.core.cache import GAME_CACHE
+from rvr.db.creation import session_scope
+from rvr.bench.cloning import read_games, clone_game, insert_batch
+from rvr.bench.games import create_users, start_game, play_game,  \
+    random_action
+from rvr.mail.notifications import NOTIFICATION_SETTINGS
+
+DEFAULT_SIZES = [10000, 100000]
+REPEATS = 20
+BATCH_GAMES = 1000
+
+def _clone_game(gameid, copies, first_gameid, last_action_time):
+    """
+    Insert <copies> copies of game <gameid> (rows and snapshot), with gameids
+    from first_gameid, last changed at last_action_time.
+    """
+    with session_scope() as session:
+        template = read_games(session, [gameid])[gameid]
+        for start in range(0, copies, BATCH_GAMES):
+            batch = {}
+            for i in range(start, min(copies, start + BATCH_GAMES)):
+                clone_game(template, first_gameid + i, batch,
+                           last_action_time=last_action_time)
+            insert_batch(session, batch)
+
+def _time(fun):
+    """
+    Median time to call fun(), in milliseconds
+    """
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        fun()
+        times.append(time.time() - start)
+    times.sort()
+    return 1000.0 * times[len(times) // 2]
+
+def _measure(api, running_gameid, userid, finished_gameid):
+    """
+    Time the queries, returning a list of (description, milliseconds)
+    """
+    def private_game():
+        """ View of a running game, not from the cache """
+        GAME_CACHE.clear()
+        api.get_private_game(running_gameid, userid)
+    def public_game():
+        """ View of an old finished game, not from the cache """
+        GAME_CACHE.clear()
+        api.get_public_game(finished_gameid)
+    cutoff = datetime.datetime.utcnow()
+    return [
+        ("get_private_game (running)", _time(private_game)),
+        ("get_game_update (running)",
+         _time(lambda: api.get_game_update(running_gameid, 0, userid))),
+        ("find_timeouts", _time(lambda: api.find_timeouts(cutoff, -1, None))),
+        ("run_pending_analysis (nothing to do)",
+         _time(api.run_pending_analysis)),
+        ("get_public_game (old, finished)", _time(public_game))]
+
+def run(finished_games, rng):
+    """
+    Benchmark with <finished_games> old finished games. Returns a list of
+    (description, milliseconds before archiving, milliseconds after).
+    """
+    with ephemeral_db() as api:
+        userids = create_users(api, 2)
+        template = start_game(api, userids, 2)
+        play_game(api, template, rng)
+        api.run_pending_analysis()
+        first_gameid = template + 1000
+        long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+        _clone_game(template, finished_games, first_gameid, long_ago)
+        api.ensure_open_games()
+        running = start_game(api, userids, 2)
+        random_action(api, running, rng)
+        finished = first_gameid + finished_games // 2
+        before = _measure(api, running, userids[0], finished)
+        while True:
+            archived = api.archive_games(batch_size=10000)
+            if isinstance(archived, APIError):
+                raise RuntimeError("API error: %s" % (archived,))
+            if archived == 0:
+                break
+        after = _measure(api, running, userids[0], finished)
+        return [(description, ms_before, ms_after)
+                for (description, ms_before), (_, ms_after)
+                in zip(before, after)]
+
+def main():
+    """
+    Run the benchmark for the sizes given on the command line
+    """
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    NOTIFICATION_SETTINGS.suppress_email = True
+    for size in sizes:
+        start = time.time()
+        results = run(size, random.Random(0))
+        print "%d finished games (%0.1fs to set up and run):" %  \
+            (size, time.time() - start)
+        print "  %-40s %12s %12s" % ("median ms", "hot", "archived")
+        for description, ms_before, ms_after in results:
+            print "  %-40s %12.2f %12.2f" % (description, ms_before, ms_after)
+
+if __name__ == '__main__':
+    main()
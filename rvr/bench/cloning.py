@@ -0,0 +1,69 @@
+"""
+Copying games' rows in bulk, for benchmarks that need lots of games.
+"""
+import datetime
+from rvr.db import tables
+from rvr.db.archive import ARCHIVED_TABLES
+
+# All of the rows of a game, parents first
+GAME_TABLES = [tables.RunningGame,
+               tables.RunningGameParticipant] +  \
+    ARCHIVED_TABLES +  \
+    [tables.GameHistorySnapshot]
+
+USER_COLUMNS = ['userid', 'current_userid']
+
+def read_games(session, gameids, classes=None):
+    """
+    The rows of games <gameids> in the tables of <classes> (default:
+    GAME_TABLES), as {gameid: template}, where each template is a list of
+    (table, rows) in the order of classes, and each row is a dict.
+    """
+    if classes is None:
+        classes = GAME_TABLES
+    found = {gameid: {} for gameid in gameids}
+    for cls in classes:
+        table = cls.__table__
+        for row in session.execute(
+                table.select().where(table.c.gameid.in_(gameids))):
+            found[row['gameid']].setdefault(table, []).append(
+                dict(row.items()))
+    return {gameid: [(cls.__table__, by_table.get(cls.__table__, []))
+                     for cls in classes]
+            for gameid, by_table in found.iteritems()}
+
+def clone_game(template, gameid, batch, users=None, situationids=None,
+               last_action_time=None):
+    """
+    Add to batch (table -> rows) the rows of a copy of <template> (from
+    read_games), as game <gameid>.
+
+    If specified, users and situationids map the template's userids and
+    situationids to the copy's, and all of the copy's times are moved so that
+    it was last changed at last_action_time.
+    """
+    delta = None
+    if last_action_time is not None:
+        delta = last_action_time - template[0][1][0]['last_action_time']
+    for table, rows in template:
+        for row in rows:
+            row = dict(row, gameid=gameid)
+            if users is not None:
+                for column in USER_COLUMNS:
+                    if row.get(column) is not None:
+                        row[column] = users[row[column]]
+            if situationids is not None and 'situationid' in row:
+                row['situationid'] = situationids[row['situationid']]
+            if delta is not None:
+                for key, value in row.items():
+                    if isinstance(value, datetime.datetime):
+                        row[key] = value + delta
+            batch.setdefault(table, []).append(row)
+
+def insert_batch(session, batch):
+    """
+    Insert batch (table -> rows, from clone_game), parents first
+    """
+    for cls in GAME_TABLES:
+        if batch.get(cls.__table__):
+            session.execute(cls.__table__.insert(), batch[cls.__table__])
@@ -0,0 +1,110 @@
+"""
+Benchmark of action throughput when several threads are playing separate
+games at once, against an on-disk database (so that each thread has its own
+connection).
+
+Usage: python -m rvr.bench.concurrency [<games> [<threads> ...]]
+(default: 8 games, with 1 2 4 threads)
+
+Each run starts <games> heads-up games, then shares them between the
+threads, which each play their games to the end with random actions.
+Transient database errors (e.g. due to lock contention) are retried by @api,
+and counted as retries. Actions that fail anyway are counted and retried, but
+if a game's actions fail MAX_FAILURES times in a row, the benchmark stops.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from rvr.core.api import API
+from rvr.core.fixture import ephemeral_db
+from rvr.db.creation import RETRY_STATS
+from rvr.bench.games import create_users, start_game, random_action
+from rvr.mail.notifications import NOTIFICATION_SETTINGS
+
+DEFAULT_GAMES = 8
+DEFAULT_THREADS = [1, 2, 4]
+MAX_FAILURES = 10
+
+def _play(job):
+    """
+    job is (seed, gameids). Play the games to the end, in turn, one action at
+    a time. Returns (actions, failures).
+    
+    Raises RuntimeError if a game's actions fail MAX_FAILURES times in a row,
+    because that's not contention, it's something wrong with the game.
+    """
+    seed, gameids = job
+    api = API()  # an API's session is not shareable between threads
+    rng = random.Random(seed)
+    actions = 0
+    failures = 0
+    remaining = list(gameids)
+    in_a_row = {gameid: 0 for gameid in gameids}
+    while remaining:
+        for gameid in list(remaining):
+            try:
+                if random_action(api, gameid, rng):
+                    actions += 1
+                else:
+                    remaining.remove(gameid)
+                in_a_row[gameid] = 0
+            except RuntimeError as ex:
+                failures += 1
+                in_a_row[gameid] += 1
+                if in_a_row[gameid] == MAX_FAILURES:
+                    raise RuntimeError("Game %d failed %d times in a row, "
+                                       "most recently with %s" %
+                                       (gameid, MAX_FAILURES, ex))
+    return actions, failures
+
+def run(games, threads, dirname):
+    """
+    Benchmark <games> games played by <threads> threads. Returns (actions,
+    failures, retries, seconds).
+    """
+    with ephemeral_db(os.path.join(dirname, 'bench.db')) as api:
+        userids = create_users(api, 2 * games)
+        gameids = [start_game(api, userids[2 * i:2 * i + 2], 2)
+                   for i in range(games)]
+        shares = [gameids[i::threads] for i in range(threads)]
+        pool = ThreadPool(threads)
+        RETRY_STATS.reset()
+        start = time.time()
+        try:
+            results = pool.map(_play, enumerate(shares))
+        finally:
+            pool.close()
+            pool.join()
+        seconds = time.time() - start
+    return (sum(actions for actions, _ in results),
+            sum(failures for _, failures in results),
+            RETRY_STATS.retries,
+            seconds)
+
+def main():
+    """
+    Run the benchmark with the parameters given on the command line
+    """
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_GAMES
+    thread_counts = [int(arg) for arg in sys.argv[2:]] or DEFAULT_THREADS
+    NOTIFICATION_SETTINGS.suppress_email = True
+    dirname = tempfile.mkdtemp()
+    try:
+        print "%d games:" % (games,)
+        print "  %8s %8s %8s %8s %10s %10s" %  \
+            ("threads", "actions", "retries", "failed", "seconds", "actions/s")
+        for threads in thread_counts:
+            actions, failures, retries, seconds =  \
+                run(games, threads, dirname)
+            print "  %8d %8d %8d %8d %10.2f %10.1f" %  \
+                (threads, actions, retries, failures, seconds,
+                 actions / seconds)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Creating users and playing games through the API, for benchmarks.
+"""
+from rvr.core.api import APIError
+from rvr.core import dtos
+from rvr.poker.handrange import HandRange, unweighted_options_to_description
+from rvr.poker.cards import Card
+
+def _check(result):
+    """
+    Raise RuntimeError if result is an APIError, otherwise return it
+    """
+    if isinstance(result, APIError):
+        raise RuntimeError("API error: %s" % (result,))
+    return result
+
+def create_users(api, count, prefix='bench'):
+    """
+    Log in <count> new users, and return their userids
+    """
+    return [_check(api.login(dtos.LoginRequest(
+                identity='%s%d' % (prefix, i),
+                email='%s%d@example.com' % (prefix, i),
+                screenname='%s%d' % (prefix, i)))).userid
+            for i in range(count)]
+
+def start_game(api, userids, players):
+    """
+    Join userids to the open game for <players> players, and return the
+    gameid of the resulting running game.
+    """
+    open_games = _check(api.get_open_games())
+    open_game = [game for game in open_games
+                 if len(game.situation.players) == players][0]
+    gameid = None
+    for userid in userids[:players]:
+        gameid = _check(api.join_game(userid, open_game.gameid))
+    return gameid
+
+def split_random(hands, _board, rng):
+    """
+    Strategy: fold a random quarter of hands, bet or raise another quarter,
+    and check or call the rest. Returns (fold, passive, aggressive).
+    """
+    hands = list(hands)
+    rng.shuffle(hands)
+    quarter = len(hands) // 4
+    return hands[:quarter], hands[quarter:3 * quarter], hands[3 * quarter:]
+
+def _strength(hand, board):
+    """
+    A crude stand-in for equity: hands that pair the board (or are pocket
+    pairs) beat those that don't, then higher cards beat lower.
+    """
+    board_ranks = [card.rank for card in board]
+    ranks = sorted([card.rank for card in hand], reverse=True)
+    made = sum(board_ranks.count(rank) for rank in ranks) +  \
+        (2 if ranks[0] == ranks[1] else 0)
+    return (made, ranks)
+
+def split_by_strength(hands, board, _rng):
+    """
+    Strategy: fold the weakest quarter of hands (see _strength), bet or raise
+    the strongest quarter, and check or call the rest. Returns (fold,
+    passive, aggressive).
+    """
+    hands = sorted(hands, key=lambda hand: _strength(hand, board))
+    quarter = len(hands) // 4
+    return hands[:quarter], hands[quarter:3 * quarter], hands[3 * quarter:]
+
+STRATEGIES = {'random': split_random,
+              'strength': split_by_strength}
+
+def strategy_action(api, gameid, rng, strategy):
+    """
+    Have the current player of game <gameid> make a range action, by
+    splitting their range with <strategy> (see STRATEGIES), using
+    random.Random <rng>. Returns False if the game is finished.
+    """
+    game = _check(api.get_public_game(gameid))
+    if game.is_finished():
+        return False
+    userid = game.game_details.current_player.user.userid
+    game = _check(api.get_private_game(gameid, userid))
+    options = game.current_options
+    board = Card.many_from_text(game.game_details.board_raw)
+    hands = HandRange(game.game_details.current_player.range_raw)  \
+        .generate_options_unweighted(board)
+    fold, passive, aggressive = strategy(hands, board, rng)
+    if not options.can_raise():
+        passive, aggressive = passive + aggressive, []
+    if options.can_check():
+        passive, fold = passive + fold, []
+    if not aggressive:
+        raise_total = 0
+    elif rng.random() < 0.3:
+        raise_total = options.max_raise
+    else:
+        raise_total = options.min_raise
+    range_action = dtos.ActionDetails(
+        fold_raw=unweighted_options_to_description(fold),
+        passive_raw=unweighted_options_to_description(passive),
+        aggressive_raw=unweighted_options_to_description(aggressive),
+        raise_total=raise_total)
+    _check(api.perform_action(gameid, userid, range_action))
+    return True
+
+def random_action(api, gameid, rng):
+    """
+    Have the current player of game <gameid> make a random range action,
+    using random.Random <rng>. Returns False if the game is finished.
+    """
+    return strategy_action(api, gameid, rng, split_random)
+
+def play_game(api, gameid, rng, strategy=split_random):
+    """
+    Play game <gameid> to the end with <strategy> (default: random actions).
+    Returns the number of actions.
+    """
+    actions = 0
+    while strategy_action(api, gameid, rng, strategy):
+        actions += 1
+    return actions
@@ -0,0 +1,109 @@
+"""
+Self-play simulation, for end-to-end throughput benchmarks of the game engine.
+
+Usage: python -m rvr.bench.simulation [<games> [<strategy> [<filename>]]]
+(default: 1000 games, with the random strategy, in a temporary file)
+
+This plays <games> complete games, alternately heads-up and three-handed,
+with every player splitting their range by <strategy> (see
+rvr.bench.games.STRATEGIES). The database is a new one, in a temporary file
+or in <filename> (which must not exist), deleted afterwards. Then it runs the
+analysis of all of the games.
+"""
+import random
+import sys
+import time
+from rvr.core.api import API
+from rvr.core.fixture import ephemeral_db, suppressed_email
+from rvr.db.creation import count_queries
+from rvr.bench.games import create_users, start_game, play_game, STRATEGIES
+
+DEFAULT_GAMES = 1000
+DEFAULT_STRATEGY = 'random'
+
+class TimedAPI(API):
+    """
+    API that records the time taken by, and queries made by, each call to
+    perform_action
+    """
+    def __init__(self):
+        super(TimedAPI, self).__init__()
+        self.action_seconds = []
+        self.action_queries = []
+
+    def perform_action(self, gameid, userid, range_action):
+        """
+        See API.perform_action
+        """
+        start = time.time()
+        with count_queries() as queries:
+            result = super(TimedAPI, self).perform_action(gameid, userid,
+                                                          range_action)
+        self.action_seconds.append(time.time() - start)
+        self.action_queries.append(queries.count)
+        return result
+
+def _percentile(values, fraction):
+    """
+    The value at <fraction> (0 to 1) of the way through sorted values
+    """
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def run(games, strategy=DEFAULT_STRATEGY, filename=None, seed=0):
+    """
+    Play <games> games with <strategy>, then analyse them. Returns a dict of
+    results.
+    """
+    with suppressed_email():
+        with ephemeral_db(filename):
+            api = TimedAPI()
+            rng = random.Random(seed)
+            userids = create_users(api, 3, prefix='sim')
+            players_counts = {2: 0, 3: 0}
+            start = time.time()
+            for i in range(games):
+                players = 3 if i % 2 else 2
+                gameid = start_game(api, userids, players)
+                play_game(api, gameid, rng, STRATEGIES[strategy])
+                players_counts[players] += 1
+            play_seconds = time.time() - start
+            start = time.time()
+            api.run_pending_analysis()
+            analysis_seconds = time.time() - start
+    actions = len(api.action_seconds)
+    return {'games': games,
+            'heads_up': players_counts[2],
+            'three_way': players_counts[3],
+            'actions': actions,
+            'play_seconds': play_seconds,
+            'actions_per_second': actions / play_seconds,
+            'p50_ms': 1000.0 * _percentile(api.action_seconds, 0.5),
+            'p99_ms': 1000.0 * _percentile(api.action_seconds, 0.99),
+            'queries_per_action': sum(api.action_queries) / float(actions),
+            'analysis_seconds': analysis_seconds}
+
+def report(results):
+    """
+    The results of run, as text
+    """
+    return "\n".join([
+        "%(games)d games (%(heads_up)d heads-up, %(three_way)d three-way), "
+        "%(actions)d actions in %(play_seconds)0.1fs" % results,
+        "  actions/s:                 %(actions_per_second)10.1f" % results,
+        "  perform_action p50 (ms):   %(p50_ms)10.1f" % results,
+        "  perform_action p99 (ms):   %(p99_ms)10.1f" % results,
+        "  queries per perform_action: %(queries_per_action)9.1f" % results,
+        "  analysis (s):              %(analysis_seconds)10.1f" % results])
+
+def main():
+    """
+    Run the simulation with the parameters given on the command line
+    """
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_GAMES
+    strategy = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_STRATEGY
+    filename = sys.argv[3] if len(sys.argv) > 3 else None
+    print report(run(games, strategy, filename))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Synthetic data, for trying out pages, API calls and maintenance against a
+database with a large history.
+
+Usage: python -m rvr.bench.synthetic <users> <games> [<running> [<seed>]]
+(default: 10% of the games running, seed 0)
+
+This adds <games> games, shared between <users> users, to the configured
+database (which must already be initialised). A few template games are
+played for real (with random actions) in a separate temporary database,
+half of them to the end and analysed, and half only part of the way. The
+synthetic games are copies of these, bulk inserted, with new gameids, random
+participants, and times spread over the last year (finished games) or the
+last few days (running games, so that some of them have timed out).
+
+Everything but the times depends only on the seed. Users are named after the
+seed, so generating again with the same seed adds games for the same users.
+
+Finished games are inserted with their analysis but without snapshots, so
+the "analyse" admin command has a backlog of snapshots to create.
+"""
+import datetime
+import random
+import sys
+import time
+import unittest
+from rvr.core.fixture import ephemeral_db, game_db, suppressed_email
+from rvr.db.creation import session_scope
+from rvr.db import tables
+from rvr.bench.cloning import GAME_TABLES, read_games, clone_game,  \
+    insert_batch
+from rvr.bench.games import create_users, start_game, play_game,  \
+    random_action
+
+DEFAULT_RUNNING = 0.1
+DEFAULT_SEED = 0
+TEMPLATES = 6  # of each of finished and running
+BATCH_GAMES = 1000
+FINISHED_SPREAD = datetime.timedelta(days=365)
+RUNNING_SPREAD = datetime.timedelta(days=10)
+
+# Everything but snapshots (see above)
+CLONED_TABLES = [cls for cls in GAME_TABLES
+                 if cls is not tables.GameHistorySnapshot]
+
+def _play_templates(count, rng):
+    """
+    Play <count> finished and <count> running games in an ephemeral database.
+    Returns (finished, running, ranges, situations): lists of templates (see
+    rvr.bench.cloning.read_games), all stored ranges, and situationid ->
+    situation description.
+    """
+    finished = []
+    running = []
+    with ephemeral_db() as api:
+        userids = create_users(api, 3, prefix='template')
+        for i in range(count):
+            gameid = start_game(api, userids, 2 + i % 2)
+            play_game(api, gameid, rng)
+            finished.append(gameid)
+        while len(running) < count:
+            gameid = start_game(api, userids, 2 + len(running) % 2)
+            for _ in range(rng.randint(0, 4)):
+                if not random_action(api, gameid, rng):
+                    break
+            if api.get_public_game(gameid).game_details.current_player:
+                running.append(gameid)
+        api.run_pending_analysis()
+        with session_scope() as session:
+            templates = read_games(session, finished + running,
+                                   CLONED_TABLES)
+            ranges = [dict(row.items()) for row in session.execute(
+                tables.StoredRange.__table__.select())]
+            situations = dict(session.query(tables.Situation.situationid,
+                                            tables.Situation.description))
+    return ([templates[gameid] for gameid in finished],
+            [templates[gameid] for gameid in running],
+            ranges, situations)
+
+def _ensure_users(session, count, seed):
+    """
+    Userids of synthetic users 0 to count - 1 for seed, creating any that
+    don't exist.
+    """
+    names = ['synth%d-%d' % (seed, i) for i in range(count)]
+    table = tables.User.__table__
+    existing = set(name for name, in session.query(tables.User.screenname)
+                   .filter(tables.User.screenname.like('synth%d-%%' % seed)))
+    missing = [{'identity': 'synthetic:' + name,
+                'screenname': name,
+                'email': name + '@example.com',
+                'unsubscribed': True}
+               for name in names if name not in existing]
+    if missing:
+        session.execute(table.insert(), missing)
+    by_name = dict(session.query(tables.User.screenname, tables.User.userid)
+                   .filter(tables.User.screenname.like('synth%d-%%' % seed)))
+    return [by_name[name] for name in names]
+
+def _insert_ranges(session, ranges):
+    """
+    Insert into stored_range whichever of <ranges> aren't there already
+    """
+    table = tables.StoredRange.__table__
+    existing = set(rangeid for rangeid, in
+                   session.query(tables.StoredRange.rangeid))
+    missing = [row for row in ranges if row['rangeid'] not in existing]
+    if missing:
+        session.execute(table.insert(), missing)
+
+def _random_users(template, userids, rng):
+    """
+    Map the participants of <template> to random users from <userids>
+    """
+    participants = sorted(template[1][1], key=lambda row: row['order'])
+    return dict(zip([row['userid'] for row in participants],
+                    rng.sample(userids, len(participants))))
+
+def _fraction_of(delta, fraction):
+    """
+    <fraction> of timedelta <delta>
+    """
+    return datetime.timedelta(seconds=fraction * delta.total_seconds())
+
+def _move_open_games(session, first_free):
+    """
+    Renumber the empty open games from after first_free, so that gameids
+    given to new open games don't run into the synthetic games.
+    """
+    table = tables.OpenGame.__table__
+    session.execute(table.update().where(table.c.participants == 0)
+                    .values(gameid=table.c.gameid + first_free))
+    if session.bind.dialect.name == 'postgresql':
+        session.execute("SELECT setval('gameid_seq', "
+                        "(SELECT max(gameid) FROM open_game))")
+
+def generate(users, games, running=DEFAULT_RUNNING, seed=DEFAULT_SEED,
+             templates=TEMPLATES):
+    """
+    Add <games> synthetic games between <users> synthetic users to the
+    database, a fraction <running> of them still running. Returns the new
+    gameids.
+    """
+    if users < 3:
+        raise ValueError("Need at least 3 users")
+    rng = random.Random(seed)
+    # The engine deals with the random module
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        with suppressed_email():
+            finished_templates, running_templates, ranges, situations =  \
+                _play_templates(templates, rng)
+    finally:
+        random.setstate(state)
+    now = datetime.datetime.utcnow()
+    with session_scope() as session:
+        by_description = dict(session.query(tables.Situation.description,
+                                            tables.Situation.situationid))
+        missing = set(situations.values()) - set(by_description)
+        if missing:
+            raise ValueError("Situations not in database (initialise it?): "
+                             "%s" % (", ".join(sorted(missing)),))
+        situationids = {situationid: by_description[description]
+                        for situationid, description in situations.items()}
+        userids = _ensure_users(session, users, seed)
+        _insert_ranges(session, ranges)
+        first_gameid = 1 + max(
+            session.query(tables.RunningGame.gameid).order_by(
+                tables.RunningGame.gameid.desc()).limit(1).scalar() or 0,
+            session.query(tables.OpenGame.gameid).order_by(
+                tables.OpenGame.gameid.desc()).limit(1).scalar() or 0)
+    gameids = range(first_gameid, first_gameid + games)
+    for start in range(0, games, BATCH_GAMES):
+        batch = {}
+        for gameid in gameids[start:start + BATCH_GAMES]:
+            if rng.random() < running:
+                template = rng.choice(running_templates)
+                when = now - _fraction_of(RUNNING_SPREAD, rng.random())
+            else:
+                template = rng.choice(finished_templates)
+                when = now - _fraction_of(FINISHED_SPREAD, rng.random())
+            clone_game(template, gameid, batch,
+                       users=_random_users(template, userids, rng),
+                       situationids=situationids, last_action_time=when)
+        with session_scope() as session:
+            insert_batch(session, batch)
+    with session_scope() as session:
+        _move_open_games(session, first_gameid + games)
+    return gameids
+
+def main():
+    """
+    Generate the data described on the command line
+    """
+    if len(sys.argv) < 3:
+        print __doc__
+        return
+    users = int(sys.argv[1])
+    games = int(sys.argv[2])
+    running = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_RUNNING
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_SEED
+    start = time.time()
+    generate(users, games, running, seed)
+    print "Generated %d games for %d users in %0.1fs." %  \
+        (games, users, time.time() - start)
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    @staticmethod
+    def _generate():
+        """
+        Generate a few games in a new database, and return their rows, except
+        for times
+        """
+        with game_db() as (api, _, _):
+            gameids = generate(4, 10, running=0.5, seed=1, templates=1)
+            with session_scope() as session:
+                templates = read_games(session, gameids, CLONED_TABLES)
+            rows = [sorted(tuple(sorted(
+                        (key, value) for key, value in row.iteritems()
+                        if not isinstance(value, datetime.datetime)))
+                        for gameid in gameids
+                        for row in templates[gameid][i][1])
+                    for i in range(len(CLONED_TABLES))]
+            for gameid in gameids:
+                api.get_public_game(gameid)
+        return gameids, rows
+
+    def test_generate(self):
+        """ Test generate """
+        first = self._generate()
+        second = self._generate()
+        self.assertEqual(first, second)
+        gameids, rows = first
+        self.assertEqual(len(gameids), 10)
+        self.assertEqual(len(rows[0]), 10)  # running_game
+        self.assertTrue(rows[2])  # game_history_base
+
+if __name__ == '__main__':
+    main()
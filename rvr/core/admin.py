@@ -2,14 +2,29 @@
 Admin Cmd class for interacting with API
 """
 from cmd import Cmd
+import datetime
+import logging
+import os
+import sys
 from rvr.core.api import APIError, API
 from rvr.core.dtos import LoginRequest, ChangeScreennameRequest
 from rvr.core import dtos
-from rvr.db.dump import load, dump
+from rvr.db.dump import load, dump, restore
 from sqlalchemy.exc import IntegrityError, OperationalError
 
 #pylint:disable=R0201,R0904,E1103
 
+def _print_progress(tablename, rows_done, rows_total):
+    """
+    Show dump progress, on one line
+    """
+    if rows_total is None:
+        sys.stdout.write("\r%s: %d rows    " % (tablename, rows_done))
+    else:
+        sys.stdout.write("\r%s: %d of %d rows    " %
+                         (tablename, rows_done, rows_total))
+    sys.stdout.flush()
+
 class AdminCmd(Cmd):
     """
     Cmd class to make calls to an API instance
@@ -280,40 +295,146 @@ class AdminCmd(Cmd):
         else:
             print "Analysis run."
             
-    def do_timeout(self, _details):
-        """
-        timeout
-        Fold any players who have timed out.
-        """
-        result = self.api.process_timeouts()
+    def do_timeout(self, details):
+        """
+        timeout [<batch_size> [<parallelism>]]
+        Fold any players who have timed out, finding up to <batch_size>
+        (default: all) at a time, and processing <parallelism> (default: 1) at
+        a time (but only 1 on SQLite).
+        """
+        params = details.split()
+        try:
+            batch_size = int(params[0]) if len(params) > 0 else None
+            parallelism = int(params[1]) if len(params) > 1 else 1
+        except ValueError:
+            print "Bad syntax. See 'help timeout'."
+            return
+        result = self.api.process_timeouts(batch_size, parallelism)
         if isinstance(result, APIError):
             print "Error:", result.description
         else:
-            print result, "timeouts processed."
+            print result
+
+    def do_archive(self, details):
+        """
+        archive [<days> [<batch_size>]]
+        Archive finished games that haven't changed for <days> (default: 30),
+        <batch_size> (default: 1000) at a time.
+        """
+        params = details.split()
+        try:
+            days = int(params[0]) if len(params) > 0 else 30
+            batch_size = int(params[1]) if len(params) > 1 else 1000
+        except ValueError:
+            print "Bad syntax. See 'help archive'."
+            return
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        total = 0
+        while True:
+            result = self.api.archive_games(cutoff, batch_size)
+            if isinstance(result, APIError):
+                print "Error:", result.description
+                break
+            total += result
+            if result < batch_size:
+                break
+        print "Archived %d games." % (total,)
+
+    def do_simulate(self, details):
+        """
+        simulate [<games> [<strategy>]]
+        Play <games> (default: 1000) games in a separate temporary database,
+        with every player using <strategy> (random or strength, default:
+        random), analyse them, and report throughput and latency. See
+        rvr.bench.simulation.
+        """
+        from rvr.bench import simulation
+        params = details.split()
+        try:
+            games = int(params[0]) if len(params) > 0  \
+                else simulation.DEFAULT_GAMES
+        except ValueError:
+            print "Bad syntax. See 'help simulate'."
+            return
+        strategy = params[1] if len(params) > 1  \
+            else simulation.DEFAULT_STRATEGY
+        if games < 1 or strategy not in simulation.STRATEGIES:
+            print "Bad syntax. See 'help simulate'."
+            return
+        level = logging.root.level
+        logging.root.setLevel(logging.WARNING)
+        try:
+            results = simulation.run(games, strategy)
+        finally:
+            logging.root.setLevel(level)
+        print simulation.report(results)
+
+    def do_synthesise(self, details):
+        """
+        synthesise <users> <games> [<running> [<seed>]]
+        Add <games> games between <users> synthetic users to the database,
+        a fraction <running> (default: 0.1) of them still running, generated
+        from <seed> (default: 0). See rvr.bench.synthetic.
+        """
+        from rvr.bench import synthetic
+        params = details.split()
+        try:
+            users = int(params[0])
+            games = int(params[1])
+            running = float(params[2]) if len(params) > 2  \
+                else synthetic.DEFAULT_RUNNING
+            seed = int(params[3]) if len(params) > 3  \
+                else synthetic.DEFAULT_SEED
+        except (IndexError, ValueError):
+            print "Bad syntax. See 'help synthesise'."
+            return
+        level = logging.root.level
+        logging.root.setLevel(logging.WARNING)
+        start = datetime.datetime.utcnow()
+        try:
+            synthetic.generate(users, games, running, seed)
+        except ValueError as err:
+            print "Error:", err
+            return
+        finally:
+            logging.root.setLevel(level)
+        print "Generated %d games for %d users in %s." %  \
+            (games, users, datetime.datetime.utcnow() - start)
 
     def do_dump(self, params):
         """
-        dump { out | in }
+        dump { out | in | restore [<parallelism>] }
         
-        dump out pickles the database to db.pkl
-        dump in unpickles it
+        dump out writes the database to the directory db.dump
+        dump in reads it back in (or, if there is no db.dump, reads db.pkl,
+        dumped by an older version)
+        dump restore reads db.dump into a new database, loading up to
+        <parallelism> (default: 4) tables at a time (but only 1 on SQLite)
         
-        To restore a database from a db.pkl file:
+        To restore a database from a db.dump directory:
         1. delete the database file (rvr.db)
         2. "createdb"
         3. "dump in"
         4. "initialise"
+        5. "analyse"
+        
+        If "dump in" is interrupted, run it again to carry on where it left
+        off. "dump restore" (instead of "dump in") is faster, but if it is
+        interrupted, start again from step 1.
         
         The "initiialise" does things like refreshing open games, because open
-        games are not dumped out by "dump out".
+        games are not dumped out by "dump out". Similarly, "analyse" recreates
+        the history snapshots of finished games.
         """
-        filename = 'db.pkl'
+        dirname = 'db.dump'
         if params == 'out':
-            dump(filename)
-            print "Successfully exported database to %s." % (filename,)
+            dump(dirname, progress=_print_progress)
+            print
+            print "Successfully exported database to %s." % (dirname,)
         elif params == 'in':
+            filename = dirname if os.path.isdir(dirname) else 'db.pkl'
             try:
-                load(filename)
+                load(filename, progress=_print_progress)
             except IntegrityError as err:
                 print "IntegrityError. Is the database empty?"
                 print "Perhaps delete the database and try the 'createdb' command."  # pylint:disable=C0301
@@ -324,7 +445,24 @@ class AdminCmd(Cmd):
                 print "Perhaps try the 'createdb' command."
                 print "Details:", err
                 return
+            print
             print "Successfully read %s into database." % (filename,)
+        elif params.split()[:1] == ['restore']:
+            try:
+                parallelism = int(params.split()[1])  \
+                    if len(params.split()) > 1 else 4
+            except ValueError:
+                print "Bad syntax. See 'help dump'."
+                return
+            try:
+                results = restore(dirname, parallelism)
+            except (ValueError, OperationalError) as err:
+                print "Error:", err
+                return
+            for tablename, rows, seconds in results:
+                print "%s: %d rows in %0.3fs (%0.0f rows/s)" %  \
+                    (tablename, rows, seconds, rows / seconds if seconds else 0)
+            print "Successfully restored %s into database." % (dirname,)
         else:
             print "Bad syntax. See 'help dump'."
 
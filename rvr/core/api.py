@@ -1,12 +1,16 @@
 """
 Core API for Range vs. Range backend.
 """
-from rvr.db.creation import BASE, ENGINE, create_session
+from rvr.db.creation import BASE, ENGINE, create_session, after_commit,  \
+    retry_transient, create_read_session, ensure_writable, count_queries
 from rvr.db import tables
+from rvr.db.history import load_history_items
+from rvr.db.archive import archive_games, unarchive_games
 from rvr.core import dtos
 from functools import wraps
 import logging
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func, and_, inspect
 import traceback
 from rvr.poker.handrange import deal_from_ranges, remove_board_from_range,  \
     ANYTHING, NOTHING
@@ -14,19 +18,67 @@ from rvr.poker.action import range_action_fits, calculate_current_options,  \
     PREFLOP, RIVER, FLOP,  \
     NEXT_ROUND, TOTAL_COMMUNITY_CARDS,\
     act_passive, act_fold, act_aggressive, finish_game, WhatCouldBe
-from rvr.core.dtos import MAP_TABLE_DTO
 from rvr.infrastructure.util import concatenate
-from rvr.poker.cards import deal_cards, Card, RANKS_HIGH_TO_LOW,  \
-    SUITS_HIGH_TO_LOW
-from sqlalchemy.orm.exc import NoResultFound
+from rvr.poker.cards import deal_cards, COMBO_COUNT
+from sqlalchemy.orm.exc import NoResultFound, StaleDataError
+from sqlalchemy.orm import joinedload, subqueryload, aliased
 from rvr.mail.notifications import notify_current_player, notify_first_player, \
-    notify_finished
+    notify_finished, copy_app_context
 from rvr.analysis.analyse import AnalysisReplayer, already_analysed
 from rvr.db.tables import AnalysisFoldEquity, RangeItem
+from rvr.core.cache import GAME_CACHE
+from rvr.core.events import GAME_EVENTS
 import datetime
+import time
+from multiprocessing.pool import ThreadPool
+import cPickle
+import cStringIO
+import random
+import unittest
+import zlib
 
 #pylint:disable=R0903,R0904
 
+# Increment when dtos.RunningGameHistory (or anything it contains) changes, so
+# that existing snapshots are recreated.
+SNAPSHOT_VERSION = 1
+
+# Number of finished games per page of UserDashboard
+FINISHED_GAMES_PAGE = 50
+
+# How long a player has to act before being timed out
+TIMEOUT_PERIOD = datetime.timedelta(days=7)
+
+def _dump_snapshot(history):
+    """
+    Serialise history for a GameHistorySnapshot. Users are stored by userid
+    only, because their screennames can change.
+    """
+    data = cStringIO.StringIO()
+    pickler = cPickle.Pickler(data, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = lambda obj: obj.userid  \
+        if type(obj) is dtos.UserDetails else None
+    pickler.dump(history)
+    return zlib.compress(data.getvalue())
+
+def _load_snapshot(data, screennames):
+    """
+    Deserialise history from a GameHistorySnapshot, with current screennames
+    from <screennames> (userid -> screenname)
+    """
+    users = {}
+    def load_user(userid):
+        """ The same UserDetails for each mention of userid """
+        if userid not in users:
+            users[userid] = dtos.UserDetails(userid, screennames[userid])
+        return users[userid]
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(zlib.decompress(data)))
+    unpickler.persistent_load = load_user
+    return unpickler.load()
+
+# How long after it finishes a game is archived
+ARCHIVE_PERIOD = datetime.timedelta(days=30)
+
 def exception_mapper(fun):
     """
     Converts database exceptions to APIError
@@ -50,13 +102,17 @@ def api(fun):
     """
     Equivalent to:
         @exception_mapper
+        @retry_transient
         @create_session
         
-    Used to ensure exception_mapper and create_session are applied in the
-    correct order.
+    Used to ensure exception_mapper, retry_transient and create_session are
+    applied in the correct order. In particular, a transient database error
+    (e.g. lock contention) retries the whole unit of work, in a new session,
+    and only becomes API.ERR_UNKNOWN if the retries run out.
     """
     @wraps(fun)
     @exception_mapper
+    @retry_transient
     @create_session
     def inner(*args, **kwargs):
         """
@@ -75,6 +131,27 @@ def api(fun):
             raise
     return inner
 
+def api_read(fun):
+    """
+    Equivalent to:
+        @exception_mapper
+        @retry_transient
+        @create_read_session
+        
+    For API functions that only query, so that they don't contend with
+    writers. See rvr.db.creation.read_session_scope.
+    """
+    @wraps(fun)
+    @exception_mapper
+    @retry_transient
+    @create_read_session
+    def inner(*args, **kwargs):
+        """
+        No additional functionality: there's nothing to roll back.
+        """
+        return fun(*args, **kwargs)
+    return inner
+
 class APIError(object):
     """
     These objects will be returned by @exception_mapper
@@ -102,7 +179,7 @@ class API(object):
     ERR_JOIN_GAME_GAME_FULL = APIError("Game is full")
     ERR_DELETE_USER_PLAYING = APIError("User is playing")
     ERR_USER_NOT_IN_GAME = APIError("User is not in the specified game")
-    ERR_DUPLICATE_SITUATION = APIError("Duplicate situation")
+    ERR_GAME_CHANGED = APIError("Game has changed")
     
     def __init__(self):
         self.session = None  # required for @create_session
@@ -117,57 +194,58 @@ class API(object):
     
     def _add_all_situations(self):
         """
-        Add all situations
-        """
-        err = None
-        err = err or self._add_situation(_create_hu())
-        err = err or self._add_situation(_create_three())
-        return err
-    
-    def _add_card_combo(self, higher_card, lower_card):
-        """
-        Add a RangeItem
+        Add all situations that aren't already in the database
         """
-        item = RangeItem()
-        item.higher_card = higher_card.to_mnemonic()
-        item.lower_card = lower_card.to_mnemonic()
-        self.session.add(item)
-        try:
-            self.session.commit()
-            logging.debug("Added range item: %s, %s", item.higher_card,
-                          item.lower_card)
-        except IntegrityError:
-            self.session.rollback()
-            # No error, it's a singleton, it's there, we're happy.
+        self._add_situations([_create_hu(), _create_three()])
     
     def _add_card_combos(self):
         """
-        Populate table of RangeItem
-        """
-        deck1 = [Card(rank, suit)
-                 for rank in RANKS_HIGH_TO_LOW
-                 for suit in SUITS_HIGH_TO_LOW]
-        deck2 = deck1[:]
-        err = None
-        for card1 in deck1:
-            for card2 in deck2:
-                if card1 > card2:
-                    err = err or self._add_card_combo(higher_card=card1,
-                                                      lower_card=card2)
-        return err  
+        Populate table of RangeItem, adding (in bulk) only those combos that
+        aren't already there.
+        """
+        existing = set(comboid for comboid,
+                       in self.session.query(RangeItem.comboid).all())
+        missing = [{'comboid': comboid}
+                   for comboid in range(COMBO_COUNT)
+                   if comboid not in existing]
+        if missing:
+            self.session.execute(RangeItem.__table__.insert(), missing)
+            logging.debug("Added %d range items", len(missing))
     
     @api
     def initialise_db(self):
         """
-        Create initial data for database
+        Create initial data for database, and any indexes added since it was
+        created.
+        
+        This is idempotent, adding only what is missing, in a single
+        transaction.
         """
-        self.session.commit()  # any errors are our own
-                        
-        # Each of these also commits.
-        err = None
-        err = err or self._add_card_combos()
-        err = err or self._add_all_situations()
-        return err
+        self._add_indexes()
+        self._add_card_combos()
+        self._add_all_situations()
+    
+    def _add_indexes(self):
+        """
+        Create any indexes that are missing from existing tables, and
+        recreate any whose columns have changed. (create_db only creates the
+        indexes of tables it creates.)
+        """
+        connection = self.session.connection()
+        inspector = inspect(connection)
+        for table in BASE.metadata.sorted_tables:
+            existing = dict((index['name'], index['column_names'])
+                            for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                columns = [column.name for column in index.columns]
+                if index.name in existing:
+                    if existing[index.name] == columns:
+                        continue
+                    index.drop(connection)
+                    logging.debug("Dropped index %s on %r", index.name,
+                                  existing[index.name])
+                index.create(connection)
+                logging.debug("Created index %s", index.name)
     
     @api
     def login(self, request):
@@ -240,7 +318,7 @@ class API(object):
         except NoResultFound:
             return self.ERR_NO_SUCH_USER
     
-    @api
+    @api_read
     def get_user(self, userid):
         """
         Get user's LoginDetails
@@ -272,7 +350,7 @@ class API(object):
         self.session.delete(user)
         return True
     
-    @api
+    @api_read
     def get_user_by_screenname(self, screenname):
         """
         Return userid, screenname
@@ -285,40 +363,46 @@ class API(object):
         else:
             return None
     
-    def _add_situation(self, dto):
-        """
-        Add a dtos.SituationDetails to the database, as a tables.Situation and
-        associated tables.SituationPlayer objects.
-        """
-        situation = tables.Situation()
-        situation.description = dto.description
-        situation.participants = len(dto.players)
-        situation.is_limit = dto.is_limit
-        situation.big_blind = dto.big_blind
-        situation.board_raw = dto.board_raw
-        situation.current_round = dto.current_round
-        situation.pot_pre = dto.pot_pre
-        situation.increment = dto.increment
-        situation.bet_count = dto.bet_count
-        situation.current_player_num = dto.current_player
-        self.session.add(situation)
-        for order, player in enumerate(dto.players):
-            child = tables.SituationPlayer()
-            child.situation = situation
-            child.order = order
-            child.stack = player.stack
-            child.contributed = player.contributed
-            child.range_raw = player.range_raw
-            child.left_to_act = player.left_to_act
-            self.session.add(child)
-        try:
-            self.session.commit()
+    def _add_situations(self, situation_dtos):
+        """
+        Add dtos.SituationDetails to the database, as tables.Situation and
+        associated tables.SituationPlayer rows, in bulk, skipping any whose
+        description is already in the database.
+        """
+        existing = set(description for (description,) in
+                       self.session.query(tables.Situation.description).all())
+        new = [dto for dto in situation_dtos if dto.description not in existing]
+        if not new:
+            return
+        self.session.execute(tables.Situation.__table__.insert(),
+            [{'description': dto.description,
+              'participants': len(dto.players),
+              'is_limit': dto.is_limit,
+              'big_blind': dto.big_blind,
+              'board_raw': dto.board_raw,
+              'current_round': dto.current_round,
+              'pot_pre': dto.pot_pre,
+              'increment': dto.increment,
+              'bet_count': dto.bet_count,
+              'current_player_num': dto.current_player}
+             for dto in new])
+        situationids = dict(self.session.query(tables.Situation.description,
+                                               tables.Situation.situationid)
+            .filter(tables.Situation.description.in_(
+                [dto.description for dto in new])).all())
+        self.session.execute(tables.SituationPlayer.__table__.insert(),
+            [{'situationid': situationids[dto.description],
+              'order': order,
+              'stack': player.stack,
+              'contributed': player.contributed,
+              'range_raw': player.range_raw,
+              'left_to_act': player.left_to_act}
+             for dto in new
+             for order, player in enumerate(dto.players)])
+        for dto in new:
             logging.debug("Added situation: %s", dto.description)
-        except IntegrityError:
-            self.session.rollback()
-            return self.ERR_DUPLICATE_SITUATION            
     
-    @api
+    @api_read
     def get_open_games(self):
         """
         2. Retrieve open games including registered users
@@ -331,7 +415,7 @@ class API(object):
                    for game in all_open_games]
         return results
     
-    @api
+    @api_read
     def get_running_games(self):
         """
         Retrieve running games including registered users
@@ -344,7 +428,7 @@ class API(object):
                    for game in all_running_games]
         return results
     
-    @api
+    @api_read
     def get_user_running_games(self, userid):
         """
         3. Retrieve user's games and their statuses
@@ -362,6 +446,59 @@ class API(object):
                           for rgp in rgps if rgp.game.current_userid is None]
         return dtos.UsersGameDetails(userid, running_games, finished_games)
     
+    @api_read
+    def get_user_dashboard(self, userid, finished_before=None):
+        """
+        Retrieve everything for user's home page, in a constant number of
+        queries.
+        inputs: userid, optionally finished_before (a gameid)
+        outputs: UserDashboard with all open games, user's running games, and
+        up to FINISHED_GAMES_PAGE of user's finished games with gameid less
+        than finished_before (if specified), most recent first
+        
+        Note: we don't validate that userid is a real userid!
+        """
+        open_games = self.session.query(tables.OpenGame)  \
+            .options(subqueryload(tables.OpenGame.ogps)
+                     .joinedload(tables.OpenGameParticipant.user),
+                     joinedload(tables.OpenGame.situation)
+                     .subqueryload(tables.Situation.players))  \
+            .order_by(tables.OpenGame.gameid).all()
+        users_games = self.session.query(tables.RunningGame)  \
+            .join(tables.RunningGameParticipant,
+                  tables.RunningGameParticipant.gameid ==
+                  tables.RunningGame.gameid)  \
+            .filter(tables.RunningGameParticipant.userid == userid)  \
+            .options(subqueryload(tables.RunningGame.rgps)
+                     .joinedload(tables.RunningGameParticipant.user),
+                     joinedload(tables.RunningGame.situation)
+                     .subqueryload(tables.Situation.players))
+        running_games = users_games  \
+            .filter(tables.RunningGame.current_userid != None)  \
+            .order_by(tables.RunningGame.gameid).all()
+        finished_query = users_games  \
+            .filter(tables.RunningGame.current_userid == None)
+        if finished_before is not None:
+            finished_query = finished_query  \
+                .filter(tables.RunningGame.gameid < finished_before)
+        finished_games = finished_query  \
+            .order_by(tables.RunningGame.gameid.desc())  \
+            .limit(FINISHED_GAMES_PAGE + 1).all()
+        if len(finished_games) > FINISHED_GAMES_PAGE:
+            finished_games = finished_games[:FINISHED_GAMES_PAGE]
+            next_finished_before = finished_games[-1].gameid
+        else:
+            next_finished_before = None
+        return dtos.UserDashboard(
+            userid=userid,
+            open_details=[dtos.OpenGameDetails.from_open_game(game)
+                          for game in open_games],
+            running_details=[dtos.RunningGameSummary.from_running_game(game)
+                             for game in running_games],
+            finished_details=[dtos.RunningGameSummary.from_running_game(game)
+                              for game in finished_games],
+            next_finished_before=next_finished_before)
+
     def _start_game(self, open_game, final_ogp):
         """
         Takes the id of a full OpenGame, creates a new RunningGame from it,
@@ -399,7 +536,11 @@ class API(object):
         situation_players = situation.ordered_players()
         self.session.add(running_game)
         self.session.flush()  # get gameid from database
-        map_to_range = {p: p.range for p in situation.players}
+        # Keyed by order rather than by player, so that players are dealt to
+        # in the same order every time, and the deal depends only on the
+        # state of the random module.
+        map_to_range = {order: s_p.range
+                        for order, s_p in enumerate(situation_players)}
         player_to_dealt = deal_from_ranges(map_to_range, running_game.board)
         for order, (ogp, s_p) in enumerate(zip(all_ogps, situation_players)):
             # create rgps in the order they will act in future rounds
@@ -412,7 +553,7 @@ class API(object):
             rgp.range_raw = s_p.range_raw
             rgp.left_to_act = s_p.left_to_act
             rgp.folded = False
-            rgp.cards_dealt = player_to_dealt[s_p]
+            rgp.cards_dealt = player_to_dealt[order]
             if situation.current_player_num == order:
                 assert running_game.current_userid == ogp.userid
             self.session.add(rgp)
@@ -422,7 +563,8 @@ class API(object):
         # TODO: REVISIT: check that this cascades to ogps
         self.session.delete(open_game)
         self._deal_to_board(running_game)  # also changes ranges
-        notify_first_player(running_game, starter_id=final_ogp.userid)
+        after_commit(self.session, notify_first_player(
+            running_game, starter_id=final_ogp.userid))
         logging.debug("Started game %d", open_game.gameid)
         return running_game
     
@@ -439,6 +581,8 @@ class API(object):
         item.order = base.order
         self.session.add(base)
         self.session.add(item)
+        gameid = game.gameid
+        after_commit(self.session, lambda: GAME_CACHE.invalidate(gameid))
     
     def _record_action_result(self, rgp, action_result):
         """
@@ -714,10 +858,23 @@ class API(object):
             self.apply_action_result(game, rgp, action_result)
         if game.is_finished:
             finish_game(game)
-        notify_current_player(game)  # Notify them *after* action obviously.
+        # Notify them *after* action obviously, and once it's committed.
+        after_commit(self.session, notify_current_player(game))
+        self._publish_game_state(game)
         return action_result
+
+    def _publish_game_state(self, game):
+        """
+        Once committed, tell anything waiting on GAME_EVENTS that game has
+        changed.
+        """
+        gameid = game.gameid
+        next_hh = game.next_hh
+        current_userid = game.current_userid
+        after_commit(self.session,
+                     lambda: GAME_EVENTS.publish(gameid, next_hh,
+                                                 current_userid))
     
-    @api
     def perform_action(self, gameid, userid, range_action):
         """
         Performs range_action for specified user in specified game.
@@ -727,12 +884,45 @@ class API(object):
          - it's not user's turn
          - range_action does not sum to user's current range
          - range_action raise_total isn't appropriate
+         - the game changes (e.g. someone else acts for the same user, or
+           they are timed out) while the action is being performed
+        """
+        # The version of the game as first read, for all attempts. If an
+        # attempt is retried (e.g. because SQLite won't let a transaction
+        # write once another has committed since it started reading), a
+        # change in between is reported just like the version check would.
+        versions_seen = []
+        return self._attempt_action(gameid, userid, range_action,
+                                    versions_seen)
+
+    @api
+    def _attempt_action(self, gameid, userid, range_action, versions_seen):
+        """
+        An attempt at perform_action, counting queries
+        """
+        with count_queries() as queries:
+            result = self._checked_perform_action(gameid, userid, range_action,
+                                                  versions_seen)
+        logging.debug("perform_action for gameid %r, userid %r took %d "
+                      "queries", gameid, userid, queries.count)
+        return result
+
+    def _checked_perform_action(self, gameid, userid, range_action,
+                                versions_seen):
+        """
+        perform_action, except for counting queries
         """
         games = self.session.query(tables.RunningGame)  \
             .filter(tables.RunningGame.gameid == gameid).all()
         if not games:
             return self.ERR_NO_SUCH_RUNNING_GAME
         game = games[0]
+        if versions_seen and versions_seen[0] != game.version:
+            logging.debug("perform_action failing for gameid %r, userid %r, "
+                          "because the game changed before a retry", gameid,
+                          userid)
+            return self.ERR_GAME_CHANGED
+        versions_seen.append(game.version)
         
         # check that they're in the game and it's their turn        
         if game.current_userid == userid:
@@ -748,23 +938,29 @@ class API(object):
                           + "userid %r, range_action %r",
                           _err, gameid, userid, range_action)
             return API.ERR_INVALID_RANGES
-        result = self._perform_action(game, rgp, range_action, current_options)
+        try:
+            result = self._perform_action(game, rgp, range_action,
+                                          current_options)
+            self.session.flush()
+        except StaleDataError:
+            # someone else (e.g. a timeout) has changed the game since we read
+            # it, so none of this applies (and nothing has been sent, because
+            # notifications wait for the commit)
+            logging.debug("perform_action failing for gameid %r, userid %r, "
+                          "because the game has changed", gameid, userid)
+            return self.ERR_GAME_CHANGED
         return result
         
-    def _get_history_items(self, game, userid=None):
+    def _get_history_items(self, game, userid=None, since=None):
         """
         Returns a list of game history items (tables.GameHistoryBase with
         additional details from child tables), with private data only for
-        <userid>, if specified.
-        """
-        # pylint:disable=W0142
-        child_items = [self.session.query(table)
-                       .filter(table.gameid == game.gameid).all()
-                       for table in MAP_TABLE_DTO.keys()]
-        all_child_items = sorted(concatenate(child_items),
-                                 key=lambda c: c.order)
+        <userid>, if specified. If <since> is specified, returns only items
+        with order >= since.
+        """
         child_dtos = [dtos.GameItem.from_game_history_child(child)
-                      for child in all_child_items]
+                      for child in load_history_items(self.session,
+                                                      game.gameid, since)]
         return [dto for dto in child_dtos
                 if game.is_finished or dto.should_include_for(userid)]
 
@@ -773,6 +969,8 @@ class API(object):
         Returns an ordered list of analysis items form the game.
         """
         afes = self.session.query(AnalysisFoldEquity)  \
+            .options(joinedload(AnalysisFoldEquity.action_result)
+                     .joinedload(tables.GameHistoryActionResult.user))  \
             .filter(AnalysisFoldEquity.gameid == game.gameid).all()
         return {afe.order: dtos.AnalysisItemFoldEquity.from_afe(afe)
                 for afe in afes}
@@ -783,12 +981,78 @@ class API(object):
         the specified user. If the game is finished, return all private data.
         Analysis items are considered private data, because they include both
         players' ranges.
-        """
-        if userid is not None:
-            users = self.session.query(tables.User)  \
-                .filter(tables.User.userid == userid).all()
-            if not users:
+        
+        Results are cached by game version, so a repeated view of an unchanged
+        game costs only the version check.
+        """
+        snapshot = tables.GameHistorySnapshot
+        rgp = tables.RunningGameParticipant
+        rows = self.session.query(tables.RunningGame.next_hh,
+                                  snapshot.version,
+                                  snapshot.next_hh,
+                                  tables.ArchivedGame.gameid,
+                                  tables.User.userid,
+                                  tables.User.screenname)  \
+            .outerjoin(snapshot,
+                       snapshot.gameid == tables.RunningGame.gameid)  \
+            .outerjoin(tables.ArchivedGame,
+                       tables.ArchivedGame.gameid ==
+                       tables.RunningGame.gameid)  \
+            .join(rgp, rgp.gameid == tables.RunningGame.gameid)  \
+            .join(tables.User, tables.User.userid == rgp.userid)  \
+            .filter(tables.RunningGame.gameid == gameid).all()
+        if not rows:
+            if userid is not None and not self._user_exists(userid):
                 return self.ERR_NO_SUCH_USER
+            return self.ERR_NO_SUCH_RUNNING_GAME
+        next_hh, snapshot_version, snapshot_next_hh, archived = rows[0][:4]
+        # Analysis doesn't change next_hh, but it is recorded along with a
+        # snapshot, and the history includes participants' screennames, so
+        # all of these are part of the version. (They may have been changed
+        # by another process, e.g. the admin console, so we can't rely on
+        # invalidation.)
+        version = (next_hh, snapshot_version, snapshot_next_hh,
+                   tuple(sorted((row.userid, row.screenname) for row in rows)))
+        result = GAME_CACHE.get(gameid, version, userid)
+        if result is not None:
+            return result
+        if userid is not None and not self._user_exists(userid):
+            return self.ERR_NO_SUCH_USER
+        if snapshot_version == SNAPSHOT_VERSION and  \
+                snapshot_next_hh == next_hh:
+            data = self.session.query(snapshot.data)  \
+                .filter(snapshot.gameid == gameid).scalar()
+            result = _load_snapshot(data, {row.userid: row.screenname
+                                           for row in rows})
+        else:
+            if archived is not None:
+                # Snapshot is out of date (e.g. SNAPSHOT_VERSION has changed
+                # and analysis hasn't been run since), so we need the rows.
+                ensure_writable(self.session)
+                unarchive_games(self.session, [gameid])
+            result = self._build_game(gameid, userid)
+        if isinstance(result, APIError):
+            return result
+        if self.session.info.get('read_only'):
+            GAME_CACHE.put(gameid, version, userid, result)
+        else:
+            # We might be seeing changes that aren't committed yet (e.g. in a
+            # unit of work, after an action), so cache only once they are.
+            after_commit(self.session,
+                lambda: GAME_CACHE.put(gameid, version, userid, result))
+        return result
+
+    def _user_exists(self, userid):
+        """
+        True if there is a user with id <userid>
+        """
+        return self.session.query(tables.User)  \
+            .filter(tables.User.userid == userid).count() > 0
+
+    def _build_game(self, gameid, userid=None):
+        """
+        Build the RunningGameHistory returned by _get_game, from scratch.
+        """
         games = self.session.query(tables.RunningGame)  \
             .filter(tables.RunningGame.gameid == gameid).all()
         #    .filter(tables.RunningGame.current_userid != None)
@@ -807,7 +1071,7 @@ class API(object):
                                        analysis_items=analysis_items,
                                        current_options=current_options)
 
-    @api
+    @api_read
     def get_public_game(self, gameid):
         """
         7. Retrieve game history without current player's ranges
@@ -816,7 +1080,7 @@ class API(object):
         """
         return self._get_game(gameid)
     
-    @api
+    @api_read
     def get_private_game(self, gameid, userid):
         """
         8. Retrieve game history with current player's ranges
@@ -825,42 +1089,111 @@ class API(object):
         """
         return self._get_game(gameid, userid)
     
+    @api_read
+    def get_game_update(self, gameid, next_hh, userid=None):
+        """
+        Retrieve only what has happened in a game since a client last saw it.
+        inputs: gameid, next_hh as of the client's last view, optional userid
+        outputs: GameHistoryUpdate, with history items of order >= next_hh,
+        populated with ranges for userid only, or all ranges iff finished
+        
+        If nothing has changed, this costs only the version check.
+        """
+        games = self.session.query(tables.RunningGame)  \
+            .filter(tables.RunningGame.gameid == gameid).all()
+        if not games:
+            return self.ERR_NO_SUCH_RUNNING_GAME
+        game = games[0]
+        if game.next_hh <= next_hh:
+            history_items = []
+        elif game.is_finished:
+            # The game may be archived, so go via the snapshot.
+            result = self._get_game(gameid)
+            if isinstance(result, APIError):
+                return result
+            history_items = [item for item in result.history
+                             if item.order >= next_hh]
+        else:
+            if userid is not None and not self._user_exists(userid):
+                return self.ERR_NO_SUCH_USER
+            history_items = self._get_history_items(game, userid, next_hh)
+        return dtos.GameHistoryUpdate(gameid=gameid,
+                                      next_hh=game.next_hh,
+                                      current_userid=game.current_userid,
+                                      history_items=history_items)
+
     @api
     def ensure_open_games(self):
         """
         Ensure there is exactly one empty open game for each situation in the
         database.
-        """
-        for situation in self.session.query(tables.Situation).all():
-            empty_open = self.session.query(tables.OpenGame)  \
-                .filter(tables.OpenGame.situationid ==
-                        situation.situationid)  \
-                .filter(tables.OpenGame.participants == 0).all()
-            if len(empty_open) > 1:
-                # delete all except one
-                for game in empty_open[:-1]:
-                    logging.debug("Deleted open game %d for situation %d",
-                                  game.gameid, situation.situationid)
-                    self.session.delete(game)
-            elif len(empty_open) == 0:
-                # add one!
-                new_game = tables.OpenGame()
-                new_game.situationid = situation.situationid
-                new_game.participants = 0
-                self.session.add(new_game)
-                self.session.flush()  # get gameid
-                logging.debug("Created open game %d for situation %d",
-                              new_game.gameid, situation.situationid)
+        
+        This is set-based: one grouped query to count empty open games for
+        every situation, then at most one delete and one (bulk) insert.
+        """
+        empty_open = self.session.query(
+                tables.Situation.situationid,
+                func.count(tables.OpenGame.gameid),
+                func.max(tables.OpenGame.gameid))  \
+            .outerjoin(tables.OpenGame,
+                       and_(tables.OpenGame.situationid ==
+                            tables.Situation.situationid,
+                            tables.OpenGame.participants == 0))  \
+            .group_by(tables.Situation.situationid).all()
+        missing = [situationid for situationid, count, _ in empty_open
+                   if count == 0]
+        excess = {situationid: keep for situationid, count, keep in empty_open
+                  if count > 1}
+        if excess:
+            # delete all except one
+            deleted = self.session.query(tables.OpenGame)  \
+                .filter(tables.OpenGame.participants == 0)  \
+                .filter(tables.OpenGame.situationid.in_(excess.keys()))  \
+                .filter(~tables.OpenGame.gameid.in_(excess.values()))  \
+                .delete(synchronize_session=False)
+            logging.debug("Deleted %d open games for situations %r",
+                          deleted, excess.keys())
+        if missing:
+            # add one!
+            self.session.execute(tables.OpenGame.__table__.insert(),
+                                 [{'situationid': situationid,
+                                   'participants': 0}
+                                  for situationid in missing])
+            logging.debug("Created open games for situations %r", missing)
                 
+    def _record_snapshot(self, game):
+        """
+        Serialise the history of finished game <game>, so that it can be loaded
+        quickly in future.
+        """
+        history = self._build_game(game.gameid)
+        snapshot = tables.GameHistorySnapshot()
+        snapshot.gameid = game.gameid
+        snapshot.next_hh = game.next_hh
+        snapshot.version = SNAPSHOT_VERSION
+        snapshot.data = _dump_snapshot(history)
+        self.session.merge(snapshot)
+        logging.debug("gameid %d, recorded snapshot", game.gameid)
+
     def _run_pending_analysis(self):
         """
         Look through all games for analysis that has not yet been done, and do
         it, and record the analysis in the database.
         
+        Finished games are then snapshotted, and not looked at again unless
+        their snapshot is deleted or out of date.
+        
         If you need to RE-analyse the database, delete existing analysis first. 
         """
+        snapshot = tables.GameHistorySnapshot
         games = self.session.query(tables.RunningGame)  \
-            .filter(tables.RunningGame.current_userid == None).all()
+            .outerjoin(snapshot,
+                       snapshot.gameid == tables.RunningGame.gameid)  \
+            .filter(tables.RunningGame.current_userid == None)  \
+            .filter((snapshot.gameid == None) |
+                    (snapshot.version != SNAPSHOT_VERSION)).all()
+        # Archived games need their rows back to be (re)snapshotted.
+        unarchive_games(self.session, [game.gameid for game in games])
         for game in games:
             if not already_analysed(self.session, game):
                 replayer = AnalysisReplayer(self.session, game)
@@ -868,7 +1201,11 @@ class API(object):
                 if already_analysed(self.session, game):
                     # Don't tell them if there's no analysis!
                     logging.debug("gameid %d, notifying", game.gameid)
-                    notify_finished(game)
+                    after_commit(self.session, notify_finished(game))
+            self._record_snapshot(game)
+            after_commit(self.session,
+                         lambda gameid=game.gameid:
+                             GAME_CACHE.invalidate(gameid))
 
     @api
     def run_pending_analysis(self):
@@ -882,11 +1219,47 @@ class API(object):
         """
         Delete all analysis, and reanalyse all games.
         """
+        archived = self.session.query(tables.ArchivedGame.gameid).all()
+        unarchive_games(self.session, [gameid for (gameid,) in archived])
         self.session.query(tables.AnalysisFoldEquityItem).delete()
         self.session.query(tables.AnalysisFoldEquity).delete()
+        self.session.query(tables.GameHistorySnapshot).delete()
+        after_commit(self.session, GAME_CACHE.clear)
         self.session.commit()
         return self._run_pending_analysis()
 
+    @api
+    def archive_games(self, cutoff=None, batch_size=1000):
+        """
+        Archive (up to batch_size) finished games that haven't changed since
+        cutoff (default: ARCHIVE_PERIOD ago), and whose analysis and snapshot
+        are up to date. See rvr.db.archive.
+        
+        Their history is still available as normal, from their snapshots.
+        
+        Returns the number of games archived.
+        """
+        if cutoff is None:
+            cutoff = datetime.datetime.utcnow() - ARCHIVE_PERIOD
+        game = tables.RunningGame
+        snapshot = tables.GameHistorySnapshot
+        archived = tables.ArchivedGame
+        query = self.session.query(game.gameid)  \
+            .join(snapshot, snapshot.gameid == game.gameid)  \
+            .outerjoin(archived, archived.gameid == game.gameid)  \
+            .filter(game.current_userid == None)  \
+            .filter(game.last_action_time < cutoff)  \
+            .filter(snapshot.version == SNAPSHOT_VERSION)  \
+            .filter(snapshot.next_hh == game.next_hh)  \
+            .filter(archived.gameid == None)  \
+            .order_by(game.gameid)
+        if batch_size is not None:
+            query = query.limit(batch_size)
+        gameids = [gameid for (gameid,) in query.all()]
+        archive_games(self.session, gameids)
+        logging.debug("archived %d games", len(gameids))
+        return len(gameids)
+
     def _timeout(self, game):
         """
         Timeout the current player by folding their current range.
@@ -898,25 +1271,115 @@ class API(object):
         logging.debug("gameid %d, userid %d being timed out", game.gameid,
                       rgp.userid)
         self._record_timeoout(rgp)
+        # this also publishes the new game state to GAME_EVENTS
         self._perform_action(game, rgp, range_action, current_options)
 
+    @api_read
+    def find_timeouts(self, cutoff, after_gameid, batch_size):
+        """
+        Return (up to batch_size, if not None) ids of running games with
+        gameid > after_gameid where the current player hasn't acted since
+        cutoff, in gameid order.
+        
+        The games are found with a subquery, so that it's answered from
+        ix_running_game_timeout. (Otherwise SQLite, unless it has been
+        ANALYZEd, scans all of running_game in gameid order, to avoid sorting.)
+        """
+        expired = aliased(tables.RunningGame)
+        timed_out = self.session.query(expired.gameid)  \
+            .filter(expired.last_action_time < cutoff)  \
+            .filter(expired.current_userid != None)
+        query = self.session.query(tables.RunningGame.gameid)  \
+            .filter(tables.RunningGame.gameid.in_(timed_out.subquery()))  \
+            .filter(tables.RunningGame.gameid > after_gameid)  \
+            .order_by(tables.RunningGame.gameid)
+        if batch_size is not None:
+            query = query.limit(batch_size)
+        return [gameid for (gameid,) in query.all()]
+
     @api
-    def process_timeouts(self):
+    def timeout_game(self, gameid, cutoff):
         """
-        Fold players' hands where those players have not acted for the
-        standard timeout time period.
+        Fold the current player's hand in game <gameid> if they have not acted
+        since cutoff. Returns True if they were timed out, False if not (e.g.
+        because they have acted in the meantime).
         """
-        count = 0
         games = self.session.query(tables.RunningGame)  \
-            .filter(tables.RunningGame.current_userid != None).all()
-        for game in games:
-            if game.last_action_time + datetime.timedelta(days=7) <  \
-                    datetime.datetime.utcnow():
-                # This doesn't cause a race condition because we have isolation
-                # level set to SERIALIZABLE
-                self._timeout(game)
-                count += 1
-        return count
+            .filter(tables.RunningGame.gameid == gameid)  \
+            .filter(tables.RunningGame.current_userid != None)  \
+            .filter(tables.RunningGame.last_action_time < cutoff).all()
+        if not games:
+            return False
+        try:
+            self._timeout(games[0])
+            self.session.flush()
+        except StaleDataError:
+            # the player has acted since we read the game
+            self.session.rollback()
+            return False
+        return True
+
+    @api
+    def process_timeouts(self, batch_size=None, parallelism=1):
+        """
+        Fold players' hands where those players have not acted for the
+        standard timeout time period.
+        
+        Expired games are found batch_size (default: all) at a time, and each
+        is timed out in its own transaction, by parallelism threads at a time,
+        so that one failure doesn't affect the others.
+        
+        SQLite only lets one transaction write at a time, so there, threads
+        would only wait for each other's locks (and retry when they time out),
+        and parallelism is always 1.
+        
+        Returns a TimeoutReport.
+        """
+        start = time.time()
+        cutoff = datetime.datetime.utcnow() - TIMEOUT_PERIOD
+        report = dtos.TimeoutReport()
+        if self.session.bind.dialect.name == 'sqlite':
+            parallelism = 1
+        pool = ThreadPool(parallelism) if parallelism > 1 else None
+        after_gameid = -1
+        try:
+            while True:
+                scan_start = time.time()
+                gameids = self.find_timeouts(cutoff, after_gameid, batch_size)
+                report.scan_seconds += time.time() - scan_start
+                if isinstance(gameids, APIError):
+                    return gameids
+                if not gameids:
+                    break
+                report.batches += 1
+                report.found += len(gameids)
+                after_gameid = gameids[-1]
+                process_start = time.time()
+                # a new API per game, because an API's session is not shareable
+                process = copy_app_context(
+                    lambda gameid: API().timeout_game(gameid, cutoff))
+                if pool is None:
+                    results = [process(gameid) for gameid in gameids]
+                else:
+                    results = pool.map(process, gameids)
+                report.process_seconds += time.time() - process_start
+                for gameid, result in zip(gameids, results):
+                    if isinstance(result, APIError):
+                        logging.info("gameid %d, timeout failed: %s", gameid,
+                                     result)
+                        report.failed += 1
+                    elif result:
+                        report.timed_out += 1
+                    else:
+                        report.skipped += 1
+                if batch_size is None or len(gameids) < batch_size:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+        report.total_seconds = time.time() - start
+        logging.debug("%s", report)
+        return report
 
 def _create_hu():
     """
@@ -977,3 +1440,253 @@ def _create_three():
         increment=2,
         bet_count=0)
     return three_situation
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904,W0212
+    def test_game_cache_version(self):
+        """
+        Test that _get_game sees changes made by another process, which
+        don't invalidate this process's GAME_CACHE
+        """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import SESSION
+        random.seed(0)
+        with game_db(users=2, games=2, played=1) as  \
+                (api_, userids, (gameid, running)):
+            self.assertEqual(api_.get_public_game(gameid).analysis, {})
+            api_.get_public_game(running)
+            stale = dict(GAME_CACHE._entries)
+            api_.run_pending_analysis()
+            GAME_CACHE._entries.update(stale)
+            session = SESSION()
+            try:
+                analysed = session.query(AnalysisFoldEquity)  \
+                    .filter(AnalysisFoldEquity.gameid == gameid).count()
+                session.query(tables.User)  \
+                    .filter(tables.User.userid == userids[0])  \
+                    .update({'screenname': 'renamed'})
+                session.commit()
+            finally:
+                session.close()
+            self.assertGreater(analysed, 0)
+            self.assertEqual(len(api_.get_public_game(gameid).analysis),
+                             analysed)
+            for gameid_ in [running, gameid]:
+                game = api_.get_public_game(gameid_)
+                self.assertIn('renamed', [rgp.user.screenname for rgp
+                                          in game.game_details.rgp_details])
+            # The snapshot is used, and mentions only the new screenname
+            api_.archive_games(cutoff=datetime.datetime.utcnow() +
+                               datetime.timedelta(days=1))
+            GAME_CACHE.clear()
+            game = api_.get_public_game(gameid)
+            self.assertTrue(game.is_finished())
+            self.assertNotIn('bench0', [item.user.screenname
+                                          for item in game.history
+                                          if hasattr(item, 'user')])
+            self.assertIn('renamed', [item.user.screenname
+                                      for item in game.history
+                                      if hasattr(item, 'user')])
+
+    def test_notify_after_commit(self):
+        """
+        Test that a retried action sends its notification only once, when it
+        is committed
+        """
+        from rvr.core.fixture import game_db
+        from rvr.bench.games import random_action
+        from rvr.mail import notifications
+        from sqlalchemy.exc import OperationalError
+        import sqlite3
+        class FlakyAPI(API):
+            """ API whose first attempt at publishing game state fails """
+            def __init__(self):
+                super(FlakyAPI, self).__init__()
+                self.attempts = 0
+            def _publish_game_state(self, game):
+                self.attempts += 1
+                if self.attempts == 1:
+                    raise OperationalError("UPDATE ...", {},
+                        sqlite3.OperationalError("database is locked"))
+                super(FlakyAPI, self)._publish_game_state(game)
+        sent = []
+        your_turn = notifications._your_turn
+        notifications._your_turn = lambda **kwargs: sent.append(kwargs)
+        try:
+            with game_db(users=2, games=1) as (_, _, (gameid,)):
+                flaky = FlakyAPI()
+                self.assertTrue(random_action(flaky, gameid, random.Random(0)))
+        finally:
+            notifications._your_turn = your_turn
+        self.assertEqual(flaky.attempts, 2)
+        self.assertEqual([kwargs['gameid'] for kwargs in sent], [gameid])
+
+    def test_concurrent_actions(self):
+        """
+        Test that when two actions in the same game overlap, the one that
+        commits second fails with ERR_GAME_CHANGED
+        """
+        from rvr.core.fixture import game_db
+        import threading
+        class PausingAPI(API):
+            """ API that waits after reading the game, before acting """
+            def __init__(self):
+                super(PausingAPI, self).__init__()
+                self.reached = threading.Event()
+                self.proceed = threading.Event()
+                self.results = []
+            def _perform_action(self, *args):
+                self.reached.set()
+                self.proceed.wait(10)
+                return super(PausingAPI, self)._perform_action(*args)
+            def act(self, *args):
+                """ perform_action, recording the result """
+                self.results.append(self.perform_action(*args))
+                self.reached.set()
+        with game_db(users=2, games=1) as (api_, _, (gameid,)):
+            game = api_.get_public_game(gameid).game_details
+            action = dtos.ActionDetails(fold_raw=NOTHING,
+                passive_raw=game.current_player.range_raw,
+                aggressive_raw=NOTHING, raise_total=0)
+            args = (gameid, game.current_player.user.userid, action)
+            first = PausingAPI()
+            thread = threading.Thread(target=first.act, args=args)
+            thread.start()
+            try:
+                self.assertTrue(first.reached.wait(10))
+                second = api_.perform_action(*args)
+            finally:
+                first.proceed.set()
+                thread.join()
+        self.assertIsInstance(second, dtos.ActionResult)
+        self.assertEqual(first.results, [API.ERR_GAME_CHANGED])
+
+    def test_retry(self):
+        """
+        Test that perform_action is retried after transient errors, up to a
+        point, and not after others
+        """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import SESSION, RETRY_STATS, RETRY_ATTEMPTS
+        from sqlalchemy import event
+        from sqlalchemy.exc import OperationalError
+        import sqlite3
+        failures = []
+        def fail_commit(_session):
+            """ Fail to commit, while there are failures left """
+            if failures:
+                raise OperationalError("COMMIT", {},
+                    sqlite3.OperationalError(failures.pop()))
+        with game_db(users=2, games=1) as (api_, userids, (gameid,)):
+            def act(message, count):
+                """
+                Check with the current player's whole range, failing to
+                commit count times with message. Returns the result, and the
+                userid of the player to act afterwards.
+                """
+                player = api_.get_public_game(gameid)  \
+                    .game_details.current_player
+                failures[:] = [message] * count
+                RETRY_STATS.reset()
+                result = api_.perform_action(gameid, player.user.userid,
+                    dtos.ActionDetails(fold_raw=NOTHING,
+                                       passive_raw=player.range_raw,
+                                       aggressive_raw=NOTHING, raise_total=0))
+                self.assertEqual(failures, [])
+                current = api_.get_public_game(gameid)  \
+                    .game_details.current_player.user.userid
+                return result, current
+            first = api_.get_public_game(gameid)  \
+                .game_details.current_player.user.userid
+            second = userids[1 - userids.index(first)]
+            event.listen(SESSION, "before_commit", fail_commit)
+            try:
+                result, current = act("database is locked", RETRY_ATTEMPTS)
+                self.assertEqual(result, API.ERR_UNKNOWN)
+                self.assertEqual(current, first)
+                self.assertEqual(RETRY_STATS.give_ups, 1)
+                result, current = act("no such table: foo", 1)
+                self.assertEqual(result, API.ERR_UNKNOWN)
+                self.assertEqual(current, first)
+                self.assertEqual(RETRY_STATS.retries, 0)
+                result, current = act("database is locked", 2)
+                self.assertIsInstance(result, dtos.ActionResult)
+                self.assertEqual(current, second)
+                self.assertEqual(RETRY_STATS.retries, 2)
+                self.assertEqual(RETRY_STATS.give_ups, 0)
+            finally:
+                event.remove(SESSION, "before_commit", fail_commit)
+
+    def test_read_only(self):
+        """
+        Test that query-only API functions use read-only sessions, and fall
+        back to writing when they have to
+        """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import SESSION, session_scope
+        from sqlalchemy import event
+        read_only = []
+        def record(session, _transaction, _connection):
+            """ Record whether each transaction is read-only """
+            read_only.append(session.info.get('read_only', False))
+        with game_db(users=2, games=1, played=1) as  \
+                (api_, userids, (gameid,)):
+            api_.run_pending_analysis()
+            api_.archive_games(cutoff=datetime.datetime.utcnow() +
+                               datetime.timedelta(days=1))
+            # An out of date snapshot has to be recreated from archived rows
+            with session_scope() as session:
+                session.query(tables.GameHistorySnapshot)  \
+                    .update({'version': 0})
+            GAME_CACHE.clear()
+            event.listen(SESSION, "after_begin", record)
+            try:
+                self.assertEqual(api_.get_user(userids[0]).userid,
+                                 userids[0])
+                self.assertEqual(read_only, [True])
+                del read_only[:]
+                self.assertTrue(api_.get_public_game(gameid).is_finished())
+                self.assertEqual(read_only, [True, False])
+            finally:
+                event.remove(SESSION, "after_begin", record)
+            with session_scope() as session:
+                self.assertEqual(session.query(tables.ArchivedGame).count(),
+                                 0)
+
+    def test_timeouts(self):
+        """
+        Test that initialise_db brings the index process_timeouts needs up to
+        date in an existing database, and that process_timeouts times out old
+        games
+        """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import session_scope
+        with game_db(users=2, games=1) as (api_, _, (gameid,)):
+            with session_scope() as session:
+                session.execute("DROP INDEX ix_running_game_timeout")
+                session.execute("CREATE INDEX ix_running_game_timeout "
+                    "ON running_game (current_userid, last_action_time)")
+                session.query(tables.RunningGame)  \
+                    .filter(tables.RunningGame.gameid == gameid)  \
+                    .update({'last_action_time': datetime.datetime.utcnow() -
+                             TIMEOUT_PERIOD - datetime.timedelta(hours=1)})
+            self.assertIsNone(api_.initialise_db())
+            with session_scope() as session:
+                indexes = dict((index['name'], index['column_names'])
+                               for index in inspect(session.connection())
+                               .get_indexes('running_game'))
+                self.assertEqual(indexes['ix_running_game_timeout'],
+                                 ['last_action_time'])
+                self.assertIn("WHERE current_userid IS NOT NULL",
+                              session.execute("SELECT sql FROM sqlite_master "
+                                  "WHERE name = 'ix_running_game_timeout'")
+                              .scalar())
+            report = api_.process_timeouts(parallelism=4)
+            self.assertIsInstance(report, dtos.TimeoutReport)
+            self.assertEqual((report.found, report.timed_out), (1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+In-process caches for expensive-to-build, read-mostly core objects.
+"""
+from collections import OrderedDict
+import threading
+import unittest
+
+#pylint:disable=R0903
+
+class GameCache(object):
+    """
+    Holds dtos.RunningGameHistory objects, keyed by (gameid, version, viewer).
+
+    The version is whatever the caller reads from the database to tell
+    whether a game's history has changed (see API._get_game), so a cached
+    history is valid for exactly as long as its version is unchanged, and
+    checking that requires only a small query. Because the version comes from
+    the database, changes made by other processes are seen too; invalidate()
+    only frees the memory sooner.
+
+    Cached objects are shared between callers, so treat them as read-only.
+
+    Least recently used entries are discarded once there are more than
+    max_entries.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, gameid, version, viewer):
+        """
+        Return cached game history, or None if there isn't one.
+        """
+        key = (gameid, version, viewer)
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries[key] = value  # now most recently used
+            self.hits += 1
+            return value
+
+    def put(self, gameid, version, viewer, value):
+        """
+        Cache game history
+        """
+        key = (gameid, version, viewer)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, gameid):
+        """
+        Forget everything cached for game <gameid>
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == gameid]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Forget everything
+        """
+        with self._lock:
+            self._entries.clear()
+
+GAME_CACHE = GameCache()
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_get_put(self):
+        """ Test GameCache.get and GameCache.put """
+        cache = GameCache()
+        self.assertIsNone(cache.get(1, 0, None))
+        cache.put(1, 0, None, "public")
+        cache.put(1, 0, 7, "private")
+        self.assertEqual(cache.get(1, 0, None), "public")
+        self.assertEqual(cache.get(1, 0, 7), "private")
+        self.assertIsNone(cache.get(1, 1, None))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_invalidate(self):
+        """ Test GameCache.invalidate """
+        cache = GameCache()
+        cache.put(1, 0, None, "one")
+        cache.put(2, 0, None, "two")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1, 0, None))
+        self.assertEqual(cache.get(2, 0, None), "two")
+
+    def test_max_entries(self):
+        """ Test that the least recently used entry is discarded """
+        cache = GameCache(max_entries=2)
+        cache.put(1, 0, None, "one")
+        cache.put(2, 0, None, "two")
+        cache.get(1, 0, None)
+        cache.put(3, 0, None, "three")
+        self.assertEqual(cache.get(1, 0, None), "one")
+        self.assertIsNone(cache.get(2, 0, None))
+        self.assertEqual(cache.get(3, 0, None), "three")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,7 +12,8 @@ Data transfer objects:
 from rvr.db import tables
 from argparse import ArgumentError
 from rvr.poker.handrange import HandRange
-from rvr.poker.cards import FLOP, TURN, RIVER, PREFLOP, Card
+from rvr.poker.cards import FLOP, TURN, RIVER, PREFLOP, combo_cards
+from rvr.db.packing import unpack_fold_equity_items
 
 #pylint:disable=R0903,R0913,R0902
 
@@ -239,10 +240,10 @@ class RunningGameSummary(object):
         rgps = sorted(running_game.rgps, key=lambda r:r.order)
         users = [UserDetails.from_user(r.user) for r in rgps]
         situation = SituationDetails.from_situation(running_game.situation)
-        if running_game.current_userid is not None:
-            user_details = UserDetails.from_user(running_game.current_rgp.user)
-        else:
-            user_details = None
+        # from rgps rather than current_rgp, which would be another query
+        current = [user for user in users
+                   if user.userid == running_game.current_userid]
+        user_details = current[0] if current else None
         return cls(running_game.gameid, users, situation, user_details)
 
 class RunningGameParticipantDetails(object):
@@ -279,7 +280,8 @@ class RunningGameDetails(object):
     details of a game, including game state (more than RunningGameSummary)
     """
     def __init__(self, gameid, situation, current_player, board_raw,
-                 current_round, pot_pre, increment, bet_count, rgp_details):
+                 current_round, pot_pre, increment, bet_count, rgp_details,
+                 next_hh):
         self.gameid = gameid
         self.situation = situation  # SituationDetails
         self.current_player = current_player # RGPDetails
@@ -289,14 +291,16 @@ class RunningGameDetails(object):
         self.increment = increment
         self.bet_count = bet_count
         self.rgp_details = rgp_details  # RunningGameParticipantDetails
+        self.next_hh = next_hh  # order of the next hand history item
     
     def __repr__(self):
         return ("RunningGameDetails(gameid=%r, situation=%r, " +
                 "current_player=%r, board_raw=%r, current_round=%r, " +  \
-                "pot_pre=%r, increment=%r, bet_count=%r, rgp_details=%r") %  \
+                "pot_pre=%r, increment=%r, bet_count=%r, rgp_details=%r, " +  \
+                "next_hh=%r)") %  \
             (self.gameid, self.situation, self.current_player, self.board_raw,
              self.current_round, self.pot_pre, self.increment, self.bet_count,
-             self.rgp_details)
+             self.rgp_details, self.next_hh)
     
     @classmethod
     def from_running_game(cls, game):
@@ -311,7 +315,7 @@ class RunningGameDetails(object):
         current_player = current_players[0] if current_players else None
         return cls(game.gameid, situation, current_player, game.board_raw,
                    game.current_round, game.pot_pre, game.increment,
-                   game.bet_count, rgp_details)
+                   game.bet_count, rgp_details, game.next_hh)
         
     def is_finished(self):
         """
@@ -319,6 +323,40 @@ class RunningGameDetails(object):
         """
         return self.current_player is None
 
+class TimeoutReport(object):
+    """
+    what happened during a run of process_timeouts
+    
+    found games had expired when scanned, of which timed_out were timed out,
+    skipped were no longer expired by the time they were processed, and failed
+    failed (e.g. a database error).
+    """
+    def __init__(self):
+        self.batches = 0
+        self.found = 0
+        self.timed_out = 0
+        self.skipped = 0
+        self.failed = 0
+        self.scan_seconds = 0.0
+        self.process_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def __repr__(self):
+        return ("TimeoutReport(batches=%r, found=%r, timed_out=%r, " +
+                "skipped=%r, failed=%r, scan_seconds=%r, " +
+                "process_seconds=%r, total_seconds=%r)") %  \
+            (self.batches, self.found, self.timed_out, self.skipped,
+             self.failed, self.scan_seconds, self.process_seconds,
+             self.total_seconds)
+
+    def __str__(self):
+        return ("%d timeouts processed (%d found in %d batches, %d skipped, " +
+                "%d failed); %0.3fs scanning, %0.3fs processing, " +
+                "%0.3fs total") %  \
+            (self.timed_out, self.found, self.batches, self.skipped,
+             self.failed, self.scan_seconds, self.process_seconds,
+             self.total_seconds)
+
 class UsersGameDetails(object):
     """
     lists of open game details, running game details, for a specific user
@@ -328,10 +366,36 @@ class UsersGameDetails(object):
         self.running_details = running_details
         self.finished_details = finished_details
 
+class UserDashboard(object):
+    """
+    everything on a user's home page: all open games, the user's running
+    games, and one page of the user's finished games, most recent first
+    
+    next_finished_before is the finished_before to request the next page of
+    finished games with, or None if there are no more.
+    """
+    def __init__(self, userid, open_details, running_details,
+                 finished_details, next_finished_before):
+        self.userid = userid
+        self.open_details = open_details
+        self.running_details = running_details
+        self.finished_details = finished_details
+        self.next_finished_before = next_finished_before
+
+    def __repr__(self):
+        return ("UserDashboard(userid=%r, open_details=%r, " +
+                "running_details=%r, finished_details=%r, " +
+                "next_finished_before=%r)") %  \
+            (self.userid, self.open_details, self.running_details,
+             self.finished_details, self.next_finished_before)
+
 class GameItem(object):
     """
     base class for hand history item DTOs
     """    
+    # position in the game's history, set by from_game_history_child
+    order = None
+
     @classmethod
     def from_game_history_child(cls, child):
         """
@@ -340,7 +404,9 @@ class GameItem(object):
         """
         class_ = child.__class__
         if class_ in MAP_TABLE_DTO:
-            return MAP_TABLE_DTO[class_].from_history_item(child)
+            item = MAP_TABLE_DTO[class_].from_history_item(child)
+            item.order = child.order
+            return item
         raise TypeError("Object is not a GameHistoryItem associated object")
     
     def should_include_for(self, _userid):
@@ -544,13 +610,24 @@ class AnalysisItemFoldEquityItem(object):
         """
         Create from AnalysisFoldEquityItem
         """
-        cards = [Card.from_text(afei.higher_card),
-                 Card.from_text(afei.lower_card)]
+        cards = list(combo_cards(afei.comboid))
         return cls(cards, afei.is_aggressive, afei.is_passive, afei.is_fold,
             afei.fold_ratio, afei.immediate_result,
             afei.semibluff_ev,
             afei.semibluff_equity)
 
+    @classmethod
+    def from_packed(cls, packed_items):
+        """
+        Create a list from AnalysisFoldEquity.packed_items
+        """
+        return [cls(list(combo_cards(comboid)), is_aggressive, is_passive,
+                    is_fold, fold_ratio, immediate_result, semibluff_ev,
+                    semibluff_equity)
+                for comboid, is_aggressive, is_passive, is_fold, fold_ratio,
+                    immediate_result, semibluff_ev, semibluff_equity
+                in unpack_fold_equity_items(packed_items)]
+
 class AnalysisItemFoldEquity(object):
     """
     All about the fold equity of a betting range.
@@ -588,8 +665,11 @@ class AnalysisItemFoldEquity(object):
         Create from AnalysisFoldEquity
         """
         bettor = UserDetails.from_user(afe.action_result.user)
-        items = [AnalysisItemFoldEquityItem.from_afei(item)
-                 for item in afe.items]
+        if afe.packed_items is not None:
+            items = AnalysisItemFoldEquityItem.from_packed(afe.packed_items)
+        else:
+            items = [AnalysisItemFoldEquityItem.from_afei(item)
+                     for item in afe.items]
         items.sort(key=lambda item: (-item.immediate_result, item.cards),
                    reverse=True)
         return cls(bettor, afe.street, afe.pot_before_bet, afe.is_raise,
@@ -631,6 +711,30 @@ class RunningGameHistory(object):
         """
         return self.game_details.is_finished()
             
+class GameHistoryUpdate(object):
+    """
+    What has happened in a game since a client last looked at it.
+    
+    history_items are only those with order >= the next_hh the client already
+    had; next_hh is the game's current next_hh.
+    """
+    def __init__(self, gameid, next_hh, current_userid, history_items):
+        self.gameid = gameid
+        self.next_hh = next_hh
+        self.current_userid = current_userid
+        self.history = history_items
+        
+    def __repr__(self):
+        return "GameHistoryUpdate(gameid=%r, next_hh=%r, current_userid=%r, "  \
+            "history=%r)" % (self.gameid, self.next_hh, self.current_userid,
+                             self.history)
+
+    def is_finished(self):
+        """
+        True when the game is finished.
+        """
+        return self.current_userid is None
+
 class ActionOptions(object):
     """
     Describes the options available to the current player, in general poker
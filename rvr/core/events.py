@@ -0,0 +1,161 @@
+"""
+In-process publish/subscribe of game state changes, so that clients waiting
+for something to happen in a game don't need to poll the database.
+
+Note that only changes made by this process are published. Anything waiting
+for a change should also check the database occasionally (e.g. whenever wait()
+times out), to catch changes made by other processes, such as timeouts
+processed from the admin console.
+"""
+import threading
+import time
+import unittest
+
+#pylint:disable=R0903
+
+class GameEvents(object):
+    """
+    Latest known (next_hh, current_userid) of each running game, and a way to
+    wait for it to change.
+
+    Waiting threads are blocked on a per-game condition, so an idle subscriber
+    costs no CPU, and makes no database queries, until its game changes. It
+    does cost a thread, though (under a synchronous server, a worker thread),
+    so waits should be short, and callers should limit how many threads wait
+    at once (see rvr.views.ajax.game_events).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}  # gameid -> (next_hh, current_userid)
+        self._conditions = {}  # gameid -> threading.Condition
+        self._waiters = {}  # gameid -> number of waiting threads
+        self._total_waiters = 0
+
+    def publish(self, gameid, next_hh, current_userid):
+        """
+        Record that game <gameid> is now at next_hh, with current_userid to act
+        (None if finished), and wake anything waiting for it.
+        
+        Finished games won't change again, so their state is forgotten (once
+        what's waiting has been woken), rather than kept forever.
+        """
+        with self._lock:
+            if current_userid is None:
+                self._states.pop(gameid, None)
+            else:
+                self._states[gameid] = (next_hh, current_userid)
+            condition = self._conditions.get(gameid)
+            if condition is not None:
+                condition.notify_all()
+
+    def wait(self, gameid, next_hh, timeout, max_waiters=None):
+        """
+        Wait up to <timeout> seconds for game <gameid> to be published with a
+        next_hh other than <next_hh>. Returns the latest published
+        (next_hh, current_userid), or None if nothing has been published for
+        this game (or it has finished).
+        
+        If max_waiters is specified, and that many threads are already
+        waiting (for any games), return straight away instead.
+        """
+        with self._lock:
+            state = self._states.get(gameid)
+            if state is not None and state[0] != next_hh:
+                return state
+            if max_waiters is not None and  \
+                    self._total_waiters >= max_waiters:
+                return state
+            condition = self._conditions.get(gameid)
+            if condition is None:
+                condition = threading.Condition(self._lock)
+                self._conditions[gameid] = condition
+            self._waiters[gameid] = self._waiters.get(gameid, 0) + 1
+            self._total_waiters += 1
+            try:
+                condition.wait(timeout)
+            finally:
+                self._total_waiters -= 1
+                self._waiters[gameid] -= 1
+                if not self._waiters[gameid]:
+                    del self._waiters[gameid]
+                    del self._conditions[gameid]
+            return self._states.get(gameid)
+
+    def clear(self):
+        """
+        Forget all published states
+        """
+        with self._lock:
+            self._states.clear()
+
+    def subscriber_count(self):
+        """
+        Number of threads currently waiting, across all games
+        """
+        with self._lock:
+            return self._total_waiters
+
+GAME_EVENTS = GameEvents()
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_already_changed(self):
+        """ Test that wait returns immediately if next_hh has moved on """
+        events = GameEvents()
+        events.publish(1, 5, 7)
+        self.assertEqual(events.wait(1, 4, 10.0), (5, 7))
+
+    def test_timeout(self):
+        """ Test that wait times out if nothing changes """
+        events = GameEvents()
+        self.assertIsNone(events.wait(1, 0, 0.01))
+        events.publish(1, 5, 7)
+        self.assertEqual(events.wait(1, 5, 0.01), (5, 7))
+        self.assertEqual(events.subscriber_count(), 0)
+
+    def test_publish_wakes_waiter(self):
+        """ Test that publish wakes a waiting thread """
+        events = GameEvents()
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(events.wait(1, 0, 10.0)))
+        thread.start()
+        while not events.subscriber_count():
+            time.sleep(0.001)
+        events.publish(1, 1, 7)
+        thread.join()
+        self.assertEqual(results, [(1, 7)])
+
+    def test_max_waiters(self):
+        """ Test that wait doesn't wait if enough threads are waiting """
+        events = GameEvents()
+        thread = threading.Thread(target=lambda: events.wait(1, 0, 10.0))
+        thread.start()
+        while not events.subscriber_count():
+            time.sleep(0.001)
+        start = time.time()
+        self.assertIsNone(events.wait(2, 0, 10.0, max_waiters=1))
+        self.assertLess(time.time() - start, 5.0)
+        events.publish(1, 1, 7)
+        thread.join()
+
+    def test_finished(self):
+        """ Test that a finished game wakes waiters, and is forgotten """
+        events = GameEvents()
+        events.publish(1, 5, 7)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(events.wait(1, 5, 10.0)))
+        thread.start()
+        while not events.subscriber_count():
+            time.sleep(0.001)
+        events.publish(1, 6, None)
+        thread.join()
+        self.assertEqual(results, [None])
+        self.assertEqual(events._states, {})  # pylint:disable=W0212
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Ephemeral databases, for tests and benchmarks.
+"""
+from contextlib import contextmanager
+import os
+import random
+import shutil
+import tempfile
+from rvr.db.creation import BASE, SESSION, create_ephemeral_engine
+from rvr.db import tables
+from rvr.core.api import API, APIError
+from rvr.core.cache import GAME_CACHE
+from rvr.core.events import GAME_EVENTS
+from rvr.bench.games import create_users, start_game, play_game
+from rvr.mail.notifications import NOTIFICATION_SETTINGS
+import unittest
+
+@contextmanager
+def ephemeral_db(filename=None):
+    """
+    Point the application at a new, seeded database for the duration, and
+    yield an API to use it with. The database is in a temporary file, or in
+    <filename> (which must not exist), if specified, and is deleted
+    afterwards. It's safe to use from several threads.
+    
+    Usage:
+        with ephemeral_db() as api:
+            api.login(...)
+    """
+    dirname = None
+    if filename is None:
+        dirname = tempfile.mkdtemp()
+        filename = os.path.join(dirname, 'ephemeral.db')
+    elif os.path.exists(filename):
+        raise ValueError("File already exists: %s" % filename)
+    engine = create_ephemeral_engine(filename)
+    BASE.metadata.create_all(engine)
+    old_bind = SESSION.kw.get('bind')
+    SESSION.configure(bind=engine)
+    # In-process state is keyed by gameid, which is only unique per database.
+    GAME_CACHE.clear()
+    GAME_EVENTS.clear()
+    try:
+        api = API()
+        result = api.initialise_db() or api.ensure_open_games()
+        if isinstance(result, APIError):
+            raise RuntimeError("Failed to seed ephemeral database: %s" %
+                               (result,))
+        yield api
+    finally:
+        SESSION.configure(bind=old_bind)
+        GAME_CACHE.clear()
+        GAME_EVENTS.clear()
+        engine.dispose()
+        if dirname is not None:
+            shutil.rmtree(dirname)
+        else:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+
+@contextmanager
+def suppressed_email():
+    """
+    Don't send emails for the duration (e.g. from tests and benchmarks, which
+    have no Flask app context to send them from)
+    """
+    suppress_email = NOTIFICATION_SETTINGS.suppress_email
+    NOTIFICATION_SETTINGS.suppress_email = True
+    try:
+        yield
+    finally:
+        NOTIFICATION_SETTINGS.suppress_email = suppress_email
+
+@contextmanager
+def game_db(users=0, games=0, played=0, seed=0):
+    """
+    An ephemeral_db() with emails suppressed, <users> users, and <games>
+    heads-up games between the first two of them, the first <played> of which
+    are played to the end (with random actions, using random.Random(seed)).
+    Yields (api, userids, gameids).
+    
+    Usage:
+        with game_db(users=2, games=1) as (api, userids, (gameid,)):
+            api.perform_action(gameid, ...)
+    """
+    with suppressed_email():
+        with ephemeral_db() as api:
+            userids = create_users(api, users)
+            gameids = [start_game(api, userids, 2) for _ in range(games)]
+            rng = random.Random(seed)
+            for gameid in gameids[:played]:
+                play_game(api, gameid, rng)
+            yield api, userids, gameids
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_seeding(self):
+        """ Test that ephemeral_db seeds the database, idempotently """
+        with ephemeral_db() as api:
+            self.assertIsNone(api.initialise_db())
+            session = SESSION()
+            try:
+                self.assertEqual(session.query(tables.RangeItem).count(), 1326)
+                self.assertEqual(session.query(tables.Situation).count(), 2)
+                self.assertEqual(
+                    session.query(tables.SituationPlayer).count(), 5)
+            finally:
+                session.close()
+            self.assertEqual(len(api.get_open_games()), 2)
+
+    def test_game_db(self):
+        """ Test game_db's users and games, and that it suppresses emails """
+        suppress_email = NOTIFICATION_SETTINGS.suppress_email
+        with game_db(users=3, games=2, played=1) as (api, userids, gameids):
+            self.assertTrue(NOTIFICATION_SETTINGS.suppress_email)
+            self.assertEqual(len(userids), 3)
+            self.assertEqual([api.get_public_game(gameid).is_finished()
+                              for gameid in gameids], [True, False])
+        self.assertEqual(NOTIFICATION_SETTINGS.suppress_email, suppress_email)
+
+if __name__ == '__main__':
+    unittest.main()
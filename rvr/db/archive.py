@@ -0,0 +1,169 @@
+"""
+Archival of the history and analysis of finished games.
+
+The game_history_* and analysis_* tables grow with every game ever played,
+but once a finished game has been analysed and snapshotted (see
+API._run_pending_analysis), its rows are only needed again if the snapshot
+has to be recreated. Archiving moves those rows into a single archived_game
+row per game, and unarchiving moves them back.
+
+RunningGame and RunningGameParticipant rows stay where they are, so archived
+games still appear in users' lists of finished games.
+
+Archived rows are stored with their column names, so they can be unarchived
+after columns have been added to or removed from their tables.
+"""
+import cPickle
+import datetime
+import unittest
+import zlib
+from rvr.db.tables import GameHistoryBase, GameHistoryUserRange,  \
+    GameHistoryActionResult, GameHistoryRangeAction, GameHistoryBoard,  \
+    GameHistoryTimeout, AnalysisFoldEquity, AnalysisFoldEquityItem,  \
+    ArchivedGame
+
+# Parents first
+ARCHIVED_TABLES = [GameHistoryBase,
+                   GameHistoryUserRange,
+                   GameHistoryActionResult,
+                   GameHistoryRangeAction,
+                   GameHistoryBoard,
+                   GameHistoryTimeout,
+                   AnalysisFoldEquity,
+                   AnalysisFoldEquityItem]
+
+# Keeps "IN (...)" within SQLite's limit on bound parameters
+_SLICE = 500
+
+# Format of ArchivedGame.data, which is a compressed pickle of
+# (ARCHIVE_FORMAT, {tablename: (column names, rows)}). Increment if that
+# structure changes (but not for changes to the tables, which unarchive_games
+# copes with).
+ARCHIVE_FORMAT = 1
+
+def _slices(gameids):
+    """
+    Yield gameids in lists of up to _SLICE
+    """
+    for i in range(0, len(gameids), _SLICE):
+        yield gameids[i:i + _SLICE]
+
+def _dumps(tables_):
+    """
+    ArchivedGame.data for {tablename: (column names, rows)}
+    """
+    return zlib.compress(cPickle.dumps((ARCHIVE_FORMAT, tables_),
+                                       cPickle.HIGHEST_PROTOCOL))
+
+def _loads(data):
+    """
+    {tablename: (column names, rows)} from ArchivedGame.data
+    """
+    format_, tables_ = cPickle.loads(zlib.decompress(data))
+    if format_ != ARCHIVE_FORMAT:
+        raise ValueError("Unknown archived game format: %r" % (format_,))
+    return tables_
+
+def _insert_values(table, data):
+    """
+    Values to insert into table, from the {tablename: (column names, rows)}
+    of some archived games, as lists of dicts with the same keys. Columns that
+    the table no longer has are dropped. Columns that it didn't have when the
+    games were archived are left out, so they get their defaults.
+    """
+    groups = {}
+    for tables_ in data:
+        if table.name not in tables_:
+            continue
+        columns, rows = tables_[table.name]
+        kept = [(i, name) for i, name in enumerate(columns)
+                if name in table.c]
+        groups.setdefault(tuple(name for _, name in kept), []).extend(
+            {name: row[i] for i, name in kept} for row in rows)
+    return groups.values()
+
+def archive_games(session, gameids):
+    """
+    Move the history and analysis rows of games <gameids> (which should be
+    finished, analysed, and not already archived) into archived_game.
+    """
+    now = datetime.datetime.utcnow()
+    for some_gameids in _slices(list(gameids)):
+        # gameid -> tablename -> (columns, rows)
+        data = {gameid: {} for gameid in some_gameids}
+        for cls in ARCHIVED_TABLES:
+            table = cls.__table__
+            columns = [column.name for column in table.columns]
+            query = session.query(*table.columns)  \
+                .filter(table.c.gameid.in_(some_gameids))
+            for row in query:
+                data[row.gameid].setdefault(table.name, (columns, []))[1]  \
+                    .append(tuple(row))
+        session.execute(ArchivedGame.__table__.insert(),
+            [{'gameid': gameid,
+              'archived_time': now,
+              'data': _dumps(tables_)}
+             for gameid, tables_ in data.iteritems()])
+        for cls in reversed(ARCHIVED_TABLES):
+            session.query(cls).filter(cls.gameid.in_(some_gameids))  \
+                .delete(synchronize_session=False)
+
+def unarchive_games(session, gameids):
+    """
+    Move the history and analysis rows of any of games <gameids> that are
+    archived back to where they came from. Returns the gameids that were
+    archived.
+    """
+    unarchived = []
+    for some_gameids in _slices(list(gameids)):
+        archived = session.query(ArchivedGame.gameid, ArchivedGame.data)  \
+            .filter(ArchivedGame.gameid.in_(some_gameids)).all()
+        if not archived:
+            continue
+        data = [_loads(blob) for _, blob in archived]
+        for cls in ARCHIVED_TABLES:
+            table = cls.__table__
+            for values in _insert_values(table, data):
+                if values:
+                    session.execute(table.insert(), values)
+        gameids_done = [gameid for gameid, _ in archived]
+        session.query(ArchivedGame)  \
+            .filter(ArchivedGame.gameid.in_(gameids_done))  \
+            .delete(synchronize_session=False)
+        unarchived.extend(gameids_done)
+    return unarchived
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_loads(self):
+        """ Test _loads, of _dumps and of an unknown format """
+        tables_ = {'game_history_timeout': (['gameid', 'order', 'userid'],
+                                            [(1, 2, 3), (1, 5, 4)])}
+        self.assertEqual(_loads(_dumps(tables_)), tables_)
+        data = zlib.compress(cPickle.dumps((ARCHIVE_FORMAT + 1, tables_)))
+        self.assertRaises(ValueError, _loads, data)
+
+    def test_insert_values(self):
+        """
+        Test _insert_values, for games archived before and after a column was
+        added and another removed
+        """
+        table = GameHistoryTimeout.__table__
+        new = {'game_history_timeout': (['gameid', 'order', 'userid'],
+                                        [(1, 2, 3), (1, 5, 4)])}
+        old = {'game_history_timeout': (['gameid', 'order', 'removed'],
+                                        [(2, 3, 'x')]),
+               'game_history_board': (['gameid', 'order', 'street', 'cards'],
+                                      [(2, 1, 'flop', 'AsKsQs')])}
+        other = {'game_history_board': (['gameid', 'order', 'street',
+                                         'cards'],
+                                        [(3, 1, 'flop', 'AsKsQs')])}
+        values = _insert_values(table, [_loads(_dumps(tables_))
+                                        for tables_ in [new, old, other]])
+        self.assertEqual(sorted(values), sorted([
+            [{'gameid': 1, 'order': 2, 'userid': 3},
+             {'gameid': 1, 'order': 5, 'userid': 4}],
+            [{'gameid': 2, 'order': 3}]]))
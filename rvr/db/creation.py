@@ -1,28 +1,312 @@
 """
 Creation of database, connection to database, sessions for use of database
 """
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, Index
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
 from functools import wraps
+import logging
+import random
+import threading
+import time
 from rvr.local_settings import SQLALCHEMY_DATABASE_URI
 
-ENGINE = create_engine(SQLALCHEMY_DATABASE_URI, echo=False,
-                       isolation_level='SERIALIZABLE')
-SESSION = sessionmaker(bind=ENGINE)
-BASE = declarative_base()
-
 #pylint:disable=R0903
 
-@event.listens_for(ENGINE, "begin")
+# How long an SQLite connection waits for another's write lock before failing
+SQLITE_BUSY_TIMEOUT_MS = 10000
+
+# How many times retry_transient tries a unit of work, and the range of its
+# (exponential, jittered) delays between attempts, in seconds
+RETRY_ATTEMPTS = 5
+RETRY_MIN_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+
+# Fragments of the messages of errors that go away if you try again
+TRANSIENT_ERRORS = ["database is locked",        # SQLite
+                    "database table is locked",  # SQLite
+                    "could not serialize",       # PostgreSQL
+                    "deadlock detected",         # PostgreSQL
+                    "Deadlock found",            # MySQL
+                    "Lock wait timeout"]         # MySQL
+
+def do_connect(dbapi_connection, _connection_record):
+    """
+    Put SQLite into WAL mode, so that readers don't block writers or vice
+    versa, and make it wait (rather than fail immediately) for locks.
+    
+    We don't ask for SERIALIZABLE isolation. Instead, conflicting changes to
+    a game are detected by RunningGame's version column.
+    
+    Also stop pysqlite from managing transactions itself (do_begin does it),
+    because it would commit before a SAVEPOINT, per http://docs.sqlalchemy.org
+    /en/latest/dialects/sqlite.html#serializable-transaction-isolation
+    """
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % (SQLITE_BUSY_TIMEOUT_MS,))
+    cursor.close()
+
 def do_begin(conn):
     """
-    To allows SQLite serializable isolation, per http://docs.sqlalchemy.org/en
-    /latest/dialects/sqlite.html#serializable-transaction-isolation
+    Start SQLite transactions when SQLAlchemy thinks they start (rather than
+    at the first write), so that each transaction sees a consistent snapshot,
+    per http://docs.sqlalchemy.org/en/latest/dialects/sqlite.html
+    #serializable-transaction-isolation
     """
     conn.execute("BEGIN")
 
+def _configure(engine):
+    """
+    Apply the above to engine, if it's SQLite
+    """
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, "connect", do_connect)
+        event.listen(engine, "begin", do_begin)
+    return engine
+
+ENGINE = _configure(create_engine(SQLALCHEMY_DATABASE_URI, echo=False))
+SESSION = sessionmaker(bind=ENGINE)
+BASE = declarative_base()
+
+def partial_index(name, *columns, **kwargs):
+    """
+    An Index of only the rows matching kwargs['where'], on PostgreSQL and
+    SQLite (3.8.0 and later). Other databases index every row.
+    """
+    where = kwargs.pop('where')
+    index = Index(name, *columns, postgresql_where=where, **kwargs)
+    index.info['where'] = where
+    return index
+
+@compiles(CreateIndex, 'sqlite')
+def _create_sqlite_index(create, compiler, **kwargs):
+    """
+    Add partial_index's WHERE clause to CREATE INDEX, which SQLAlchemy only
+    does for PostgreSQL
+    """
+    text = compiler.visit_create_index(create, **kwargs)
+    where = create.element.info.get('where')
+    if where is not None and  \
+            compiler.dialect.dbapi.sqlite_version_info >= (3, 8, 0):
+        text += " WHERE " + compiler.sql_compiler.process(
+            where, include_table=False, literal_binds=True)
+    return text
+
+def create_ephemeral_engine(filename):
+    """
+    Create an engine for a new, empty SQLite database in <filename>,
+    configured like ENGINE.
+    
+    This is always a file, never in memory: an in-memory database can only
+    have one connection (each would be a different database), which threads
+    would have to share, but a file gives each thread its own connection, with
+    the same locking as a real database.
+    """
+    return _configure(create_engine('sqlite:///' + filename, echo=False))
+
+def after_commit(session, callback):
+    """
+    Arrange for callback() to be called once session's current transaction
+    has been committed. If the transaction is rolled back instead, callback is
+    discarded. If the current transaction is a savepoint, that means once the
+    outermost transaction has been committed, unless the savepoint (or the
+    outermost transaction) is rolled back.
+
+    Useful for things like cache invalidation, which should not happen until
+    other sessions are able to see the change, and notifications, which
+    should not be sent by an attempt that is rolled back (and perhaps
+    retried).
+    
+    By then, the session can't be used to query, so callback shouldn't need
+    to load anything. An exception raised by callback is logged, rather than
+    raised, because the transaction has been committed regardless.
+    """
+    session.info.setdefault('after_commit', []).append(
+        (session.transaction, callback))
+
+def _parent(transaction):
+    """
+    The transaction that transaction is a subtransaction of, or None
+    """
+    return transaction._parent  # pylint:disable=W0212
+
+def _within(transaction, ancestor):
+    """
+    Is transaction ancestor, or one of its subtransactions?
+    """
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = _parent(transaction)
+    return False
+
+@event.listens_for(SESSION, "after_commit")
+def _run_after_commit(session):
+    """
+    Run (and clear) callbacks registered with after_commit(), if it's the
+    outermost transaction that has been committed (rather than a savepoint)
+    """
+    if session.transaction is not None and session.transaction.nested:
+        return
+    callbacks = session.info.pop('after_commit', [])
+    for _transaction, callback in callbacks:
+        try:
+            callback()
+        except Exception:  # pylint:disable=W0703
+            logging.exception("after_commit callback failed")
+
+@event.listens_for(SESSION, "after_soft_rollback")
+def _discard_after_commit(session, previous_transaction):
+    """
+    Discard callbacks registered with after_commit() within the transaction
+    (or savepoint) that has been rolled back
+    """
+    rolled_back = previous_transaction
+    while not rolled_back.nested and _parent(rolled_back) is not None:
+        rolled_back = _parent(rolled_back)
+    callbacks = session.info.get('after_commit', [])
+    session.info['after_commit'] = [(transaction, callback)
+        for transaction, callback in callbacks
+        if not _within(transaction, rolled_back)]
+
+class QueryCount(object):
+    """
+    The number of statements executed within a count_queries()
+    """
+    def __init__(self):
+        self.count = 0
+
+_QUERY_COUNTS = threading.local()
+
+@contextmanager
+def count_queries():
+    """
+    Count the statements executed (by any engine) in this thread, for the
+    duration. Yields a QueryCount.
+    
+    Usage:
+        with count_queries() as queries:
+            ...
+        logging.debug("... took %d queries", queries.count)
+    """
+    counts = _QUERY_COUNTS.__dict__.setdefault('active', [])
+    query_count = QueryCount()
+    counts.append(query_count)
+    try:
+        yield query_count
+    finally:
+        counts.remove(query_count)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(*_args):
+    """
+    Increment this thread's active QueryCounts
+    """
+    for query_count in getattr(_QUERY_COUNTS, 'active', ()):
+        query_count.count += 1
+
+class RetryStats(object):
+    """
+    Counts of what retry_transient has done
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.give_ups = 0
+
+    def retried(self):
+        """
+        Record that a unit of work is being retried
+        """
+        with self._lock:
+            self.retries += 1
+
+    def gave_up(self):
+        """
+        Record that a unit of work failed on its last attempt
+        """
+        with self._lock:
+            self.give_ups += 1
+
+    def reset(self):
+        """
+        Set the counts back to zero
+        """
+        with self._lock:
+            self.retries = 0
+            self.give_ups = 0
+
+RETRY_STATS = RetryStats()
+
+def is_transient(ex):
+    """
+    Is ex a database error that might not happen if we try again, such as
+    lock contention or a serialization failure?
+    """
+    if not isinstance(ex, DBAPIError) or ex.connection_invalidated:
+        return False
+    message = str(ex.orig)
+    return any(fragment in message for fragment in TRANSIENT_ERRORS)
+
+def _call_with_retries(fun, name, before_retry=None):
+    """
+    Return fun(), trying again if it fails with a transient error, as
+    described for retry_transient. Calls before_retry() (if specified) before
+    each retry.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return fun()
+        except DBAPIError as ex:
+            if not is_transient(ex):
+                raise
+            if attempt == RETRY_ATTEMPTS - 1:
+                RETRY_STATS.gave_up()
+                raise
+            RETRY_STATS.retried()
+            delay = min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** attempt)
+            logging.debug("Retrying %s in %0.3fs after %r", name, delay, ex)
+            time.sleep(random.uniform(0, delay))
+            if before_retry is not None:
+                before_retry()
+
+def retry_transient(fun):
+    """
+    Retry a unit of work that fails with a transient error (see is_transient),
+    up to RETRY_ATTEMPTS attempts in all, with exponentially increasing,
+    jittered delays in between.
+    
+    Intended for use outside @create_session, so that each attempt is a whole
+    new transaction. When called with a session already in progress, it
+    doesn't retry, because only the outermost call can. Within a
+    unit_of_work(), it records the error, so that the whole unit of work can be
+    retried.
+    """
+    @wraps(fun)
+    def inner(*args, **kwargs):
+        """
+        See parent.
+        """
+        if args[0].session is not None:
+            return fun(*args, **kwargs)
+        unit = current_unit_of_work()
+        if unit is not None:
+            try:
+                return fun(*args, **kwargs)
+            except DBAPIError as ex:
+                if is_transient(ex) and unit.transient_error is None:
+                    unit.transient_error = ex
+                raise
+        return _call_with_retries(lambda: fun(*args, **kwargs), fun.__name__)
+    return inner
+
 # from http://docs.sqlalchemy.org/en/rel_0_8/orm/session.html
 @contextmanager
 def session_scope():
@@ -37,6 +321,108 @@ def session_scope():
     finally:
         session.close()
 
+class UnitOfWork(object):
+    """
+    The state of a unit_of_work()
+    """
+    def __init__(self, session):
+        self.session = session
+        self.transient_error = None
+
+_UNITS_OF_WORK = threading.local()
+
+def current_unit_of_work():
+    """
+    The UnitOfWork of this thread's unit_of_work(), or None
+    """
+    return getattr(_UNITS_OF_WORK, 'current', None)
+
+@contextmanager
+def unit_of_work():
+    """
+    Share one session, and therefore one transaction and one identity map,
+    between everything using @create_session (or @create_read_session) in this
+    thread for the duration, and commit it once at the end.
+    
+    Each outermost @create_session call runs in a savepoint, so that it can
+    still fail (and roll back) on its own. If any of them fails with a
+    transient error (see retry_transient), the whole unit of work is rolled
+    back, and the error raised at the end, so that it can be retried (see
+    run_unit_of_work).
+    
+    Nested uses share the outermost unit of work.
+    """
+    unit = current_unit_of_work()
+    if unit is not None:
+        yield unit
+        return
+    session = SESSION()
+    unit = UnitOfWork(session)
+    _UNITS_OF_WORK.current = unit
+    try:
+        yield unit
+        if unit.transient_error is not None:
+            raise unit.transient_error  # pylint:disable=E0702
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        _UNITS_OF_WORK.current = None
+        session.close()
+
+def run_unit_of_work(fun, before_retry=None):
+    """
+    Return fun(), called within a unit_of_work(). If the unit of work fails
+    with a transient error, retry it all, like retry_transient.
+    
+    before_retry(), if specified, is called before each retry, to undo fun's
+    effects outside the database.
+    """
+    def attempt():
+        """
+        Call fun() within a unit of work
+        """
+        with unit_of_work():
+            return fun()
+    return _call_with_retries(attempt, getattr(fun, '__name__', repr(fun)),
+                              before_retry)
+
+class ReadOnlySessionError(Exception):
+    """
+    Raised by ensure_writable for a session from read_session_scope()
+    """
+    pass
+
+@contextmanager
+def read_session_scope():
+    """
+    Provide a scope for a series of queries. The session never flushes or
+    commits, so its (deferred) transaction only ever reads, which in WAL mode
+    doesn't block or wait for writers. It is rolled back at the end.
+    """
+    session = SESSION(autoflush=False, expire_on_commit=False)
+    session.info['read_only'] = True
+    try:
+        yield session
+    finally:
+        session.close()
+
+def ensure_writable(session):
+    """
+    Raise ReadOnlySessionError if session is from read_session_scope(). Call
+    before writing in code that might be running in one.
+    """
+    if session.info.get('read_only'):
+        raise ReadOnlySessionError()
+
+@event.listens_for(SESSION, "before_flush")
+def _refuse_read_only_flush(session, _flush_context, _instances):
+    """
+    Don't let changes made in a read-only session go unnoticed
+    """
+    ensure_writable(session)
+
 def create_session(fun):
     """
     Creates a session_scope() for session and assigns it to the parent object,
@@ -48,15 +434,62 @@ def create_session(fun):
         See parent.
         """
         self = args[0]
-        if self.session is None:
-            with session_scope() as session:
+        if self.session is not None:
+            return fun(*args, **kwargs)
+        unit = current_unit_of_work()
+        if unit is not None:
+            savepoint = unit.session.begin_nested()
+            self.session = unit.session
+            try:
+                result = fun(*args, **kwargs)
+                if savepoint.is_active:
+                    savepoint.commit()
+                return result
+            except:
+                if savepoint.is_active:
+                    savepoint.rollback()
+                raise
+            finally:
+                self.session = None
+        with session_scope() as session:
+            self.session = session
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                self.session = None
+    return inner
+
+def create_read_session(fun):
+    """
+    Like create_session, but with a read_session_scope(). If fun turns out to
+    need to write (i.e. raises ReadOnlySessionError), it is called again with
+    a session_scope().
+    
+    Within another session, fun simply uses that session. Within a
+    unit_of_work(), fun uses its session, just like create_session.
+    """
+    writing_fun = create_session(fun)
+    @wraps(fun)
+    def inner(*args, **kwargs):
+        """
+        See parent.
+        """
+        self = args[0]
+        if self.session is not None:
+            return fun(*args, **kwargs)
+        if current_unit_of_work() is not None:
+            return writing_fun(*args, **kwargs)
+        try:
+            with read_session_scope() as session:
                 self.session = session
                 try:
                     return fun(*args, **kwargs)
                 finally:
                     self.session = None
-        else:
-            return fun(*args, **kwargs)
+        except ReadOnlySessionError:
+            logging.debug("%s needs to write, calling again with a "
+                          "read-write session", fun.__name__)
+        return writing_fun(*args, **kwargs)
     return inner
 
 if __name__ == '__main__':
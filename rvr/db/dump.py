@@ -1,21 +1,22 @@
 """
 How to use this file:
 
-This file is kept up to date. It can read and write the current version of the
-database. If you need to dump out an old version of the database, find the
-dump.py for that version of the code (it's probably right there).
+This file is kept up to date. dump writes every table of the current version
+of the database to a directory, with the names of each table's columns. To
+load it into a new version, release the new version of the code, create a new
+database, and use the new dump.py to load in the old data (load_stream or
+restore).
 
-To load it into a new version, release the new version of the code, create a
-new database, and use the new dump.py to load in the old data.
+Loading copes with columns that have been removed since the dump (their
+values are dropped) or added (they get their defaults). Any other change to a
+table (e.g. a renamed column, or a new column that has no default and can't be
+null) makes loading fail, so it needs code here to convert the old data.
 
-This won't quite work, but it's a good start. The major difference is that the
-reads below need to be aware of the changes since the previous version.
+Older versions dumped to a single pickle file, which load_pickle reads.
 
 At deployment time:
-- make sure the existing production dump code is up to date for the database you
-  want to dump (visually)
-- make sure this code can write (to the database) what the previous version will
-  be reading (from the file) (visually)
+- make sure this code can load (into the database) what the previous version
+  will be dumping (visually)
 - in production:
   - dump the previous version of the database ('dump out' from the console)
 - in a local development environment:
@@ -31,15 +32,26 @@ At deployment time:
   update it to be correct
 """
 import pickle
+import cPickle
+import gzip
+import json
+import logging
+import os
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import and_
 from rvr.db.tables import User, SituationPlayer, Situation, OpenGame, \
     OpenGameParticipant, RunningGame, RunningGameParticipant, \
     GameHistoryBoard, GameHistoryRangeAction, GameHistoryActionResult, \
     GameHistoryUserRange, GameHistoryBase, GameHistoryTimeout, RangeItem,\
-    AnalysisFoldEquity, AnalysisFoldEquityItem
-from rvr.db.creation import SESSION
+    AnalysisFoldEquity, AnalysisFoldEquityItem, StoredRange, ArchivedGame
+from rvr.db.creation import SESSION, session_scope
+from rvr.poker.cards import Card, combo_id
 
 #pylint:disable=C0103
 
+# The tables in an old format (pickled) dump, in the order they are written
 dumpable_tables = [
     User,
     Situation,
@@ -58,30 +70,24 @@ dumpable_tables = [
     AnalysisFoldEquity,
     AnalysisFoldEquityItem]
 
-def read_range_items(session):
-    """ Read RangeItem table from DB into memory """
-    range_items = session.query(RangeItem).all()
-    return [(r.higher_card,
-             r.lower_card)
-            for r in range_items]
-    
+def _comboid(higher_card, lower_card):
+    """
+    Convert a combo from the pickled format (two card mnemonics) to a comboid
+    """
+    return combo_id(Card.from_text(higher_card), Card.from_text(lower_card))
+
+def _float(value):
+    """
+    Convert a number from the pickled format (Decimal) to a float
+    """
+    return float(value) if value is not None else None
+
 def write_range_items(session, range_items):
     """ Write RangeItem table from memory into DB """
     for higher_card, lower_card in range_items:
         range_item = RangeItem()
         session.add(range_item)
-        range_item.higher_card = higher_card
-        range_item.lower_card = lower_card
-
-def read_users(session):
-    """ Read User table from DB into memory """
-    users = session.query(User).all()
-    return [(u.userid,
-             u.identity,
-             u.screenname,
-             u.email,
-             u.unsubscribed)
-            for u in users]
+        range_item.comboid = _comboid(higher_card, lower_card)
 
 def write_users(session, users):
     """ Write User table from memory into DB """
@@ -94,22 +100,6 @@ def write_users(session, users):
         user.email = email
         user.unsubscribed = unsubscribed
 
-def read_situations(session):
-    """ Read Situation table from DB into memory """
-    situations = session.query(Situation).all()
-    return [(situation.situationid,
-             situation.description,
-             situation.participants,
-             situation.is_limit,
-             situation.big_blind,
-             situation.board_raw,
-             situation.current_round,
-             situation.pot_pre,
-             situation.increment,
-             situation.bet_count,
-             situation.current_player_num)
-            for situation in situations]
-
 def write_situations(session, situations):
     """ Write Situation from memory into DB """
     for situationid, description, participants, is_limit, big_blind,  \
@@ -129,17 +119,6 @@ def write_situations(session, situations):
         situation.bet_count = bet_count
         situation.current_player_num = current_player_num
 
-def read_situation_players(session):
-    """ Read SituationPlayer table from DB into memory """
-    sps = session.query(SituationPlayer).all()
-    return [(sp.situationid,
-             sp.order,
-             sp.stack,
-             sp.contributed,
-             sp.range_raw,
-             sp.left_to_act)
-            for sp in sps]
-
 def write_situation_players(session, sps):
     """ Write SituationPlayer from memory into DB """
     for situationid, order, stack, contributed, range_raw, left_to_act in sps:
@@ -152,14 +131,6 @@ def write_situation_players(session, sps):
         sp.range_raw = range_raw
         sp.left_to_act = left_to_act
 
-def read_open_games(session):
-    """ Read OpenGame table from DB into memory """
-    ogs = session.query(OpenGame).all()
-    return [(og.gameid,
-             og.situationid,
-             og.participants)
-            for og in ogs]
-
 def write_open_games(session, ogs):
     """ Write OpenGame from memory into DB """
     for gameid, situationid, participants in ogs:
@@ -169,13 +140,6 @@ def write_open_games(session, ogs):
         og.situationid = situationid
         og.participants = participants
 
-def read_open_game_participants(session):
-    """ Read GameParticipant table from DB into memory """
-    ogps = session.query(OpenGameParticipant).all()
-    return [(ogp.userid,
-             ogp.gameid)
-            for ogp in ogps]
-
 def write_open_game_participants(session, ogps):
     """ Write GameParticipant from memory into DB """
     for userid, gameid in ogps:
@@ -184,22 +148,6 @@ def write_open_game_participants(session, ogps):
         ogp.userid = userid
         ogp.gameid = gameid
 
-def read_running_games(session):
-    """ Read RunningGame table from DB into memory """
-    rgs = session.query(RunningGame).all()
-    return [(rg.gameid,
-             rg.situationid,
-             rg.current_userid,
-             rg.next_hh,
-             rg.board_raw,
-             rg.current_round,
-             rg.pot_pre,
-             rg.increment,
-             rg.bet_count,
-             rg.current_factor,
-             rg.last_action_time)
-            for rg in rgs]
-
 def write_running_games(session, rgs):
     """ Write RunningGame from memory into DB """
     for gameid, situationid, current_userid, next_hh, board_raw,  \
@@ -219,20 +167,6 @@ def write_running_games(session, rgs):
         rg.current_factor = current_factor
         rg.last_action_time = last_action_time
 
-def read_running_game_participants(session):
-    """ Read RunningGameParticipant table from DB into memory """
-    rgps = session.query(RunningGameParticipant).all()
-    return [(rgp.userid,
-             rgp.gameid,
-             rgp.order,
-             rgp.stack,
-             rgp.contributed,
-             rgp.range_raw,
-             rgp.left_to_act,
-             rgp.folded,
-             rgp.cards_dealt_raw)
-            for rgp in rgps]
-
 def write_running_game_participants(session, rgps):
     """ Write RunningGameParticipant from memory into DB """
     for userid, gameid, order, stack, contributed, range_raw, left_to_act, \
@@ -249,14 +183,6 @@ def write_running_game_participants(session, rgps):
         rgp.folded = folded
         rgp.cards_dealt_raw = cards_dealt_raw
 
-def read_game_history_bases(session):
-    """ Read GameHistoryBase table from DB into memory """
-    ghbs = session.query(GameHistoryBase).all()
-    return [(ghb.gameid,
-             ghb.order,
-             ghb.time)
-            for ghb in ghbs]
-
 def write_game_history_bases(session, ghbs):
     """ Write GameHistoryBase from memory into DB """
     for gameid, order, time in ghbs:
@@ -266,15 +192,6 @@ def write_game_history_bases(session, ghbs):
         ghb.order = order
         ghb.time = time
 
-def read_game_history_user_ranges(session):
-    """ Read GameHistoryUserRange table from DB into memory """
-    ghurs = session.query(GameHistoryUserRange).all()
-    return [(ghur.gameid,
-             ghur.order,
-             ghur.userid,
-             ghur.range_raw)
-            for ghur in ghurs]
-
 def write_game_history_user_ranges(session, ghurs):
     """ Write GameHistoryUserRange from memory into DB """
     for gameid, order, userid, range_raw in ghurs:
@@ -285,20 +202,6 @@ def write_game_history_user_ranges(session, ghurs):
         ghur.userid = userid
         ghur.range_raw = range_raw
 
-def read_game_history_action_results(session):
-    """ Read GameHistoryActionResult table from DB into memory """
-    ghars = session.query(GameHistoryActionResult).all()
-    return [(ghar.gameid,
-             ghar.order,
-             ghar.userid,
-             ghar.is_fold,
-             ghar.is_passive,
-             ghar.is_aggressive,
-             ghar.call_cost,
-             ghar.raise_total,
-             ghar.is_raise)
-            for ghar in ghars]
-
 def write_game_history_action_results(session, ghars):
     """ Write GameHistoryActionResult from memory into DB """
     for gameid, order, userid, is_fold, is_passive, is_aggressive, call_cost,  \
@@ -315,20 +218,6 @@ def write_game_history_action_results(session, ghars):
         ghar.raise_total = raise_total
         ghar.is_raise = is_raise
 
-def read_game_history_range_actions(session):
-    """ Read HandHistoryRangeAction table from DB into memory """
-    ghras = session.query(GameHistoryRangeAction).all()
-    return [(ghra.gameid,
-             ghra.order,
-             ghra.userid,
-             ghra.fold_range,
-             ghra.passive_range,
-             ghra.aggressive_range,
-             ghra.raise_total,
-             ghra.is_check,
-             ghra.is_raise)
-            for ghra in ghras]
-
 def write_game_history_range_actions(session, ghras):
     """ Write HandHistoryRangeAction from memory into DB """
     for gameid, order, userid, fold_range, passive_range, aggressive_range,  \
@@ -345,15 +234,6 @@ def write_game_history_range_actions(session, ghras):
         ghra.is_check = is_check
         ghra.is_raise = is_raise
 
-def read_game_history_boards(session):
-    """ Read GameHistoryBoard table from DB into memory """
-    ghbs = session.query(GameHistoryBoard).all()
-    return [(ghb.gameid,
-             ghb.order,
-             ghb.street,
-             ghb.cards)
-            for ghb in ghbs]
-
 def write_game_history_boards(session, ghbs):
     """ Write GameHistoryBoard from memory into DB """
     for gameid, order, street, cards in ghbs:
@@ -364,14 +244,6 @@ def write_game_history_boards(session, ghbs):
         ghb.street = street
         ghb.cards = cards
         
-def read_game_history_timeouts(session):
-    """ Read GameHistoryTimeout table from DB into memory """
-    ghts = session.query(GameHistoryTimeout).all()
-    return [(ght.gameid,
-             ght.order,
-             ght.userid)
-            for ght in ghts]
-    
 def write_game_history_timeouts(session, ghts):
     """ Write GameHistoryTimeout from memory into DB """
     for gameid, order, userid in ghts:
@@ -381,20 +253,6 @@ def write_game_history_timeouts(session, ghts):
         ght.order = order
         ght.userid = userid
 
-def read_analysis_fold_equities(session):
-    """ Read AnalysisFoldEquity table from DB into memory """
-    afes = session.query(AnalysisFoldEquity).all()
-    return [(afe.gameid,
-             afe.order,
-             afe.street,
-             afe.pot_before_bet,
-             afe.is_raise,
-             afe.is_check,
-             afe.bet_cost,
-             afe.raise_total,
-             afe.pot_if_called)
-            for afe in afes]
-
 def write_analysis_fold_equities(session, afes):
     """ Write AnalysisFoldEquity table from memory into DB """
     for gameid, order, street, pot_before_bet, is_raise, is_check, bet_cost,  \
@@ -411,22 +269,6 @@ def write_analysis_fold_equities(session, afes):
         afe.raise_total = raise_total
         afe.pot_if_called = pot_if_called
 
-def read_analysis_fold_equity_items(session):
-    """ Read AnalysisFoldEquityItem table from DB into memory """
-    afeis = session.query(AnalysisFoldEquityItem).all()
-    return [(afei.gameid,
-             afei.order,
-             afei.higher_card,
-             afei.lower_card,
-             afei.is_aggressive,
-             afei.is_passive,
-             afei.is_fold,
-             afei.fold_ratio,
-             afei.immediate_result,
-             afei.semibluff_ev,
-             afei.semibluff_equity)
-            for afei in afeis]
-
 def write_analysis_fold_equity_items(session, afeis):
     """ Write AnalysisFoldEquityItem table from memory into DB """
     for gameid, order, higher_card, lower_card, is_aggressive, is_passive,  \
@@ -436,32 +278,14 @@ def write_analysis_fold_equity_items(session, afeis):
         session.add(afei)
         afei.gameid = gameid
         afei.order = order
-        afei.higher_card = higher_card
-        afei.lower_card = lower_card
+        afei.comboid = _comboid(higher_card, lower_card)
         afei.is_aggressive = is_aggressive
         afei.is_passive = is_passive
         afei.is_fold = is_fold
-        afei.fold_ratio = fold_ratio
-        afei.immediate_result = immediate_result
-        afei.semibluff_ev = semibluff_ev
-        afei.semibluff_equity = semibluff_equity
-
-TABLE_READERS = {User: read_users,
-                 Situation: read_situations,
-                 SituationPlayer: read_situation_players,
-                 OpenGame: read_open_games,
-                 OpenGameParticipant: read_open_game_participants,
-                 RunningGame: read_running_games,
-                 RunningGameParticipant: read_running_game_participants,
-                 GameHistoryBase: read_game_history_bases,
-                 GameHistoryUserRange: read_game_history_user_ranges,
-                 GameHistoryActionResult: read_game_history_action_results,
-                 GameHistoryRangeAction: read_game_history_range_actions,
-                 GameHistoryBoard: read_game_history_boards,
-                 GameHistoryTimeout: read_game_history_timeouts,
-                 RangeItem: read_range_items,
-                 AnalysisFoldEquity: read_analysis_fold_equities,
-                 AnalysisFoldEquityItem: read_analysis_fold_equity_items}
+        afei.fold_ratio = _float(fold_ratio)
+        afei.immediate_result = _float(immediate_result)
+        afei.semibluff_ev = _float(semibluff_ev)
+        afei.semibluff_equity = _float(semibluff_equity)
 
 TABLE_WRITERS = {User: write_users,
                  Situation: write_situations,
@@ -480,12 +304,6 @@ TABLE_WRITERS = {User: write_users,
                  AnalysisFoldEquity: write_analysis_fold_equities,
                  AnalysisFoldEquityItem: write_analysis_fold_equity_items}
 
-def read_db():
-    """ Read all tables from DB into memory """
-    session = SESSION()
-    return {table.__tablename__: TABLE_READERS[table](session)
-            for table in dumpable_tables}
-
 def write_db(data):
     """ Write all tables from memory into DB """
     session = SESSION()
@@ -493,16 +311,382 @@ def write_db(data):
         TABLE_WRITERS[table](session, data[table.__tablename__])
     session.commit()
 
-def dump(filename):
-    """ Read all tables from DB into memory, and write to file """
-    file_ = open(filename, 'w')
-    data = read_db()
-    pickle.dump(data, file_)
-    file_.close()
-
-def load(filename):
-    """ Read all tables from file into memory, and write to DB """
+def load_pickle(filename):
+    """ Read all tables from (old format) file into memory, and write to DB """
     file_ = open(filename, 'r')
     data = pickle.load(file_)
     write_db(data)
     file_.close()
+
+# The streaming dump format is a directory containing:
+# - MANIFEST, a JSON header listing the tables, in load order, with their
+#   columns, row count, and chunks (filename and row count of each)
+# - the chunks, each a gzipped pickle of a list of up to chunk_size rows, as
+#   tuples of column values, in primary key order
+
+DUMP_FORMAT = 'rvr-dump'
+DUMP_VERSION = 1
+MANIFEST = 'manifest.json'
+CHUNK_SIZE = 10000
+
+# StoredRange first, because other tables reference it
+streamed_tables = [StoredRange] + dumpable_tables + [ArchivedGame]
+
+def _in_chunks(rows, chunk_size):
+    """
+    Yield lists of up to chunk_size rows (as tuples)
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(tuple(row))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _write_chunk(dirname, filename, rows):
+    """ Write one chunk of rows to file """
+    file_ = gzip.open(os.path.join(dirname, filename), 'wb')
+    try:
+        cPickle.dump(rows, file_, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        file_.close()
+
+def _read_chunk(dirname, filename):
+    """ Read one chunk of rows from file """
+    file_ = gzip.open(os.path.join(dirname, filename), 'rb')
+    try:
+        return cPickle.load(file_)
+    finally:
+        file_.close()
+
+def _read_manifest(dirname):
+    """ Read and check MANIFEST """
+    with open(os.path.join(dirname, MANIFEST), 'r') as file_:
+        manifest = json.load(file_)
+    if manifest.get('format') != DUMP_FORMAT:
+        raise ValueError("Not a dump: %s" % dirname)
+    if manifest.get('version') != DUMP_VERSION:
+        raise ValueError("Unsupported dump version: %r" %
+                         manifest.get('version'))
+    return manifest
+
+def dump(dirname, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Write all tables from DB to directory <dirname>, chunk_size rows at a
+    time, so that memory use doesn't grow with the size of the database.
+    
+    If specified, progress(tablename, rows_done, rows_total) is called after
+    each chunk (rows_total is None while dumping).
+    
+    MANIFEST is written last, so a dump that was interrupted can't be loaded.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    manifest = {'format': DUMP_FORMAT,
+                'version': DUMP_VERSION,
+                'chunk_size': chunk_size,
+                'tables': []}
+    session = SESSION()
+    try:
+        for cls in streamed_tables:
+            table = cls.__table__
+            query = session.query(*table.columns)  \
+                .order_by(*table.primary_key.columns).yield_per(chunk_size)
+            chunks = []
+            rows_done = 0
+            for index, rows in enumerate(_in_chunks(query, chunk_size)):
+                filename = '%s.%05d.pkl.gz' % (table.name, index)
+                _write_chunk(dirname, filename, rows)
+                chunks.append([filename, len(rows)])
+                rows_done += len(rows)
+                if progress is not None:
+                    progress(table.name, rows_done, None)
+            manifest['tables'].append({
+                'name': table.name,
+                'columns': [column.name for column in table.columns],
+                'rows': rows_done,
+                'chunks': chunks})
+    finally:
+        session.close()
+    temp = os.path.join(dirname, MANIFEST + '.tmp')
+    with open(temp, 'w') as file_:
+        json.dump(manifest, file_, indent=1)
+    os.rename(temp, os.path.join(dirname, MANIFEST))
+
+def _loaded_columns(table, columns):
+    """
+    The (index, name) of each of <columns> (the column names of table in a
+    dump) that table still has. Raises ValueError if table has any other
+    columns that a row can't be inserted without (i.e. columns added since the
+    dump that have no default and can't be null).
+    """
+    missing = [column.name for column in table.columns
+               if column.name not in columns and not column.nullable and
+               column.default is None and column.server_default is None and
+               not (column.primary_key and column.autoincrement)]
+    if missing:
+        raise ValueError("Can't load %s: the dump has no values for "
+                         "column(s) %s, which have no default" %
+                         (table.name, ", ".join(missing)))
+    return [(index, name) for index, name in enumerate(columns)
+            if name in table.c]
+
+def _check_columns(manifest):
+    """
+    Check that every table in MANIFEST can be loaded (see _loaded_columns)
+    before anything is, and log the columns that won't be
+    """
+    for entry in manifest['tables']:
+        table = _streamed_table(entry['name'])
+        _loaded_columns(table, entry['columns'])
+        dropped = [name for name in entry['columns'] if name not in table.c]
+        if dropped:
+            logging.warning("Not loading column(s) %s of %s, which no longer "
+                            "exist", ", ".join(dropped), table.name)
+
+def _is_loaded(session, table, columns, row):
+    """
+    Is this row already in the DB? (Checks primary key only.)
+    """
+    criteria = [column == row[columns.index(column.name)]
+                for column in table.primary_key.columns]
+    return session.query(*table.primary_key.columns)  \
+        .filter(and_(*criteria)).first() is not None
+
+def load_stream(dirname, progress=None):
+    """
+    Write all tables from directory <dirname> (created by dump) into DB, one
+    chunk at a time, using bulk inserts.
+    
+    Each chunk is committed separately. If loading is interrupted, calling
+    this again resumes it, skipping chunks that are already loaded.
+    
+    If specified, progress(tablename, rows_done, rows_total) is called after
+    each chunk.
+    """
+    manifest = _read_manifest(dirname)
+    _check_columns(manifest)
+    for entry in manifest['tables']:
+        _load_table(dirname, entry, resume=True, progress=progress)
+
+def _load_table(dirname, entry, resume, progress=None, session=None):
+    """
+    Write one table (described by <entry> of MANIFEST) into DB, one chunk at a
+    time. If resume, skip chunks that are already loaded.
+    
+    Each chunk is committed separately, unless session is specified, in which
+    case they are all written in that session, and not committed.
+    
+    Returns the number of rows.
+    """
+    table = _streamed_table(entry['name'])
+    columns = entry['columns']
+    loaded = _loaded_columns(table, columns)
+    rows_done = 0
+    for filename, count in entry['chunks']:
+        rows = _read_chunk(dirname, filename)
+        if len(rows) != count:
+            raise ValueError("Expected %d rows in %s, found %d" %
+                             (count, filename, len(rows)))
+        values = [{name: row[index] for index, name in loaded}
+                  for row in rows]
+        if session is not None:
+            session.execute(table.insert(), values)
+        else:
+            with session_scope() as chunk_session:
+                # chunks are in primary key order, and committed whole
+                if not resume or not _is_loaded(chunk_session, table,
+                                                columns, rows[-1]):
+                    chunk_session.execute(table.insert(), values)
+        rows_done += count
+        if progress is not None:
+            progress(table.name, rows_done, entry['rows'])
+    if rows_done != entry['rows']:
+        raise ValueError("Expected %d rows in %s, found %d" %
+                         (entry['rows'], table.name, rows_done))
+    return rows_done
+
+def _streamed_table(tablename):
+    """ The Table called <tablename> """
+    for cls in streamed_tables:
+        if cls.__tablename__ == tablename:
+            return cls.__table__
+    raise ValueError("Unknown table in dump: %s" % tablename)
+
+def _dependency_levels(tables):
+    """
+    Group <tables> (which are in an order they could be loaded in one at a
+    time) so that each table is in a later group than the tables it
+    references. Tables in the same group are independent of each other.
+    
+    References to tables later in <tables> (e.g. from situation to
+    situation_player) are cycles, so they are ignored.
+    """
+    position = {table: index for index, table in enumerate(tables)}
+    levels = {}
+    def level(table):
+        """ 0 if table references nothing, else 1 + its parents' level """
+        if table not in levels:
+            parents = [fk.column.table for fk in table.foreign_keys
+                       if position.get(fk.column.table, -1) >= 0 and
+                       position[fk.column.table] < position[table]]
+            levels[table] = 1 + max([level(parent) for parent in parents]
+                                    + [-1])
+        return levels[table]
+    groups = {}
+    for table in tables:
+        groups.setdefault(level(table), []).append(table)
+    return [groups[key] for key in sorted(groups)]
+
+def _load_level(dirname, entries, level, pool):
+    """
+    Load <level>, a list of independent tables (see _dependency_levels),
+    all or nothing. Returns a list of (tablename, rows, seconds).
+    
+    Without a pool, the level is loaded in one transaction. With one, each
+    table is loaded in its own transaction, in parallel, and if any of them
+    fails, the others are emptied again afterwards.
+    """
+    def load_one(table, session):
+        """ Load table, and time it """
+        start = time.time()
+        rows = _load_table(dirname, entries[table.name], resume=False,
+                           session=session)
+        return (table.name, rows, time.time() - start)
+    if pool is None:
+        with session_scope() as session:
+            return [load_one(table, session) for table in level]
+    def load_alone(table):
+        """ Load table in its own transaction. Returns (result, error). """
+        try:
+            with session_scope() as session:
+                return load_one(table, session), None
+        except Exception as ex:  # pylint:disable=W0703
+            return None, ex
+    # Not pool.map's exception, which it raises as soon as one table fails,
+    # while others may still be loading.
+    outcomes = pool.map(load_alone, level)
+    errors = [error for _, error in outcomes if error is not None]
+    if errors:
+        with session_scope() as session:
+            for table in reversed(level):
+                session.execute(table.delete())
+        raise errors[0]
+    return [result for result, _ in outcomes]
+
+def restore(dirname, parallelism=4):
+    """
+    Write all tables from directory <dirname> (created by dump) into a new,
+    empty DB, loading up to <parallelism> independent tables at a time.
+    
+    Tables are loaded in dependency order (e.g. game history items once all
+    of game_history_base is committed), a level at a time, each level all or
+    nothing (see _load_level). Indexes are dropped during the load and
+    created afterwards.
+    
+    SQLite only lets one transaction write at a time, so there, tables are
+    loaded one at a time regardless of parallelism.
+    
+    Unlike load_stream, this can't be resumed. If it fails, start again with
+    a new DB.
+    
+    Returns a list of (tablename, rows, seconds), in the order loaded.
+    """
+    manifest = _read_manifest(dirname)
+    _check_columns(manifest)
+    entries = {entry['name']: entry for entry in manifest['tables']}
+    tables = [_streamed_table(entry['name']) for entry in manifest['tables']]
+    with session_scope() as session:
+        for table in tables:
+            if session.query(*table.primary_key.columns).first() is not None:
+                raise ValueError("Can't restore into a database that isn't "
+                                 "empty. Table %s has rows." % table.name)
+        if session.bind.dialect.name == 'sqlite':
+            parallelism = 1
+        indexes = [index for table in tables for index in table.indexes]
+        for index in indexes:
+            index.drop(session.connection())
+    results = []
+    pool = ThreadPool(parallelism) if parallelism > 1 else None
+    try:
+        for level in _dependency_levels(tables):
+            results.extend(_load_level(dirname, entries, level, pool))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        with session_scope() as session:
+            for index in indexes:
+                index.create(session.connection())
+    return results
+
+def load(path, progress=None):
+    """
+    Load a dump into the DB: either a directory (created by dump), or a file
+    created by the dump of an older version.
+    """
+    if os.path.isdir(path):
+        load_stream(path, progress)
+    else:
+        load_pickle(path)
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    @staticmethod
+    def _write_dump(dirname, tablename, columns, rows):
+        """ Write a dump of just one table """
+        _write_chunk(dirname, 'chunk.pkl.gz', rows)
+        manifest = {'format': DUMP_FORMAT,
+                    'version': DUMP_VERSION,
+                    'chunk_size': CHUNK_SIZE,
+                    'tables': [{'name': tablename,
+                                'columns': columns,
+                                'rows': len(rows),
+                                'chunks': [['chunk.pkl.gz', len(rows)]]}]}
+        with open(os.path.join(dirname, MANIFEST), 'w') as file_:
+            json.dump(manifest, file_)
+
+    def test_changed_columns(self):
+        """
+        Test loading a dump taken before columns were added to and removed
+        from a table
+        """
+        from rvr.core.fixture import ephemeral_db
+        import datetime
+        import shutil
+        import tempfile
+        dirname = tempfile.mkdtemp()
+        try:
+            # no next_hh (added since, with a default), and an obsolete column
+            self._write_dump(dirname, 'running_game',
+                ['gameid', 'situationid', 'current_userid', 'board_raw',
+                 'current_round', 'pot_pre', 'increment', 'bet_count',
+                 'current_factor', 'last_action_time', 'version',
+                 'obsolete'],
+                [(1, 1, None, '', 'preflop', 0, 2, 0, 1.0,
+                  datetime.datetime(2014, 1, 1), 1, 'gone')])
+            with ephemeral_db():
+                restore(dirname)
+                with session_scope() as session:
+                    game = session.query(RunningGame).one()
+                    self.assertEqual(game.next_hh, 0)
+                    self.assertEqual(game.current_round, 'preflop')
+            # no unsubscribed (added since, with no default)
+            self._write_dump(dirname, 'user',
+                ['userid', 'identity', 'screenname', 'email'],
+                [(1, 'x', 'x', 'x@example.com')])
+            with ephemeral_db():
+                self.assertRaises(ValueError, restore, dirname)
+                self.assertRaises(ValueError, load_stream, dirname)
+                with session_scope() as session:
+                    self.assertEqual(session.query(User).count(), 0)
+        finally:
+            shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""
+Loading of game history items
+"""
+from sqlalchemy import and_
+from rvr.db.tables import GameHistoryBase, GameHistoryUserRange,  \
+    GameHistoryRangeAction, GameHistoryActionResult, GameHistoryBoard,  \
+    GameHistoryTimeout
+
+HISTORY_CHILD_TABLES = [GameHistoryUserRange,
+                        GameHistoryRangeAction,
+                        GameHistoryActionResult,
+                        GameHistoryBoard,
+                        GameHistoryTimeout]
+
+def load_history_items(session, gameid, since=None):
+    """
+    Return the hand history items (GameHistoryUserRange, etc.) of game
+    <gameid>, in order, using a single query. If <since> is specified, return
+    only items with order >= since.
+    """
+    query = session.query(GameHistoryBase, *HISTORY_CHILD_TABLES)
+    for table in HISTORY_CHILD_TABLES:
+        query = query.outerjoin(table,
+                                and_(table.gameid == GameHistoryBase.gameid,
+                                     table.order == GameHistoryBase.order))
+    query = query.filter(GameHistoryBase.gameid == gameid)
+    if since is not None:
+        query = query.filter(GameHistoryBase.order >= since)
+    query = query.order_by(GameHistoryBase.order)
+    items = []
+    for row in query.all():
+        children = [child for child in row[1:] if child is not None]
+        items.extend(children)
+    return items
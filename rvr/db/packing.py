@@ -0,0 +1,132 @@
+"""
+Packed storage of the per-combo results of an analysed spot, so that all of
+the AnalysisFoldEquityItems of an AnalysisFoldEquity can be stored in (and
+read from) a single column of a single row.
+
+The format is a set of parallel arrays, indexed by comboid (see
+cards.combo_id):
+- role: one byte per combo, a bitmask of AGGRESSIVE, PASSIVE, FOLD, or 0 if
+  the combo was not in the bettor's range
+- fold_ratio, immediate_result, semibluff_ev, semibluff_equity: one
+  little-endian single-precision float per combo, NaN for None
+preceded by a version byte, and compressed with zlib.
+"""
+import math
+import struct
+import zlib
+import unittest
+from rvr.poker.cards import COMBO_COUNT
+
+PACKING_VERSION = 1
+
+AGGRESSIVE = 1
+PASSIVE = 2
+FOLD = 4
+
+_HEADER = struct.Struct('<B')
+_ROLES = struct.Struct('<%dB' % COMBO_COUNT)
+_FLOATS = struct.Struct('<%df' % COMBO_COUNT)
+
+#pylint:disable=R0903
+
+def _role(afei):
+    """
+    Role bitmask of an AnalysisFoldEquityItem
+    """
+    return (AGGRESSIVE if afei.is_aggressive else 0) |  \
+        (PASSIVE if afei.is_passive else 0) |  \
+        (FOLD if afei.is_fold else 0)
+
+def _float(value):
+    """
+    None -> NaN
+    """
+    return float('nan') if value is None else value
+
+def _optional(value):
+    """
+    NaN -> None
+    """
+    return None if math.isnan(value) else value
+
+def pack_fold_equity_items(afeis):
+    """
+    Pack AnalysisFoldEquityItems (of one AnalysisFoldEquity) into a string
+    """
+    roles = [0] * COMBO_COUNT
+    columns = [[0.0] * COMBO_COUNT for _ in range(4)]
+    for afei in afeis:
+        roles[afei.comboid] = _role(afei)
+        columns[0][afei.comboid] = afei.fold_ratio
+        columns[1][afei.comboid] = afei.immediate_result
+        columns[2][afei.comboid] = _float(afei.semibluff_ev)
+        columns[3][afei.comboid] = _float(afei.semibluff_equity)
+    data = _HEADER.pack(PACKING_VERSION) + _ROLES.pack(*roles) +  \
+        ''.join(_FLOATS.pack(*column) for column in columns)
+    return zlib.compress(data)
+
+def unpack_fold_equity_items(packed):
+    """
+    Unpack a string created by pack_fold_equity_items, returning a list of
+    (comboid, is_aggressive, is_passive, is_fold, fold_ratio,
+    immediate_result, semibluff_ev, semibluff_equity), in comboid order.
+    """
+    data = zlib.decompress(packed)
+    version, = _HEADER.unpack_from(data)
+    if version != PACKING_VERSION:
+        raise ValueError("Unsupported packing version: %d" % version)
+    offset = _HEADER.size
+    roles = _ROLES.unpack_from(data, offset)
+    offset += _ROLES.size
+    columns = []
+    for _ in range(4):
+        columns.append(_FLOATS.unpack_from(data, offset))
+        offset += _FLOATS.size
+    fold_ratios, immediate_results, semibluff_evs, semibluff_equities =  \
+        columns
+    return [(comboid,
+             bool(role & AGGRESSIVE),
+             bool(role & PASSIVE),
+             bool(role & FOLD),
+             fold_ratios[comboid],
+             immediate_results[comboid],
+             _optional(semibluff_evs[comboid]),
+             _optional(semibluff_equities[comboid]))
+            for comboid, role in enumerate(roles)
+            if role]
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    class Item(object):
+        """ Stands in for AnalysisFoldEquityItem """
+        def __init__(self, comboid, is_aggressive, is_passive, is_fold,
+                     fold_ratio, immediate_result, semibluff_ev,
+                     semibluff_equity):
+            self.comboid = comboid
+            self.is_aggressive = is_aggressive
+            self.is_passive = is_passive
+            self.is_fold = is_fold
+            self.fold_ratio = fold_ratio
+            self.immediate_result = immediate_result
+            self.semibluff_ev = semibluff_ev
+            self.semibluff_equity = semibluff_equity
+
+    def test_round_trip(self):
+        """ Test pack_fold_equity_items and unpack_fold_equity_items """
+        rows = [(0, True, False, False, 0.5, -2.5, None, None),
+                (7, False, True, False, 0.25, 1.0, 3.0, 0.125),
+                (COMBO_COUNT - 1, False, False, True, 1.0, 10.0, -0.5, None)]
+        packed = pack_fold_equity_items(Test.Item(*row)
+                                        for row in reversed(rows))
+        self.assertEqual(unpack_fold_equity_items(packed), rows)
+
+    def test_empty(self):
+        """ Test packing no items """
+        packed = pack_fold_equity_items([])
+        self.assertEqual(unpack_fold_equity_items(packed), [])
+
+if __name__ == '__main__':
+    unittest.main()
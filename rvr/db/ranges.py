@@ -0,0 +1,192 @@
+"""
+Content-addressed storage of range descriptions.
+
+Ranges are stored once each in the stored_range table, keyed by rangeid, a
+hash of the range's description. Tables that store ranges reference them by
+rangeid, through range_property(), which also remembers descriptions set on
+the object. When the object is flushed, any of those that aren't already in
+stored_range are inserted. Once the transaction is committed or rolled back,
+the object forgets them again, and its descriptions are loaded through the
+relationship.
+
+The descriptions we store are produced by weighted_options_to_description
+(or are ANYTHING or NOTHING), so the same range has the same description,
+and therefore the same rangeid, wherever it occurs.
+"""
+from collections import OrderedDict
+import hashlib
+import struct
+import threading
+import unittest
+from sqlalchemy import event, select
+from rvr.db.creation import SESSION, BASE
+from rvr.poker.handrange import HandRange
+
+#pylint:disable=R0903
+
+MAX_PARSED_RANGES = 10000
+
+_PARSED_RANGES = OrderedDict()  # rangeid -> HandRange, least recent first
+_PARSED_RANGES_LOCK = threading.Lock()
+
+def range_id(description):
+    """
+    The rangeid of a range description: the first 63 bits of its SHA-1, so
+    that it fits a (signed) BigInteger column.
+    """
+    digest = hashlib.sha1(str(description)).digest()
+    return struct.unpack('>Q', digest[:8])[0] >> 1
+
+def parsed_range(rangeid, description):
+    """
+    HandRange(description), cached by rangeid. Treat it as read-only.
+
+    Least recently used entries are discarded once there are more than
+    MAX_PARSED_RANGES.
+    """
+    with _PARSED_RANGES_LOCK:
+        hand_range = _PARSED_RANGES.pop(rangeid, None)
+        if hand_range is not None:
+            _PARSED_RANGES[rangeid] = hand_range  # now most recently used
+            return hand_range
+    hand_range = HandRange(description)
+    with _PARSED_RANGES_LOCK:
+        _PARSED_RANGES.pop(rangeid, None)
+        _PARSED_RANGES[rangeid] = hand_range
+        while len(_PARSED_RANGES) > MAX_PARSED_RANGES:
+            _PARSED_RANGES.popitem(last=False)
+    return hand_range
+
+def range_property(id_attr, relationship_attr):
+    """
+    A property for a range description, stored as a reference to
+    stored_range. <id_attr> is the name of the rangeid column, and
+    <relationship_attr> the name of a (viewonly, preferably eager loaded)
+    relationship to the StoredRange.
+    """
+    def getter(self):
+        """
+        Get range description
+        """
+        rangeid = getattr(self, id_attr)
+        new_ranges = self.__dict__.get('_new_ranges')
+        if new_ranges and rangeid in new_ranges:
+            return new_ranges[rangeid]
+        if rangeid is None:
+            return None
+        return getattr(self, relationship_attr).description
+    def setter(self, description):
+        """
+        Set range description
+        """
+        rangeid = range_id(description)
+        self.__dict__.setdefault('_new_ranges', {})[rangeid] = description
+        setattr(self, id_attr, rangeid)
+    return property(getter, setter)
+
+@event.listens_for(SESSION, "before_flush")
+def _insert_new_ranges(session, _flush_context, _instances):
+    """
+    Insert into stored_range whatever ranges (set via range_property) are not
+    already there.
+    """
+    new_ranges = {}
+    holders = session.info.setdefault('range_holders', {})
+    for obj in list(session.new) + list(session.dirty):
+        if obj.__dict__.get('_new_ranges'):
+            new_ranges.update(obj.__dict__['_new_ranges'])
+            holders[id(obj)] = obj
+    if not new_ranges:
+        return
+    table = BASE.metadata.tables['stored_range']
+    existing = set(rangeid for rangeid, in session.execute(
+        select([table.c.rangeid]).where(table.c.rangeid.in_(new_ranges))))
+    missing = [{'rangeid': rangeid, 'description': description}
+               for rangeid, description in new_ranges.iteritems()
+               if rangeid not in existing]
+    if missing:
+        session.execute(table.insert(), missing)
+
+def _forget_new_ranges(session):
+    """
+    Make the objects flushed by session forget the descriptions set on them
+    """
+    for obj in session.info.pop('range_holders', {}).itervalues():
+        obj.__dict__.pop('_new_ranges', None)
+
+@event.listens_for(SESSION, "after_commit")
+def _after_commit(session):
+    """
+    Forget new ranges, if it's the outermost transaction that has been
+    committed (rather than a savepoint). They're in stored_range now, and the
+    objects have been expired, so they'll be loaded from there.
+    """
+    if session.transaction is not None and session.transaction.nested:
+        return
+    _forget_new_ranges(session)
+
+@event.listens_for(SESSION, "after_rollback")
+def _after_rollback(session):
+    """
+    Forget new ranges, if it's the outermost transaction that has been rolled
+    back (rather than a savepoint). The objects have been expired or
+    expunged, so the descriptions no longer apply.
+    """
+    if session.transaction is not None and session.transaction.nested:
+        return
+    _forget_new_ranges(session)
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_range_id(self):
+        """ Test range_id """
+        self.assertEqual(range_id("AA"), range_id(u"AA"))
+        self.assertNotEqual(range_id("AA"), range_id("KK"))
+        self.assertTrue(0 <= range_id("anything") < 2 ** 63)
+
+    def test_parsed_range(self):
+        """ Test parsed_range """
+        first = parsed_range(range_id("AA,KK"), "AA,KK")
+        self.assertEqual(first.description, "AA,KK")
+        self.assertIs(parsed_range(range_id("AA,KK"), "AA,KK"), first)
+
+    def test_parsed_range_lru(self):
+        """ Test that the least recently used parsed range is discarded """
+        global MAX_PARSED_RANGES  # pylint:disable=W0603
+        saved, MAX_PARSED_RANGES = MAX_PARSED_RANGES, 2
+        try:
+            aces = parsed_range(range_id("AA"), "AA")
+            kings = parsed_range(range_id("KK"), "KK")
+            parsed_range(range_id("AA"), "AA")
+            parsed_range(range_id("QQ"), "QQ")
+            self.assertEqual(len(_PARSED_RANGES), 2)
+            self.assertIs(parsed_range(range_id("AA"), "AA"), aces)
+            self.assertIsNot(parsed_range(range_id("KK"), "KK"), kings)
+        finally:
+            MAX_PARSED_RANGES = saved
+
+    def test_new_ranges_forgotten(self):
+        """ Test that new ranges are forgotten on commit and rollback """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import session_scope
+        from rvr.db.tables import RunningGameParticipant
+        with game_db(users=2, games=1):
+            with session_scope() as session:
+                rgp = session.query(RunningGameParticipant).first()
+                rgp.range_raw = "AA"
+                session.commit()
+                self.assertNotIn('_new_ranges', rgp.__dict__)
+                self.assertEqual(rgp.range_raw, "AA")
+                self.assertNotIn('range_holders', session.info)
+                rgp.range_raw = "KK"
+                session.flush()
+                session.rollback()
+                self.assertNotIn('_new_ranges', rgp.__dict__)
+                self.assertEqual(rgp.range_raw, "AA")
+                self.assertNotIn('range_holders', session.info)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,68 @@
 """
 Declares database tables
 """
-from sqlalchemy import Column, Integer, String, Boolean, Sequence, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Sequence, ForeignKey,  \
+    BigInteger
 from sqlalchemy.orm import relationship, backref
-from rvr.db.creation import BASE
-from sqlalchemy.types import Float, Numeric, DateTime
+from rvr.db.creation import BASE, partial_index
+from sqlalchemy.types import Float, Numeric, DateTime, LargeBinary
 from rvr.poker.cards import Card
 from rvr.poker.handrange import HandRange, weighted_options_to_description
-from sqlalchemy.orm.session import object_session
+from sqlalchemy.orm.exc import NoResultFound
+from rvr.db.ranges import range_property, parsed_range
+import unittest
 
 #pylint:disable=W0232,R0903
 
 # TODO: REVISIT: do strings need fixed lengths?
 
+class StoredRange(BASE):
+    """
+    A range description, stored once however many times it's used. See
+    rvr.db.ranges.
+    """
+    __tablename__ = 'stored_range'
+    rangeid = Column(BigInteger, primary_key=True, autoincrement=False)
+    # longest possible range = 6,629 chars
+    description = Column(String, nullable=False)
+
+def _memoised(obj, raw_attr, parse):
+    """
+    parse(value of obj's raw_attr), cached on obj for as long as that value is
+    unchanged. Treat the result as read-only.
+    """
+    raw = getattr(obj, raw_attr)
+    cached = obj.__dict__.get('_parsed', {}).get(raw_attr)
+    if cached is not None and cached[0] == raw:
+        return cached[1]
+    value = parse(raw)
+    _remember(obj, raw_attr, value)
+    return value
+
+def _remember(obj, raw_attr, value):
+    """
+    Cache value as the parsed value of obj's (current) raw_attr, per _memoised
+    """
+    obj.__dict__.setdefault('_parsed', {})[raw_attr] =  \
+        (getattr(obj, raw_attr), value)
+
+def _range_description(range_):
+    """
+    Description of HandRange range_, as produced by
+    weighted_options_to_description
+    """
+    if range_.is_canonical:
+        return range_.description
+    return weighted_options_to_description(range_.generate_options())
+
+def _stored_range(id_column):
+    """
+    Eager loaded relationship to the StoredRange referenced by id_column
+    """
+    return relationship("StoredRange", foreign_keys=[id_column],
+                        primaryjoin=id_column == StoredRange.rangeid,
+                        lazy='joined', viewonly=True)
+
 class User(BASE):
     """
     A user of the application.
@@ -54,13 +104,12 @@ class SituationPlayer(BASE, object):
         """
         Get range, as HandRange instance
         """
-        return HandRange(self.range_raw)
+        return _memoised(self, 'range_raw', HandRange)
     def set_range(self, range_):
         """
         Set range, from HandRange instance
         """
-        self.range_raw =  \
-            weighted_options_to_description(range_.generate_options())
+        self.range_raw = _range_description(range_)
     range = property(get_range, set_range)    
 
 class Situation(BASE):
@@ -145,20 +194,32 @@ class RunningGame(BASE, object):
     current_factor = Column(Float, nullable=False)
     # keeping track of timeouts
     last_action_time = Column(DateTime, nullable=False)  # or game start time
+    # incremented by every update, which fails if someone else has updated
+    # the game since we read it (sqlalchemy.orm.exc.StaleDataError)
+    version = Column(Integer, nullable=False)
+    # for finding games where the current player has timed out: only games
+    # that are still running, because finished games (most of them) have old
+    # last_action_times too
+    __table_args__ = (partial_index('ix_running_game_timeout',
+                                    last_action_time,
+                                    where=current_userid != None),)
+    __mapper_args__ = {'version_id_col': version}
     # TODO: 3: a flag to mark completed game as "completed with no timeouts"
     # in lieu of a relationship...
     # TODO: REVISIT: can we do this with a one-to-one relationship?
     # ... and not cause circular reference issues?!
     def get_current_rgp(self):
         """
-        Get current RunningGameParticipant, from current_userid
+        Get current RunningGameParticipant, from current_userid, via rgps (so
+        there's no query if they're already loaded)
         """
         if self.current_userid is None:
             return None
-        session = object_session(self)
-        return session.query(RunningGameParticipant)  \
-            .filter(RunningGameParticipant.userid == self.current_userid)  \
-            .filter(RunningGameParticipant.gameid == self.gameid).one()
+        for rgp in self.rgps:
+            if rgp.userid == self.current_userid:
+                return rgp
+        raise NoResultFound("No participant with current_userid %r in game %r"
+                            % (self.current_userid, self.gameid))
     def set_current_rgp(self, rgp):
         """
         Set current_userid, from RunningGameParticipant 
@@ -170,12 +231,13 @@ class RunningGame(BASE, object):
         """
         Get board, as list of Card
         """
-        return Card.many_from_text(self.board_raw)
+        return list(_memoised(self, 'board_raw', Card.many_from_text))
     def set_board(self, cards):
         """
         Set board, from list of Card
         """
         self.board_raw = ''.join([card.to_mnemonic() for card in cards])
+        _remember(self, 'board_raw', list(cards))
     board = property(get_board, set_board)
     def get_is_finished(self):
         """
@@ -205,7 +267,8 @@ class RunningGameParticipant(BASE, object):
     # game state
     stack = Column(Integer, nullable=False)
     contributed = Column(Integer, nullable=False)
-    range_raw = Column(String, nullable=False)
+    rangeid = Column(BigInteger, ForeignKey("stored_range.rangeid"),
+                     nullable=False)
     left_to_act = Column(Boolean, nullable=False)
     folded = Column(Boolean, nullable=False)
     # note importantly, this is a secret from the user!
@@ -214,29 +277,34 @@ class RunningGameParticipant(BASE, object):
     user = relationship("User", backref="rgps")
     game = relationship("RunningGame", backref=backref("rgps", cascade="all"),
         primaryjoin="RunningGame.gameid==RunningGameParticipant.gameid")
+    stored_range = _stored_range(rangeid)
     # attributes
+    range_raw = range_property('rangeid', 'stored_range')
     def get_range(self):
         """
         Get range, as HandRange instance
         """
-        return HandRange(self.range_raw)
+        return _memoised(self, 'rangeid',
+                         lambda rangeid: parsed_range(rangeid, self.range_raw))
     def set_range(self, range_):
         """
         Set range, from HandRange instance
         """
-        self.range_raw = weighted_options_to_description(
-            range_.generate_options())
+        self.range_raw = _range_description(range_)
+        if range_.is_canonical:
+            _remember(self, 'rangeid', range_)
     range = property(get_range, set_range)
     def get_cards_dealt(self):
         """
         Get cards dealt, as list of two Card
         """
-        return Card.many_from_text(self.cards_dealt_raw)
+        return list(_memoised(self, 'cards_dealt_raw', Card.many_from_text))
     def set_cards_dealt(self, cards):
         """
         Set cards dealt, from list of two Card
         """
         self.cards_dealt_raw = ''.join([card.to_mnemonic() for card in cards])
+        _remember(self, 'cards_dealt_raw', list(cards))
     cards_dealt = property(get_cards_dealt, set_cards_dealt)
 
 class GameHistoryBase(BASE):
@@ -265,13 +333,16 @@ class GameHistoryUserRange(BASE):
     order = Column(Integer, ForeignKey("game_history_base.order"),
                    primary_key=True)
     userid = Column(Integer, ForeignKey("user.userid"), nullable=False)
-    # longest possible range = 6,629 chars
-    range_raw = Column(String, nullable=False)
+    rangeid = Column(BigInteger, ForeignKey("stored_range.rangeid"),
+                     nullable=False)
 
     hh_base = relationship("GameHistoryBase", primaryjoin=  \
         "and_(GameHistoryBase.gameid==GameHistoryUserRange.gameid," +  \
         " GameHistoryBase.order==GameHistoryUserRange.order)")
     user = relationship("User")
+    stored_range = _stored_range(rangeid)
+    
+    range_raw = range_property('rangeid', 'stored_range')
     
 class GameHistoryActionResult(BASE):
     """
@@ -308,9 +379,13 @@ class GameHistoryRangeAction(BASE):
     order = Column(Integer, ForeignKey("game_history_base.order"),
                    primary_key=True)
     userid = Column(Integer, ForeignKey("user.userid"), nullable=False)
-    fold_range = Column(String, nullable=False)
-    passive_range = Column(String, nullable=False)
-    aggressive_range = Column(String, nullable=False)
+    fold_rangeid = Column(BigInteger, ForeignKey("stored_range.rangeid"),
+                          nullable=False)
+    passive_rangeid = Column(BigInteger, ForeignKey("stored_range.rangeid"),
+                             nullable=False)
+    aggressive_rangeid = Column(BigInteger,
+                                ForeignKey("stored_range.rangeid"),
+                                nullable=False)
     raise_total = Column(Integer, nullable=False)
     # For syntactical context, call or check, bet or raise:
     is_check = Column(Boolean, nullable=False)
@@ -320,6 +395,14 @@ class GameHistoryRangeAction(BASE):
         "and_(GameHistoryBase.gameid==GameHistoryRangeAction.gameid," +  \
         " GameHistoryBase.order==GameHistoryRangeAction.order)")
     user = relationship("User")
+    stored_fold_range = _stored_range(fold_rangeid)
+    stored_passive_range = _stored_range(passive_rangeid)
+    stored_aggressive_range = _stored_range(aggressive_rangeid)
+    
+    fold_range = range_property('fold_rangeid', 'stored_fold_range')
+    passive_range = range_property('passive_rangeid', 'stored_passive_range')
+    aggressive_range = range_property('aggressive_rangeid',
+                                      'stored_aggressive_range')
 
 class GameHistoryBoard(BASE):
     """
@@ -380,10 +463,11 @@ class RangeItem(BASE):
     Note: these are singletons, defined once and used everywhere.
     
     This table doesn't achieve much, except to ensure uniqueness within a range.
+    
+    Combos are identified by cards.combo_id, 0 to 1325.
     """
     __tablename__ = "range_item"
-    higher_card = Column(String, primary_key=True)
-    lower_card = Column(String, primary_key=True)
+    comboid = Column(Integer, primary_key=True, autoincrement=False)
 
 class AnalysisFoldEquity(BASE):
     """
@@ -408,6 +492,9 @@ class AnalysisFoldEquity(BASE):
     bet_cost = Column(Integer, nullable=False)
     raise_total = Column(Integer, nullable=False)
     pot_if_called = Column(Integer, nullable=False)
+    # If not None, this spot's items are packed in here (see rvr.db.packing)
+    # instead of being stored in AnalysisFoldEquityItem.
+    packed_items = Column(LargeBinary, nullable=True)
 
 class AnalysisFoldEquityItem(BASE):
     """
@@ -419,10 +506,8 @@ class AnalysisFoldEquityItem(BASE):
                     primary_key=True)
     order = Column(Integer, ForeignKey("analysis_fold_equity.order"),
                    primary_key=True)
-    higher_card = Column(String, ForeignKey("range_item.higher_card"),
-                         primary_key=True)
-    lower_card = Column(String, ForeignKey("range_item.lower_card"),
-                        primary_key=True)
+    comboid = Column(Integer, ForeignKey("range_item.comboid"),
+                     primary_key=True, autoincrement=False)
     is_aggressive = Column(Boolean, nullable=False)
     is_passive = Column(Boolean, nullable=False)
     is_fold = Column(Boolean, nullable=False)
@@ -432,18 +517,48 @@ class AnalysisFoldEquityItem(BASE):
         primaryjoin="and_(AnalysisFoldEquityItem.gameid"
         "==AnalysisFoldEquity.gameid,AnalysisFoldEquityItem.order"
         "==AnalysisFoldEquity.order)")
-    range_item = relationship("RangeItem",
-        primaryjoin="and_(AnalysisFoldEquityItem.higher_card"
-        "==RangeItem.higher_card,AnalysisFoldEquityItem.lower_card"
-        "==RangeItem.lower_card)")
+    range_item = relationship("RangeItem")
     # Relevant columns
-    fold_ratio = Column(Numeric, nullable=False)
-    immediate_result = Column(Numeric, nullable=False)
+    # Single precision is plenty for these, and much smaller than Numeric.
+    fold_ratio = Column(Float(precision=24), nullable=False)
+    immediate_result = Column(Float(precision=24), nullable=False)
     # These next two can be negative, but if so we won't show them to the user.
     # Example: a bluff here wins 1.0 chips, and requires -0.3 chips EV to
     # semibluff, or -8.0% equity when called.
-    semibluff_ev = Column(Numeric, nullable=True)
-    semibluff_equity = Column(Numeric, nullable=True)
+    semibluff_ev = Column(Float(precision=24), nullable=True)
+    semibluff_equity = Column(Float(precision=24), nullable=True)
+
+class GameHistorySnapshot(BASE):
+    """
+    The complete history (including analysis) of a finished game, as seen by
+    anyone, serialised once so it can be loaded in a single read.
+    
+    This is derived data. It can be deleted at any time, and will be recreated
+    by the next analysis run.
+    """
+    __tablename__ = "game_history_snapshot"
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+    # next_hh of the game when the snapshot was taken
+    next_hh = Column(Integer, nullable=False)
+    # format of data, so that old snapshots can be recognised and replaced
+    version = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+class ArchivedGame(BASE):
+    """
+    The game history and analysis rows of an old finished game, moved out of
+    their own tables. See rvr.db.archive.
+    
+    Unlike GameHistorySnapshot, this is the only copy of that data.
+    """
+    __tablename__ = "archived_game"
+    gameid = Column(Integer, ForeignKey("running_game.gameid"),
+                    primary_key=True)
+    archived_time = Column(DateTime, nullable=False)
+    # compressed pickle of (format, {tablename: (column names, rows)}), see
+    # rvr.db.archive.ARCHIVE_FORMAT
+    data = Column(LargeBinary, nullable=False)
 
 # class AnalysisFloat(BASE):
 #     """
@@ -501,3 +616,22 @@ class AnalysisFoldEquityItem(BASE):
 #     """
 #     EV and equity of an individual hand in a raise range on the river.
 #     """
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_current_rgp(self):
+        """ Test that current_rgp comes from rgps, without a query """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import session_scope, count_queries
+        with game_db(users=2, games=1) as (_, _, (gameid,)):
+            with session_scope() as session:
+                game = session.query(RunningGame)  \
+                    .filter(RunningGame.gameid == gameid).one()
+                self.assertEqual(len(game.rgps), 2)
+                with count_queries() as queries:
+                    rgp = game.current_rgp
+                self.assertEqual(queries.count, 0)
+                self.assertEqual(rgp.userid, game.current_userid)
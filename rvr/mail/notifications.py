@@ -3,10 +3,10 @@ For sending email to users, like telling them it's their turn to act in a game.
 """
 from flask_mail import Message
 from flask.templating import render_template
-from flask import copy_current_request_context
+from flask import copy_current_request_context, has_app_context, current_app
 from rvr.app import MAIL, make_unsubscribe_url, make_game_url
 from threading import Thread
-from functools import wraps
+from functools import wraps, partial
 
 #pylint:disable=R0903,R0913
 
@@ -46,6 +46,23 @@ def send_email(msg):
     else:
         MAIL.send(msg)
 
+def copy_app_context(fun):
+    """
+    Wrap fun so that it runs in the current Flask app context (if any), so that
+    notifications can be sent when it is called on a different thread.
+    """
+    if not has_app_context():
+        return fun
+    app = current_app._get_current_object()  # pylint:disable=W0212
+    @wraps(fun)
+    def inner(*args, **kwargs):
+        """
+        Run fun in app's context
+        """
+        with app.app_context():
+            return fun(*args, **kwargs)
+    return inner
+
 def web_only(fun):
     """
     Decorator to ensure something only happens when in a web context.
@@ -63,7 +80,7 @@ def web_only(fun):
     return inner
 
 @web_only
-def _your_turn(recipient, screenname, identity, game):
+def _your_turn(recipient, screenname, identity, gameid):
     """
     Lets recipient know it's their turn in a game.
 
@@ -74,76 +91,96 @@ def _your_turn(recipient, screenname, identity, game):
     Uses Flask-Mail; sends asynchronously.
     """
     msg = Message("It's your turn in Game %d on Range vs. Range" %
-                  (game.gameid,))
+                  (gameid,))
     msg.add_recipient(recipient)
     msg.html = render_template('email/your_turn.html', recipient=recipient,
                                screenname=screenname,
                                unsubscribe=make_unsubscribe_url(identity),
-                               game_url=make_game_url(str(game.gameid)),
-                               gameid=game.gameid)
+                               game_url=make_game_url(str(gameid)),
+                               gameid=gameid)
     send_email(msg)
 
 @web_only
 def _game_started(recipient, screenname, identity, is_starter, is_acting,
-                  game):
+                  gameid):
     """
     Lets recipient know their game has started.
     """
     msg = Message("Game %d has started on Range vs. Range" %
-                  (game.gameid,))
+                  (gameid,))
     msg.add_recipient(recipient)
     msg.html = render_template('email/game_started.html',
         recipient=recipient, screenname=screenname, is_starter=is_starter,
         is_acting=is_acting, unsubscribe=make_unsubscribe_url(identity),
-        game_url=make_game_url(str(game.gameid)), gameid=game.gameid)
+        game_url=make_game_url(str(gameid)), gameid=gameid)
     send_email(msg)
 
 @web_only
-def _game_finished(recipient, screenname, identity, game):
+def _game_finished(recipient, screenname, identity, gameid):
     """
     Lets recipient know their game has finished and analysis is ready.
     """
     msg = Message("Analysis for Game %d on Range vs. Range" %
-                  (game.gameid,))
+                  (gameid,))
     msg.add_recipient(recipient)
     msg.html = render_template('email/game_complete.html',
         recipient=recipient, screenname=screenname,
         unsubscribe=make_unsubscribe_url(identity),
-        game_url=make_game_url(str(game.gameid)), gameid=game.gameid)
+        game_url=make_game_url(str(gameid)), gameid=gameid)
     send_email(msg)
 
+# The notify_* functions below read what they need from the game straight
+# away, but return a function that sends the emails, so that they can be sent
+# once the change to the game has been committed (see
+# rvr.db.creation.after_commit), and not by an attempt that is rolled back.
+
+def _send_all(sends):
+    """
+    A function that calls all of <sends>
+    """
+    def send():
+        """
+        Call them all
+        """
+        for fun in sends:
+            fun()
+    return send
+
 def notify_current_player(game):
     """
     If the game is not finished, notify the current player that it's their
     turn to act (i.e. via email).
     """
     if game.current_userid == None:
-        return
+        return _send_all([])
     user = game.current_rgp.user
-    _your_turn(recipient=user.email,
-               screenname=user.screenname,
-               identity=user.identity,
-               game=game)
+    return partial(_your_turn,
+                   recipient=user.email,
+                   screenname=user.screenname,
+                   identity=user.identity,
+                   gameid=game.gameid)
 
 def notify_first_player(game, starter_id):
     """
     If the game is not finished, notify the current player that it's their
     turn to act (i.e. via email).
     """
-    for rgp in game.rgps:
-        _game_started(recipient=rgp.user.email,
-                      screenname=rgp.user.screenname,
-                      identity=rgp.user.identity,
-                      is_starter=(rgp.userid==starter_id),
-                      is_acting=(rgp.userid==game.current_userid),
-                      game=game)
+    return _send_all([partial(_game_started,
+                              recipient=rgp.user.email,
+                              screenname=rgp.user.screenname,
+                              identity=rgp.user.identity,
+                              is_starter=(rgp.userid==starter_id),
+                              is_acting=(rgp.userid==game.current_userid),
+                              gameid=game.gameid)
+                      for rgp in game.rgps])
 
 def notify_finished(game):
     """
     Notify everyone their game is finished.
     """
-    for rgp in game.rgps:
-        _game_finished(recipient=rgp.user.email,
-                       screenname=rgp.user.screenname,
-                       identity=rgp.user.identity,
-                       game=game)
+    return _send_all([partial(_game_finished,
+                              recipient=rgp.user.email,
+                              screenname=rgp.user.screenname,
+                              identity=rgp.user.identity,
+                              gameid=game.gameid)
+                      for rgp in game.rgps])
@@ -4,7 +4,8 @@ action functionality, imported from the previous versions
 from rvr.poker.cards import Card, FLOP, PREFLOP, RIVER, TURN
 import unittest
 from rvr.poker.handrange import HandRange,  \
-    _cmp_weighted_options, _cmp_options
+    _cmp_weighted_options, _cmp_options, board_mask, mask_comboids,  \
+    COMBO_HANDS
 from rvr.infrastructure.util import concatenate
 from rvr.core.dtos import ActionOptions, ActionDetails, ActionResult
 import random
@@ -218,10 +219,32 @@ def finish_game(game):
 
 Branch = namedtuple("Branch",  # pylint:disable=C0103
                     ["is_continue",  # For this option, does play continue?
-                     "options",  # Combos that lead to this option
+                     "combos",  # Mask of combos that lead to this option
+                     "count",  # Number of combos in combos
                      "action",  # Action that results from this option
                      "range"])  # Range for player making the action
 
+def _live_combos(hand_range, dead_mask):
+    """
+    Return (mask, count) of the combos of (evenly weighted) hand_range that
+    don't contain dead cards
+    """
+    masks = hand_range.combo_masks()
+    if len(masks) > 1:
+        raise ValueError("range is not evenly weighted")
+    mask = sum(masks.values()) & ~dead_mask
+    return mask, bin(mask).count('1')
+
+def _nth_combo(mask, index):
+    """
+    The hand of the index'th (from 0) combo in mask, as a list of two Card
+    """
+    for comboid in mask_comboids(mask):
+        if index == 0:
+            return list(COMBO_HANDS[comboid])
+        index -= 1
+    raise IndexError("combo index out of range")
+
 class WhatCouldBe(object):
     """
     Determine how to handle current range action.
@@ -312,32 +335,33 @@ class WhatCouldBe(object):
         dead_cards = [card for card in self.game.board if card is not None]
         dead_cards.extend(concatenate([v for k, v in cards_dealt.iteritems()
                                        if k is not self.rgp]))
-        fold_options = self.range_action.fold_range  \
-            .generate_options_unweighted(dead_cards)
-        passive_options = self.range_action.passive_range  \
-            .generate_options_unweighted(dead_cards)
-        aggressive_options = self.range_action.aggressive_range  \
-            .generate_options_unweighted(dead_cards)
+        dead_mask = board_mask(dead_cards)
+        fold_combos, fold_count = _live_combos(
+            self.range_action.fold_range, dead_mask)
+        passive_combos, passive_count = _live_combos(
+            self.range_action.passive_range, dead_mask)
+        aggressive_combos, aggressive_count = _live_combos(
+            self.range_action.aggressive_range, dead_mask)
         # Consider fold
         fold_action = ActionResult.fold()
-        if len(fold_options) > 0:
+        if fold_count > 0:
             self.bough.append(Branch(self.fold_continue(),
-                                     fold_options,
+                                     fold_combos, fold_count,
                                      fold_action,
                                      self.range_action.fold_range))
         # Consider call
         passive_action = ActionResult.call(self.current_options.call_cost)
-        if len(passive_options) > 0:
+        if passive_count > 0:
             self.bough.append(Branch(self.passive_continue(),
-                                     passive_options,
+                                     passive_combos, passive_count,
                                      passive_action,
                                      self.range_action.passive_range))
         # Consider raise
         aggressive_action = ActionResult.raise_to(
             self.range_action.raise_total, self.current_options.is_raise)
-        if len(aggressive_options) > 0:
+        if aggressive_count > 0:
             self.bough.append(Branch(self.aggressive_continue(),
-                                     aggressive_options,
+                                     aggressive_combos, aggressive_count,
                                      aggressive_action,
                                      self.range_action.aggressive_range))
 
@@ -345,9 +369,10 @@ class WhatCouldBe(object):
         """
         Assign new range to rgp, and redeal their hand
         """
-        # branch.options excludes cards dealt, branch.range does not
+        # branch.combos excludes cards dealt, branch.range does not
         self.rgp.range_raw = branch.range.description
-        self.rgp.cards_dealt = random.choice(branch.options)
+        self.rgp.cards_dealt = _nth_combo(branch.combos,
+                                          random.randrange(branch.count))
         logging.debug("gameid %d, new range for userid %d, new range %r, " +
                       "new cards_dealt %r", self.rgp.gameid, self.rgp.userid,
                       self.rgp.range_raw, self.rgp.cards_dealt)
@@ -359,36 +384,41 @@ class WhatCouldBe(object):
         """
         # reduce current factor by the ratio of non-terminal-to-terminal options
         non_terminal = []
-        terminal = []
+        non_terminal_count = 0
+        terminal_count = 0
         for branch in self.bough:
-            if not branch.options:
+            if not branch.count:
                 continue
             if branch.is_continue:
                 logging.debug("gameid %d, potential action %r would continue",
                               self.game.gameid, branch.action)
-                non_terminal.extend(branch.options)
+                non_terminal.append(branch)
+                non_terminal_count += branch.count
             else:
                 logging.debug("gameid %d, potential action %r would terminate",
                               self.game.gameid, branch.action)
-                terminal.extend(branch.options)
-        total = len(non_terminal) + len(terminal)
-        reduction = float(len(non_terminal)) / total
+                terminal_count += branch.count
+        total = non_terminal_count + terminal_count
+        reduction = float(non_terminal_count) / total
         logging.debug("gameid %d, with %d non-terminal and %d terminal, " +
                       "multiplying current factor by %0.2f from %0.2f to %0.2f",
-                      self.game.gameid, len(non_terminal), len(terminal),
+                      self.game.gameid, non_terminal_count, terminal_count,
                       reduction, self.game.current_factor,
                       self.game.current_factor * reduction)
         # the more non-terminal, the less effect on current factor
         self.game.current_factor *= reduction
         if non_terminal:
-            chosen_option = random.choice(non_terminal)
-            # but which action was chosen?
-            for branch in self.bough:
-                if chosen_option in branch.options:
-                    logging.debug("gameid %d, chosen %r for action %r",
-                        self.game.gameid, chosen_option, branch.action)
-                    self.action_result = branch.action
-                    self.re_range(branch)
+            # choose a non-terminal combo at random, i.e. a branch in
+            # proportion to its number of combos (re_range chooses the combo)
+            index = random.randrange(non_terminal_count)
+            for branch in non_terminal:
+                if index < branch.count:
+                    break
+                index -= branch.count
+            logging.debug("gameid %d, chosen action %r",
+                          self.game.gameid, branch.action)
+            self.action_result = branch.action
+            self.re_range(branch)
         else:
             logging.debug("gameid %d, what will be is to terminate",
                           self.game.gameid)
@@ -577,6 +607,48 @@ class Test(unittest.TestCase):
         for hand_out in hands_out:
             self.assertFalse(range_contains_hand(range_, hand_out))
 
+    def test_calculate_what_will_be(self):
+        """
+        Test that calculate_what_will_be chooses each non-terminal combo with
+        equal probability
+        """
+        class Stub(object):
+            """ Stands in for RunningGame and RunningGameParticipant """
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+        dead_mask = board_mask(Card.many_from_text("As"))
+        ranges = [(True, "continue 1", HandRange("AA")),  # 3 live combos
+                  (True, "continue 2", HandRange("KQs")),  # 4 live combos
+                  (False, "terminate", HandRange("22"))]  # 6 live combos
+        bough = [Branch(is_continue, mask, count, action, range_)
+                 for is_continue, action, range_ in ranges
+                 for mask, count in [_live_combos(range_, dead_mask)]]
+        game = Stub(gameid=1, current_factor=1.0, rgps=[])
+        rgp = Stub(gameid=1, userid=1, range_raw=None, cards_dealt=None)
+        trials = 14000
+        tally = {}
+        random.seed(0)
+        for _ in range(trials):
+            game.current_factor = 1.0
+            what_could_be = WhatCouldBe(game, rgp, None, None)
+            what_could_be.bough = bough
+            action = what_could_be.calculate_what_will_be()
+            hand = "".join(sorted(card.to_mnemonic()
+                                  for card in rgp.cards_dealt))
+            key = (action, rgp.range_raw, hand)
+            tally[key] = tally.get(key, 0) + 1
+        self.assertAlmostEqual(game.current_factor, 7.0 / 13.0)
+        expected = [("continue 1", "AA", hand)
+                    for hand in ["AcAd", "AcAh", "AdAh"]] +  \
+                   [("continue 2", "KQs", hand)
+                    for hand in ["KcQc", "KdQd", "KhQh", "KsQs"]]
+        self.assertEqual(sorted(tally.keys()), sorted(expected))
+        # chi-squared, 6 degrees of freedom, 0.1% critical value 22.46
+        mean = trials / 7.0
+        chi_squared = sum((count - mean) ** 2 / mean
+                          for count in tally.values())
+        self.assertLess(chi_squared, 22.46)
+
 if __name__ == '__main__':
     # 9.7s 20130205 (client-server)
     # 9.0s 20140102 (web)
@@ -215,6 +215,36 @@ class Card(object):
     def __hash__(self):
         return hash(self.rank) ^ hash(self.suit)
 
+# Every card has an index, 0 to 51, in the same order as Card.__cmp__ (i.e.
+# rank, then suit). Every two-card combo has an id, 0 to 1325, so that a combo
+# can be stored as a single integer.
+CARDS_BY_INDEX = [Card(rank, suit)
+                  for rank in RANKS_LOW_TO_HIGH
+                  for suit in SUITE_LOW_TO_HIGH]
+CARD_INDEX = {card: index for index, card in enumerate(CARDS_BY_INDEX)}
+COMBO_COUNT = 52 * 51 / 2
+# comboid -> (higher card, lower card)
+COMBOS_BY_ID = [(CARDS_BY_INDEX[higher], CARDS_BY_INDEX[lower])
+                for higher in range(52)
+                for lower in range(higher)]
+
+def combo_id(card1, card2):
+    """
+    The id (0 to 1325) of the combo of two different cards, in either order
+    """
+    higher, lower = CARD_INDEX[card1], CARD_INDEX[card2]
+    if higher < lower:
+        higher, lower = lower, higher
+    elif higher == lower:
+        raise ValueError("Combo has the same card twice: %r" % card1)
+    return higher * (higher - 1) / 2 + lower
+
+def combo_cards(comboid):
+    """
+    The (higher card, lower card) of the combo with id <comboid>
+    """
+    return COMBOS_BY_ID[comboid]
+
 def deal_card(excluded):
     """
     Warning! Dealt cards will be appended to excluded list!
@@ -267,6 +297,9 @@ def main():
     card0 = 'Ah'
     print "%s --> %s --> %s" % (card0, Card.from_text(card0),
                                 Card.from_text(card0).to_mnemonic())
+    for combo in ['AhAc', 'AcAh', 'Kd2c', '2d2c', 'AsAh']:
+        comboid = combo_id(*Card.many_from_text(combo))
+        print "%s --> %d --> %r" % (combo, comboid, combo_cards(comboid))
 
 if __name__ == '__main__':
     main()
@@ -5,7 +5,8 @@ import re
 import random
 import logging
 from rvr.poker.cards import Card, RANK_MAP, SUIT_MAP, Rank,  \
-    RANK_INVERT, Suit, SPADES, ACE, RANKS_HIGH_TO_LOW, RANKS_LOW_TO_HIGH
+    RANK_INVERT, Suit, SPADES, ACE, RANKS_HIGH_TO_LOW, RANKS_LOW_TO_HIGH,  \
+    CARD_INDEX, COMBOS_BY_ID, combo_id
 import unittest
 
 # pylint:disable=C0103
@@ -406,13 +407,40 @@ def unweighted_options_to_description(options):
     """
     return weighted_options_to_description([(o, 1) for o in options])
 
+# comboid -> the hand, as generate_options has it
+COMBO_HANDS = [frozenset(combo) for combo in COMBOS_BY_ID]
+
+# card index -> mask (bit per comboid) of the combos containing that card
+CARD_BLOCKER_MASKS = [0] * 52
+for _comboid, (_higher, _lower) in enumerate(COMBOS_BY_ID):
+    CARD_BLOCKER_MASKS[CARD_INDEX[_higher]] |= 1 << _comboid
+    CARD_BLOCKER_MASKS[CARD_INDEX[_lower]] |= 1 << _comboid
+
+def board_mask(board):
+    """
+    Mask of the combos that contain any of the cards in board
+    """
+    mask = 0
+    for card in board or []:
+        mask |= CARD_BLOCKER_MASKS[CARD_INDEX[card]]
+    return mask
+
+def mask_comboids(mask):
+    """
+    Yield the comboids in mask, in order
+    """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
 def remove_board_from_range(hand_range, board):
     """
     returns a new hand_range, with no options that contain any hand in board
     """
-    options = hand_range.generate_options(board)
-    description = weighted_options_to_description(options)
-    return HandRange(description)
+    blocked = board_mask(board)
+    return MaskedHandRange({weight: mask & ~blocked for weight, mask
+                            in hand_range.combo_masks().iteritems()})
 
 def _cmp_options(a, b):
     """
@@ -449,16 +477,28 @@ def reweight(new, old):
     if options_new:
         raise RuntimeError("reweight: option in new that isn't in old: %s" %
                            str(options_new[0]))
-    description = weighted_options_to_description(results)
-    return HandRange(description)
+    return canonical_range(results)
+
+def canonical_range(options):
+    """
+    Return a HandRange of weighted options, described by
+    weighted_options_to_description, and marked as such (is_canonical).
+    """
+    return HandRange(weighted_options_to_description(options),
+                     is_canonical=True)
 
 class HandRange(object):
     """
     Represents a hand range! (Texas Hold'em only.)
+    
+    is_canonical means that description is known to be what
+    weighted_options_to_description(self.generate_options()) would return, so
+    there's no need to call it.
     """
-    def __init__(self, description, is_strict=True):
+    def __init__(self, description, is_strict=True, is_canonical=False):
         self.description = str(description)
         self.is_strict = is_strict
+        self.is_canonical = is_canonical
         if description == NOTHING:
             self.subranges = []
         else:
@@ -468,6 +508,21 @@ class HandRange(object):
     def __repr__(self):
         return "HandRange(description=%r)" % self.description
     
+    def combo_masks(self):
+        """
+        Returns a dict of weight -> mask (bit per comboid) of the combos with
+        that weight. Worked out once per HandRange.
+        
+        Duplicate options (which make a range invalid) are lost.
+        """
+        masks = self.__dict__.get('_combo_masks')
+        if masks is None:
+            masks = {}
+            for hand, weight in self.generate_options():
+                masks[weight] = masks.get(weight, 0) | (1 << combo_id(*hand))
+            self._combo_masks = masks
+        return masks
+    
     def is_empty(self):
         """
         Is this hand range nothing? E.g. when facing an all in, your raising
@@ -485,7 +540,7 @@ class HandRange(object):
         for o in original:
             if random.randrange(0, maxweight) < o[1]:
                 results.append((o[0], 1))
-        return HandRange(weighted_options_to_description(results))
+        return canonical_range(results)
 
     def generate_options(self, board=None):
         """
@@ -568,7 +623,7 @@ class HandRange(object):
         other = set(other.generate_options(board))
         mine.difference_update(other)
         # Note that this will only remove options with the same weight.
-        return HandRange(weighted_options_to_description(mine))
+        return canonical_range(mine)
     
     def add(self, other, board=None):
         """
@@ -580,7 +635,7 @@ class HandRange(object):
         other = set(other.generate_options(board))
         mine.update(other)
         # Note that this will duplicate options with different weights.
-        return HandRange(weighted_options_to_description(mine))
+        return canonical_range(mine)
         
     def validate(self):
         """
@@ -605,6 +660,73 @@ class HandRange(object):
             return False
         return True
 
+class MaskedHandRange(HandRange):
+    """
+    A HandRange defined by its combo_masks() rather than its description, so
+    that combos can be removed (see remove_board_from_range) with a few bit
+    operations.
+    
+    Its description is canonical, and worked out only when it's needed (e.g.
+    when it's stored), as are its subranges.
+    """
+    # pylint:disable=W0231
+    def __init__(self, masks, is_strict=True):
+        self.is_strict = is_strict
+        self.is_canonical = True
+        self._combo_masks = {weight: mask for weight, mask in masks.iteritems()
+                             if mask}
+        self._description = None
+        self._subranges = None
+
+    @property
+    def description(self):
+        """
+        Canonical description, per weighted_options_to_description
+        """
+        if self._description is None:
+            self._description =  \
+                weighted_options_to_description(self.generate_options())
+        return self._description
+
+    @property
+    def subranges(self):
+        """
+        Subranges, parsed from description
+        """
+        if self._subranges is None:
+            self._subranges = HandRange(self.description).subranges
+        return self._subranges
+
+    def combo_masks(self):
+        """
+        See HandRange.combo_masks
+        """
+        return self._combo_masks
+
+    def is_empty(self):
+        """
+        See HandRange.is_empty
+        """
+        return not self._combo_masks
+
+    def generate_options(self, board=None):
+        """
+        See HandRange.generate_options, but in comboid order within each
+        weight
+        """
+        blocked = board_mask(board)
+        return [(COMBO_HANDS[comboid], weight)
+                for weight, mask in sorted(self._combo_masks.iteritems())
+                for comboid in mask_comboids(mask & ~blocked)]
+
+    def generate_options_unweighted(self, board=None):
+        """
+        See HandRange.generate_options_unweighted
+        """
+        if len(self._combo_masks) > 1:
+            raise ValueError("range is not evenly weighted")
+        return [hand for hand, _weight in self.generate_options(board)]
+
 class IncompatibleRangesError(RuntimeError):
     """
     Occur when players in a game have incompatible ranges. E.g. my range is
@@ -734,6 +856,36 @@ class Test(unittest.TestCase):
             result = HandRange(minuend).subtract(HandRange(subtrahend))
             self.assertEqual(result.description, difference)
 
+    def test_canonical_range(self):
+        """ Test that canonical ranges really are """
+        board = Card.many_from_text("AhKd2c")
+        ranges = [canonical_range(HandRange(desc).generate_options(board))
+                  for desc in ["anything", "nothing", "22+,AKs", "QQ(3),T9s"]]
+        ranges.append(HandRange("KK+").add(HandRange("AQo")))
+        ranges.append(HandRange("anything").subtract(HandRange("A2+")))
+        for hand_range in ranges:
+            self.assertTrue(hand_range.is_canonical)
+            self.assertEqual(hand_range.description,
+                weighted_options_to_description(hand_range.generate_options()))
+        self.assertFalse(HandRange("AA,KK").is_canonical)
+
+    def test_remove_board_from_range(self):
+        """ Test remove_board_from_range against the options it should have """
+        for desc in ["anything", "nothing", "22+,AKs", "QQ(3),T9s", "AhKh"]:
+            for board_text in ["", "AhKd2c", "AhKd2cTs9s"]:
+                board = Card.many_from_text(board_text)
+                hand_range = HandRange(desc)
+                result = remove_board_from_range(hand_range, board)
+                expected = canonical_range(hand_range.generate_options(board))
+                self.assertEqual(result.description, expected.description)
+                ids = lambda options: sorted((combo_id(*hand), weight)
+                                             for hand, weight in options)
+                self.assertEqual(ids(result.generate_options()),
+                                 ids(expected.generate_options()))
+                self.assertEqual(result.is_empty(), expected.is_empty())
+                again = remove_board_from_range(result, board)
+                self.assertEqual(again.description, result.description)
+
 if __name__ == '__main__':
     # 0.035s in 20130205 (Eclipse 3.6.1)
     # 0.035s on 20131230 (Eclipse 4.2.2)
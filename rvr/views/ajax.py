@@ -3,7 +3,11 @@ Helpful functions to be called by JavaScript
 """
 
 from rvr.app import APP
-from flask import jsonify
+from flask import jsonify, request, session
+from rvr.core.api import API, APIError
+from rvr.core.events import GAME_EVENTS
+from rvr.core.dtos import GameItemUserRange, GameItemRangeAction,  \
+    GameItemActionResult, GameItemBoard, GameItemTimeout
 from rvr.poker.handrange import NOTHING, ANYTHING
 import json
 import urllib2
@@ -68,4 +72,108 @@ def total_donated():
         # Also, see if this call now honours cors=true
         logging.info("Failed to retrieve donation total.")
         return jsonify(total_received=250000)
-    return jsonify(total_received=response['total_received'])
\ No newline at end of file
+    return jsonify(total_received=response['total_received'])
+
+# Longest that /ajax/game_events waits for something to happen, in seconds
+EVENTS_WAIT = 25
+
+# Most /ajax/game_events requests (per process) waiting at once. Each holds a
+# worker thread while it waits, so this has to stay well below the number of
+# threads, or waiting requests would starve the rest of the site.
+MAX_EVENTS_WAITERS = 20
+
+HISTORY_ITEM_TYPES = {GameItemUserRange: "USER_RANGE",
+                      GameItemRangeAction: "RANGE_ACTION",
+                      GameItemActionResult: "ACTION_RESULT",
+                      GameItemBoard: "BOARD",
+                      GameItemTimeout: "TIMEOUT"}
+
+@APP.route('/ajax/game_history')
+def game_history():
+    """
+    usage:
+    ?gameid=g&next_hh=n
+    
+    gameid is the game to look at
+    
+    next_hh is the game's next_hh as of the client's last view of it, i.e. the
+    order of the first history item the client hasn't seen
+    
+    Returns 304 (Not Modified) if nothing has happened in the game since then.
+    Otherwise returns next_hh, is_finished, current_userid, and items, a list
+    of the new history items (each with order, type and text) that the
+    logged-in user (if any) is allowed to see.
+    """
+    try:
+        gameid = int(request.args['gameid'])
+        next_hh = int(request.args.get('next_hh', 0))
+    except (KeyError, ValueError):
+        return jsonify(error="Invalid game ID or next_hh."), 400
+    userid = session.get('userid', None)
+    api = API()
+    response = api.get_game_update(gameid, next_hh, userid)
+    if response is api.ERR_NO_SUCH_RUNNING_GAME:
+        return jsonify(error="Invalid game ID."), 404
+    if isinstance(response, APIError):
+        logging.debug("game_history error: %s", response)
+        return jsonify(error=response.description), 500
+    if response.next_hh == next_hh:
+        return "", 304
+    return jsonify(**_game_update_to_dict(response))
+
+def _game_update_to_dict(update):
+    """
+    JSON-friendly version of a dtos.GameHistoryUpdate
+    """
+    items = [{"order": item.order,
+              "type": HISTORY_ITEM_TYPES.get(item.__class__, "UNKNOWN"),
+              "text": str(item)}
+             for item in update.history]
+    return {"next_hh": update.next_hh,
+            "is_finished": update.is_finished(),
+            "current_userid": update.current_userid,
+            "items": items}
+
+@APP.route('/ajax/game_events')
+def game_events():
+    """
+    usage:
+    ?gameid=g&next_hh=n
+    
+    Long-polling version of /ajax/game_history. If nothing has happened in the
+    game since next_hh, waits up to EVENTS_WAIT seconds for something to, then
+    responds just as game_history would (304 if still nothing has happened).
+    
+    The wait is on GAME_EVENTS rather than the database, which is checked once
+    more at the end, to see changes made by other processes (e.g. timeouts
+    processed from the admin console). If MAX_EVENTS_WAITERS requests are
+    already waiting, it doesn't wait, and the client should wait a while
+    before asking again.
+    
+    Limits: the server's workers are synchronous, so each waiting request
+    holds a worker thread, for up to EVENTS_WAIT seconds. That means at most
+    MAX_EVENTS_WAITERS subscribers per process, not hundreds. The rest fall
+    back to polling (every 10 seconds, from game.html), each poll a database
+    read. Holding hundreds of idle subscribers would need an asynchronous
+    server (e.g. gevent workers, or a separate event server), which our
+    hosting doesn't offer.
+    """
+    try:
+        gameid = int(request.args['gameid'])
+        next_hh = int(request.args.get('next_hh', 0))
+    except (KeyError, ValueError):
+        return jsonify(error="Invalid game ID or next_hh."), 400
+    userid = session.get('userid', None)
+    api = API()
+    response = api.get_game_update(gameid, next_hh, userid)
+    if not isinstance(response, APIError) and response.next_hh == next_hh:
+        GAME_EVENTS.wait(gameid, next_hh, EVENTS_WAIT, MAX_EVENTS_WAITERS)
+        response = api.get_game_update(gameid, next_hh, userid)
+    if response is api.ERR_NO_SUCH_RUNNING_GAME:
+        return jsonify(error="Invalid game ID."), 404
+    if isinstance(response, APIError):
+        logging.debug("game_events error: %s", response)
+        return jsonify(error=response.description), 500
+    if response.next_hh == next_hh:
+        return "", 304
+    return jsonify(**_game_update_to_dict(response))
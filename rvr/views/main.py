@@ -5,6 +5,7 @@ from flask import render_template, redirect, url_for
 from rvr.app import APP
 from rvr.forms.change import ChangeForm
 from rvr.core.api import API, APIError
+from rvr.db.creation import run_unit_of_work
 from rvr.app import AUTH
 from rvr.core.dtos import LoginRequest, ChangeScreennameRequest,  \
     GameItemUserRange, GameItemBoard, GameItemActionResult,  \
@@ -17,6 +18,9 @@ from rvr.core import dtos
 from rvr.poker.handrange import NOTHING, SET_ANYTHING_OPTIONS,  \
     HandRange, unweighted_options_to_description
 from flask_googleauth import logout
+from functools import wraps
+import copy
+import unittest
 
 # pylint:disable=R0911,R0912,R0914
 
@@ -83,6 +87,35 @@ def ensure_user():
                 session['screenname'] = req2.screenname
         flash("You have logged in as '%s'" % (session['screenname'],))
 
+def unit_of_work_view(fun):
+    """
+    Run the view's API calls in a single unit of work, sharing one session
+    (so that e.g. the user is loaded once), and committing once at the end.
+    See rvr.db.creation.unit_of_work. (Within a unit of work, reads use the
+    shared session too, rather than a read-only session of their own.)
+    
+    If the unit of work has to be retried, changes the failed attempt made to
+    the Flask session (messages flashed, or a userid from a login that was
+    rolled back) are undone. Emails are sent only once the unit of work is
+    committed, so retrying doesn't duplicate them. The view must not render a
+    template, which would consume flashed messages; it should redirect, or
+    leave rendering to its caller.
+    """
+    @wraps(fun)
+    def inner(*args, **kwargs):
+        """
+        See parent.
+        """
+        saved = copy.deepcopy(dict(session))
+        def before_retry():
+            """
+            Undo the failed attempt's changes to the Flask session
+            """
+            session.clear()
+            session.update(copy.deepcopy(saved))
+        return run_unit_of_work(lambda: fun(*args, **kwargs), before_retry)
+    return inner
+
 def error(message):
     """
     Flash error message and redirect to error page.
@@ -90,17 +123,16 @@ def error(message):
     flash(message)
     return redirect(url_for('error_page'))
 
-@APP.route('/change', methods=['GET','POST'])
-@AUTH.required
-def change_screenname():
+@unit_of_work_view
+def _change_screenname(form):
     """
-    Without the user being logged in, give the user the option to change their
-    screenname from what Google OpenID gave us.
+    The writes for change_screenname: ensure the user exists, and change their
+    screenname if the form has been submitted. Returns where to redirect to,
+    if anywhere.
     """
     alt = ensure_user()
     if alt:
         return alt
-    form = ChangeForm()
     if form.validate_on_submit():
         new_screenname = form.change.data
         if 'userid' in session:
@@ -124,6 +156,18 @@ def change_screenname():
             # account.
             session['screenname'] = new_screenname
             return redirect(url_for('home_page'))
+
+@APP.route('/change', methods=['GET','POST'])
+@AUTH.required
+def change_screenname():
+    """
+    Without the user being logged in, give the user the option to change their
+    screenname from what Google OpenID gave us.
+    """
+    form = ChangeForm()
+    alt = _change_screenname(form)
+    if alt:
+        return alt
     current = session['screenname'] if 'screenname' in session  \
         else g.user['name']
     navbar_items = [('', url_for('home_page'), 'Home'),
@@ -208,6 +252,22 @@ def faq_page():
                            navbar_items=navbar_items,
                            is_logged_in=is_logged_in())
 
+@unit_of_work_view
+def _home_page_games(finished_before):
+    """
+    The database work for home_page: ensure the user exists, and load their
+    dashboard. Returns (alt, dashboard), where alt is where to redirect to, if
+    anywhere.
+    """
+    alt = ensure_user()
+    if alt:
+        return alt, None
+    my_games = API().get_user_dashboard(session['userid'], finished_before)
+    if isinstance(my_games, APIError):
+        flash("An unknown error occurred retrieving your games.")
+        return redirect(url_for("error_page")), None
+    return None, my_games
+
 @APP.route('/', methods=['GET'])
 def home_page():
     """
@@ -215,21 +275,18 @@ def home_page():
     """
     if not is_authenticated():
         return render_template('web/landing.html')
-    alt = ensure_user()
+    finished_before = request.args.get('finished_before', None, type=int)
+    alt, my_games = _home_page_games(finished_before)
     if alt:
         return alt
-    api = API()
     userid = session['userid']
     screenname = session['screenname']
-    open_games = api.get_open_games()
-    if isinstance(open_games, APIError):
-        flash("An unknown error occurred retrieving your open games.")
-        return redirect(url_for("error_page"))
-    my_games = api.get_user_running_games(userid)
-    if isinstance(my_games, APIError):
-        flash("An unknown error occurred retrieving your running games.")
-        return redirect(url_for("error_page"))
-    selected_heading = request.cookies.get("selected-heading", "heading-open")
+    open_games = my_games.open_details
+    if finished_before is not None:
+        selected_heading = "heading-finished"
+    else:
+        selected_heading = request.cookies.get("selected-heading",
+                                               "heading-open")
     my_games.running_details.sort(
         key=lambda rg: rg.current_user_details.userid != userid)
     my_open = [og for og in open_games
@@ -246,12 +303,15 @@ def home_page():
         my_open=my_open,
         others_open=others_open,
         my_finished_games=my_games.finished_details,
+        finished_before=finished_before,
+        next_finished_before=my_games.next_finished_before,
         navbar_items=navbar_items,
         selected_heading=selected_heading,
         is_logged_in=is_logged_in())
 
 @APP.route('/join', methods=['GET'])
 @AUTH.required
+@unit_of_work_view
 def join_game():
     """
     Join game, flash status, redirect back to /home
@@ -295,6 +355,7 @@ def join_game():
 
 @APP.route('/leave', methods=['GET'])
 @AUTH.required
+@unit_of_work_view
 def leave_game():
     """
     Leave game, flash status, redirect back to /home
@@ -515,22 +576,10 @@ def _make_history_list(game_history):
             results.append(("UNKNOWN", (str(item),)))
     return results
 
-def _running_game(game, gameid, userid, api):
+def _running_game(game, gameid, userid, form):
     """
     Response from game page when the requested game is still running.
     """
-    form = action_form(is_check=game.current_options.can_check(),
-        is_raise=game.current_options.is_raise,
-        can_raise=game.current_options.can_raise(),
-        min_raise=game.current_options.min_raise,
-        max_raise=game.current_options.max_raise)
-    if form.validate_on_submit():
-        if _handle_action(gameid, userid, api, form,
-                          game.current_options.can_check(),
-                          game.current_options.can_raise()):
-            return redirect(url_for('game_page', gameid=gameid))   
-    
-    # First load, OR something's wrong with their data.
     range_editor_url = url_for('range_editor',
         rng_original=game.game_details.current_player.range_raw,
         board=game.game_details.board_raw,
@@ -550,7 +599,7 @@ def _running_game(game, gameid, userid, api):
     return render_template('web/game.html', title=title, form=form,
         board=board, game_details=game.game_details, history=history,
         current_options=game.current_options,
-        is_me=is_me, is_running=True,
+        is_me=is_me, is_running=True, userid=userid,
         range_editor_url=range_editor_url,
         navbar_items=navbar_items, is_logged_in=is_logged_in())
 
@@ -569,17 +618,19 @@ def _finished_game(game, gameid):
         is_running=False,
         navbar_items=navbar_items, is_logged_in=is_logged_in())
 
-def authenticated_game_page(gameid):
+def _game_page_game(gameid, userid):
     """
-    Game page when user is not authenticated (i.e. the public view)
+    The database work for game_page: load the game (the private view if
+    userid is specified, otherwise the public view), and if it's running,
+    perform the action submitted, if any. Returns (alt, game, form), where alt
+    is where to redirect to, if anywhere, and form is the action form, if the
+    game is running.
     """
-    alt = ensure_user()
-    if alt:
-        return alt
-    userid = session['userid']
-
     api = API()
-    response = api.get_private_game(gameid, userid)
+    if userid is None:
+        response = api.get_public_game(gameid)
+    else:
+        response = api.get_private_game(gameid, userid)
     if isinstance(response, APIError):
         if response is api.ERR_NO_SUCH_RUNNING_GAME:
             msg = "Invalid game ID."
@@ -587,32 +638,56 @@ def authenticated_game_page(gameid):
             msg = "An unknown error occurred retrieving game %d, sorry." %  \
                 (gameid,)
         flash(msg)
-        return redirect(url_for('error_page'))
-    
+        return redirect(url_for('error_page')), None, None
     if response.is_finished():
-        return _finished_game(response, gameid)
+        return None, response, None
+    form = action_form(is_check=response.current_options.can_check(),
+        is_raise=response.current_options.is_raise,
+        can_raise=response.current_options.can_raise(),
+        min_raise=response.current_options.min_raise,
+        max_raise=response.current_options.max_raise)
+    if form.validate_on_submit():
+        if _handle_action(gameid, userid, api, form,
+                          response.current_options.can_check(),
+                          response.current_options.can_raise()):
+            return redirect(url_for('game_page', gameid=gameid)),  \
+                response, form
+    # First load, OR something's wrong with their data.
+    return None, response, form
+
+@unit_of_work_view
+def _authenticated_game_page_game(gameid):
+    """
+    _game_page_game for the user, after ensuring they exist
+    """
+    alt = ensure_user()
+    if alt:
+        return alt, None, None
+    return _game_page_game(gameid, session['userid'])
+
+def authenticated_game_page(gameid):
+    """
+    Game page when user is not authenticated (i.e. the public view)
+    """
+    alt, game, form = _authenticated_game_page_game(gameid)
+    if alt:
+        return alt
+    if game.is_finished():
+        return _finished_game(game, gameid)
     else:
-        return _running_game(response, gameid, userid, api)
+        return _running_game(game, gameid, session['userid'], form)
 
 def unauthenticated_game_page(gameid):
     """
     Game page when user is authenticated (i.e. the private view)
     """
-    api = API()
-    response = api.get_public_game(gameid)
-    if isinstance(response, APIError):
-        if response is api.ERR_NO_SUCH_RUNNING_GAME:
-            msg = "Invalid game ID."
-        else:
-            msg = "An unknown error occurred retrieving game %d, sorry." %  \
-                (gameid,)
-        flash(msg)
-        return redirect(url_for('error_page'))
-    
-    if response.is_finished():
-        return _finished_game(response, gameid)
+    alt, game, form = _game_page_game(gameid, None)
+    if alt:
+        return alt
+    if game.is_finished():
+        return _finished_game(game, gameid)
     else:
-        return _running_game(response, gameid, None, api)
+        return _running_game(game, gameid, None, form)
 
 @APP.route('/game', methods=['GET', 'POST'])
 def game_page():
@@ -709,3 +784,84 @@ def analysis_page():
         items_fold=items_fold,
         is_raise=aife.is_raise, is_check=aife.is_check,
         navbar_items=navbar_items, is_logged_in=is_logged_in())
+
+class Test(unittest.TestCase):
+    """
+    Unit test class
+    """
+    # pylint:disable=R0904
+    def test_unit_of_work(self):
+        """
+        Test that join_game's API calls share one transaction, and that when
+        it is retried, the failed attempt's changes to the Flask session are
+        undone
+        """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import SESSION
+        from sqlalchemy import event
+        from sqlalchemy.exc import OperationalError
+        import sqlite3
+        commits = []
+        def fail_first_commit(db_session):
+            """ Count commits (not savepoints), and fail the first """
+            if db_session.transaction.nested:
+                return
+            commits.append(True)
+            if len(commits) == 1:
+                raise OperationalError("COMMIT", {},
+                    sqlite3.OperationalError("database is locked"))
+        with game_db() as (api, _, _):
+            gameid = api.get_open_games()[0].gameid
+            client = APP.test_client()
+            with client.session_transaction() as flask_session:
+                flask_session['openid'] = {'identity': 'test',
+                                           'email': 'test@example.com',
+                                           'name': 'test'}
+            event.listen(SESSION, "before_commit", fail_first_commit)
+            try:
+                response = client.get('/join?gameid=%d' % (gameid,))
+            finally:
+                event.remove(SESSION, "before_commit", fail_first_commit)
+            self.assertEqual(response.status_code, 302)
+            # login, change_screenname and join_game, twice
+            self.assertEqual(len(commits), 2)
+            with client.session_transaction() as flask_session:
+                userid = flask_session['userid']
+                flashes = [message for _category, message
+                           in flask_session['_flashes']]
+            self.assertEqual(flashes,
+                ["You have logged in as 'Player %d'" % (userid,),
+                 "You have joined game %d." % (gameid,)])
+            self.assertIn(userid, [user.userid
+                                   for game in api.get_open_games()
+                                   for user in game.users])
+
+    def test_home_page(self):
+        """
+        Test that a first login's home page (login, change_screenname and
+        get_user_dashboard) commits once
+        """
+        from rvr.core.fixture import game_db
+        from rvr.db.creation import SESSION
+        from sqlalchemy import event
+        commits = []
+        def count_commit(db_session):
+            """ Count commits (not savepoints) """
+            if not db_session.transaction.nested:
+                commits.append(True)
+        with game_db():
+            client = APP.test_client()
+            with client.session_transaction() as flask_session:
+                flask_session['openid'] = {'identity': 'test',
+                                           'email': 'test@example.com',
+                                           'name': 'test'}
+            event.listen(SESSION, "before_commit", count_commit)
+            try:
+                response = client.get('/')
+            finally:
+                event.remove(SESSION, "before_commit", count_commit)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(commits), 1)
+            with client.session_transaction() as flask_session:
+                self.assertEqual(flask_session['screenname'],
+                                 'Player %d' % (flask_session['userid'],))